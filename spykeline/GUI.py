@@ -27,7 +27,7 @@ import spikeinterface.sorters as ss
 
 from spykeline.spikesorting.sorter_params import sorter_dict
 from spykeline.config import home_probes, default_parameters, parameters_description, repo_path
-from spykeline.tools import read_rhd
+from spykeline.tools import read_rhd, rhd_data_files
 from probeinterface import get_probe
 
 class SpykelineGUI:
@@ -65,6 +65,7 @@ class SpykelineGUI:
         self.input_path = None
         self.secondary_path = None
         self.params = defaultdict(dict)
+        self.defaults = parameters
         self.disc_channels = StringVar()
         self.nb_probes = None
         self.probes = defaultdict(dict)
@@ -216,6 +217,7 @@ class SpykelineGUI:
 
         # Collect values from GUI widgets
         self.params['general'] = {
+            **self.defaults['general'],
             'plot_probe': self.var_plot.get(),
             'export_to_phy': self.var_phy.get(),
             'export_to_klusters': self.var_klu.get(),
@@ -227,6 +229,7 @@ class SpykelineGUI:
             'mode': running_mode
         }
         self.params['preprocessing'] = {
+            **self.defaults['preprocessing'],
             'filter': {
                 'freq_min': self.var_minf.get(),
                 'freq_max': self.var_maxf.get(),
@@ -238,12 +241,14 @@ class SpykelineGUI:
             'whiten': False
         }
         self.params['spikesorting'] = {
+            **self.defaults['spikesorting'],
             'folder': self.ent_sort_path.get().strip(),
             'execution_mode': self.var_EM.get().strip(),
             'sorter': self.var_sorter.get().strip(),
             'pipeline': self.pipeline.get().strip()
         }
         self.params['curation'] = {
+            **self.defaults['curation'],
             'recursive': self.var_recursive.get(),
             'remove_noise_units': self.var_noise.get(),
         }
@@ -300,8 +305,8 @@ class SpykelineGUI:
                 all_paths_valid = False
 
         files = os.listdir(paths['Input Path'])
-        if not any(file.endswith('.dat') for file in files):
-                messagebox.showerror("Path Error", f"The .dat file is missing in the input path: {paths['Input Path']}")
+        if not any(file.endswith('.dat') for file in files) and not self.defaults['general']['dat_files'] and not rhd_data_files(paths['Input Path']):
+                messagebox.showerror("Path Error", f"The .dat file, or .rhd files holding the data, are missing in the input path: {paths['Input Path']}")
                 all_paths_valid = False
 
         # Check rhd or metadata:
@@ -318,6 +323,8 @@ class SpykelineGUI:
                 anat = metadata['Anatomical_groups'][:-1]
         else:
             rhd_path = os.path.join(paths['Input Path'], 'info.rhd')
+            if not os.path.exists(rhd_path) and rhd_data_files(paths['Input Path']):
+                rhd_path = rhd_data_files(paths['Input Path'])[0]
             assert os.path.exists(rhd_path), "No rhd file was found in the given in the input path"
             intan_info = read_rhd(rhd_path)
             anat = intan_info['Probe_channels']
@@ -0,0 +1,270 @@
+import os
+import csv
+import copy
+import glob
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+
+from typing import Dict, List, Optional
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from .config import default_parameters
+from .planner import available_cores
+from .spikesorting.scheduler import total_memory_gb
+
+SUMMARY_FIELDS = ['folder', 'status', 'attempts', 'started', 'finished', 'duration_s', 'output_folder', 'error']
+
+
+def load_params(params_file: Optional[str]) -> dict:
+    """
+    Spykeline's parameters from a json file, e.g. the spykeparams.json saved in an output folder,
+    each section being completed with the default parameters.
+    """
+    params = copy.deepcopy(default_parameters)
+    if params_file is None:
+        return params
+
+    with open(params_file, 'r') as f:
+        user_params = json.load(f)
+    for section, values in user_params.items():
+        params[section] = {**params.get(section, {}), **values} if isinstance(values, dict) else values
+
+    return params
+
+def load_probes(folder: str, probes_file: Optional[str] = None) -> Dict[int, dict]:
+    """
+    Probes of a session: the probes.json of its folder, written by the GUI, else the probes_file given.
+    """
+    probe_file = os.path.join(folder, 'probes.json')
+    if not os.path.exists(probe_file):
+        probe_file = probes_file
+    if probe_file is None or not os.path.exists(probe_file):
+        raise FileNotFoundError(f"No probes.json in {folder}, run the GUI once on it or give a probes file")
+
+    with open(probe_file, 'r') as f:
+        probes = json.load(f)
+
+    return {int(key): value for key, value in probes.items()}
+
+def expand_sessions(patterns: List[str]) -> List[str]:
+    """
+    Session folders matching the patterns, in the given order and sorted by name within a pattern.
+    """
+    folders = []
+    for pattern in patterns:
+        for folder in sorted(glob.glob(pattern)) or [pattern]:
+            folder = os.path.abspath(folder)
+            if os.path.isdir(folder) and folder not in folders:
+                folders.append(folder)
+
+    return folders
+
+
+class WorkQueue:
+    """
+    Sessions to process, with their status and timings, saved in a json file at each change so that
+    a batch interrupted at any point resumes where it stopped.
+
+    A session is 'pending', 'running', 'done' or 'failed'. When the queue is loaded, the sessions left
+    'running' by an interrupted batch are pending again, the done ones are never processed again.
+    """
+
+    def __init__(self, file: str, retry_failed: bool = False):
+        self.file = file
+        self.sessions = []
+
+        if os.path.exists(file):
+            with open(file, 'r') as f:
+                self.sessions = json.load(f)['sessions']
+        for session in self.sessions:
+            if session['status'] == 'running' or (retry_failed and session['status'] == 'failed'):
+                session['status'] = 'pending'
+        self.save()
+
+    def add(self, folders: List[str]) -> None:
+        known = [session['folder'] for session in self.sessions]
+        for folder in folders:
+            if folder not in known:
+                self.sessions.append({field: None for field in SUMMARY_FIELDS})
+                self.sessions[-1].update(folder=folder, status='pending', attempts=0)
+        self.save()
+
+    def pending(self) -> List[dict]:
+        return [session for session in self.sessions if session['status'] == 'pending']
+
+    def update(self, session: dict, **values) -> None:
+        session.update(values)
+        self.save()
+
+    def save(self) -> None:
+        # Replaced in one step, the file is never left half written
+        os.makedirs(os.path.dirname(os.path.abspath(self.file)), exist_ok=True)
+        tmp_file = f'{self.file}.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'sessions': self.sessions}, f, indent=4)
+        os.replace(tmp_file, self.file)
+
+    def write_summary(self, summary_file: str) -> None:
+        """
+        Status and timings of each session in a csv file.
+        """
+        with open(summary_file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=SUMMARY_FIELDS)
+            writer.writeheader()
+            for session in self.sessions:
+                writer.writerow({field: session.get(field) for field in SUMMARY_FIELDS})
+
+
+def run_session(folder: str, params: dict, secondary_path: Optional[str], probes_file: Optional[str]) -> str:
+    """
+    Run the whole pipeline on a session, in a worker process.
+
+    Returns
+    -------
+    output_folder : str
+        The session's output folder.
+    """
+    from . import set_spykeparams
+    from .run_spykeline import run_spykeline
+
+    probe_dict = load_probes(folder, probes_file)
+
+    params = copy.deepcopy(params)
+    # As the GUI does, a single probe is sorted with the 'all' pipeline
+    params['general']['mode'] = 'single' if len(probe_dict) == 1 else 'multiple'
+    if len(probe_dict) == 1 and params['spikesorting']['pipeline'] == 'by_probe':
+        params['spikesorting']['pipeline'] = 'all'
+    if secondary_path:
+        secondary_path = os.path.join(secondary_path, os.path.basename(folder))
+        os.makedirs(secondary_path, exist_ok=True)
+        params['general']['secondary_path'] = True
+
+    spykeparams = set_spykeparams(params)
+
+    return run_spykeline(folder, secondary_path, spykeparams, probe_dict)
+
+def run_batch(sessions: List[str],
+              params_file: Optional[str],
+              queue_file: str,
+              n_workers: int = 1,
+              secondary_path: Optional[str] = None,
+              probes_file: Optional[str] = None,
+              retry_failed: bool = False) -> WorkQueue:
+    """
+    Run Spykeline on several sessions, without the GUI, each session being processed by a worker
+    process running the whole pipeline.
+
+    The sessions are kept in a queue file, so that running the same command again after a crash
+    only processes the sessions that weren't done. The status and timings of every session are
+    written to <queue>_summary.csv.
+
+    Parameters
+    ----------
+    sessions : list
+        Session folders, or glob patterns of them.
+    params_file : str
+        Json file of Spykeline's parameters, the default ones if None.
+    queue_file : str
+        Json file of the queue, created if it doesn't exist.
+    n_workers : int
+        Number of sessions processed at once, sharing the cores and RAM of the machine,
+        or the ones set in the parameters. Default is 1.
+    secondary_path : str, optional
+        Folder where the output of each session is saved, in a folder named as the session.
+        If None, the output is saved in the session's folder.
+    probes_file : str, optional
+        Probes of the sessions without a probes.json.
+    retry_failed : bool
+        Process again the sessions that failed in a previous run. Default is False.
+
+    Returns
+    -------
+    queue : WorkQueue
+        The queue, with the status and timings of every session.
+    """
+    params = load_params(params_file)
+
+    # The sessions processed at once share the machine, each one plans its jobs within its share
+    if n_workers > 1:
+        n_cores = params['spikesorting']['n_cores'] or available_cores()
+        ram_gb = params['spikesorting']['ram_gb'] or total_memory_gb()
+        params['spikesorting']['n_cores'] = max(1, n_cores // n_workers)
+        params['spikesorting']['ram_gb'] = ram_gb / n_workers if ram_gb else None
+        print(f"Each session gets {params['spikesorting']['n_cores']} cores"
+              + (f" and {params['spikesorting']['ram_gb']:.0f} GB" if ram_gb else ""))
+
+    queue = WorkQueue(queue_file, retry_failed)
+    queue.add(expand_sessions(sessions))
+    summary_file = os.path.splitext(queue_file)[0] + '_summary.csv'
+
+    done = [session for session in queue.sessions if session['status'] == 'done']
+    print(f"{len(queue.sessions)} sessions in the queue, {len(done)} already done, {len(queue.pending())} to process")
+
+    while queue.pending():
+        running = {}
+        broken = False
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            while queue.pending() or running:
+                # As many sessions are submitted as there are workers, so that the submitted ones are the running ones
+                for session in ([] if broken else queue.pending()[:n_workers - len(running)]):
+                    try:
+                        future = executor.submit(run_session, session['folder'], params, secondary_path, probes_file)
+                    except BrokenProcessPool:
+                        broken = True
+                        break
+                    queue.update(session, status='running', attempts=session['attempts'] + 1, started=time.time(), error=None)
+                    print(f"Processing {session['folder']}")
+                    running[future] = session
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    session = running.pop(future)
+                    end = time.time()
+                    try:
+                        output_folder = future.result()
+                        queue.update(session, status='done', finished=end, duration_s=end - session['started'], output_folder=output_folder)
+                        print(f"Done {session['folder']} in {end - session['started']:.0f}s")
+                    except Exception as error:
+                        message = ''.join(traceback.format_exception_only(type(error), error)).strip()
+                        queue.update(session, status='failed', finished=end, duration_s=end - session['started'], error=message)
+                        print(f"Failed {session['folder']}: {message}")
+                        # A worker killed (e.g. out of memory) breaks the pool, which is started again once the
+                        # sessions it was running are failed
+                        broken = broken or isinstance(error, BrokenProcessPool)
+                    queue.write_summary(summary_file)
+
+    queue.write_summary(summary_file)
+
+    counts = {status: sum(session['status'] == status for session in queue.sessions) for status in ['done', 'failed']}
+    print(f"Batch finished: {counts['done']} sessions done, {counts['failed']} failed, summary in {summary_file}")
+
+    return queue
+
+def main():
+    parser = argparse.ArgumentParser(description="Run Spykeline on several sessions, without the GUI.")
+    parser.add_argument('sessions', nargs='+', help="Session folders, or glob patterns of them.")
+    parser.add_argument('--params', default=None, help="Json file of Spykeline's parameters, e.g. a spykeparams.json of a previous run.")
+    parser.add_argument('--queue', default='spykeline_queue.json', help="Json file of the queue, to resume an interrupted batch.")
+    parser.add_argument('--workers', type=int, default=1, help="Number of sessions processed at once.")
+    parser.add_argument('--secondary-path', default=None, help="Folder of the outputs, one folder per session.")
+    parser.add_argument('--probes', default=None, help="Probes of the sessions without a probes.json.")
+    parser.add_argument('--retry-failed', action='store_true', help="Process again the sessions that failed.")
+    args = parser.parse_args()
+
+    run_batch(args.sessions,
+              args.params,
+              args.queue,
+              n_workers=args.workers,
+              secondary_path=args.secondary_path,
+              probes_file=args.probes,
+              retry_failed=args.retry_failed)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,564 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+
+import numpy as np
+import spikeinterface
+import spikeinterface.core as si
+import spikeinterface.preprocessing as spre
+import spikeinterface.sorters as ss
+
+from typing import Dict, List, Optional
+from spikeinterface.core.job_tools import ChunkRecordingExecutor, fix_job_kwargs
+
+from .tools import folder_size, extension_dependencies
+from .spikesorting.sorter_params import sorter_dict
+
+# Keys of the extensions of an analyzer folder, to chain the keys of the extensions depending on them
+KEYS_FILE = 'spykeline_cache_keys.json'
+ENTRY_FILE = 'entry.json'
+# Largest value of the sampled traces, relative to the int16 range, when they are scaled to int16
+INT16_HEADROOM = 4
+
+
+def _json_default(obj):
+    """
+    JSON fallback of the fingerprints, arrays are replaced by their digest so that they are never truncated.
+    """
+    if isinstance(obj, np.ndarray):
+        return f"{obj.dtype}{obj.shape}:{hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest()}"
+    if isinstance(obj, np.generic):
+        return obj.item()
+    return str(obj)
+
+def _digest(*parts) -> str:
+    fingerprint = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, bytes):
+            fingerprint.update(part)
+        else:
+            fingerprint.update(json.dumps(part, sort_keys=True, default=_json_default).encode())
+
+    return fingerprint.hexdigest()
+
+def _files_stats(description) -> list:
+    """
+    Size and modification time of every file a recording description points to.
+    """
+    stats = []
+    if isinstance(description, dict):
+        for key, value in description.items():
+            if key in ('file_path', 'file_paths', 'folder_path') and value is not None:
+                for path in (value if isinstance(value, (list, tuple)) else [value]):
+                    if os.path.exists(str(path)):
+                        stat = os.stat(str(path))
+                        stats.append([str(path), stat.st_size, stat.st_mtime_ns])
+            else:
+                stats.extend(_files_stats(value))
+    elif isinstance(description, (list, tuple)):
+        for value in description:
+            stats.extend(_files_stats(value))
+
+    return stats
+
+def _drop_estimated(description):
+    """
+    Recording description without the whitening matrices (W, M) of the whitening steps, which are
+    estimated on random chunks at each run, their parameters being kept.
+    """
+    if isinstance(description, dict):
+        return {key: _drop_estimated(value) for key, value in description.items()
+                if not (key in ('W', 'M') and 'recording' in description)}
+    if isinstance(description, (list, tuple)):
+        return [_drop_estimated(value) for value in description]
+
+    return description
+
+def recording_fingerprint(recording) -> Optional[str]:
+    """
+    Fingerprint of a recording: its whole preprocessing chain, with the parameters of each step,
+    and the size and modification time of the files it reads. The whitening matrices, estimated
+    on random chunks at each run, are left out so that the same chain always has the same fingerprint.
+
+    Parameters
+    ----------
+    recording : recording
+        A spikeinterface recording object.
+
+    Returns
+    -------
+    fingerprint : str
+        Hexadecimal digest, None if the recording can't be described (e.g. in memory).
+    """
+    if recording is None or not recording.check_serializability('json'):
+        return None
+
+    description = _drop_estimated(recording.to_dict(include_properties=True, recursive=True))
+    description.pop('relative_paths', None)
+
+    return _digest(description, _files_stats(description))
+
+def analyzer_fingerprint(sorting_analyzer) -> Optional[str]:
+    """
+    Fingerprint of everything the extensions of an analyzer depend on, besides their own parameters:
+    the recording, the preprocessing parameters, the spikes, the sparsity and spikeinterface's version.
+    A recording preprocessed by run_preprocessing is identified by its preprocessed_fingerprint annotation,
+    i.e. by its raw recording, rather than by the files it reads, which the demultiplexer writes at each run.
+
+    Parameters
+    ----------
+    sorting_analyzer : sorting_analyzer
+        A spikeinterface's object.
+
+    Returns
+    -------
+    fingerprint : str
+        Hexadecimal digest, None if the recording can't be fingerprinted.
+    """
+    from . import spykeparams
+
+    recording = sorting_analyzer.recording.get_annotation('preprocessed_fingerprint')
+    if recording is not None:
+        recording = _digest(recording,
+                            [str(channel_id) for channel_id in sorting_analyzer.channel_ids],
+                            [sorting_analyzer.get_num_samples(segment_index) for segment_index in range(sorting_analyzer.get_num_segments())])
+    else:
+        recording = recording_fingerprint(sorting_analyzer.recording)
+    if recording is None:
+        return None
+
+    spike_vector = sorting_analyzer.sorting.to_spike_vector()
+    mask = sorting_analyzer.sparsity.mask if sorting_analyzer.is_sparse() else None
+
+    return _digest(recording,
+                   spykeparams['preprocessing'],
+                   spikeinterface.__version__,
+                   sorting_analyzer.return_scaled,
+                   list(sorting_analyzer.unit_ids),
+                   np.ascontiguousarray(spike_vector['segment_index']).tobytes(),
+                   np.ascontiguousarray(spike_vector['sample_index']).tobytes(),
+                   np.ascontiguousarray(spike_vector['unit_index']).tobytes(),
+                   mask)
+
+def read_keys(sorting_analyzer) -> Dict[str, str]:
+    """
+    Cache keys of the extensions of an analyzer, that were computed or restored through the cache.
+    """
+    keys_file = os.path.join(sorting_analyzer.folder, KEYS_FILE)
+    if not os.path.exists(keys_file):
+        return {}
+
+    with open(keys_file, 'r') as f:
+        keys = json.load(f)
+
+    # Keys of the extensions deleted or recomputed since are dropped
+    return {extension: key for extension, key in keys.items() if sorting_analyzer.has_extension(extension)}
+
+def record_keys(sorting_analyzer, keys: Dict[str, str]) -> None:
+    keys = {**read_keys(sorting_analyzer), **keys}
+    with open(os.path.join(sorting_analyzer.folder, KEYS_FILE), 'w') as f:
+        json.dump(keys, f, indent=4)
+
+def _link_or_copy(source, destination):
+    """
+    Hard link a file, copy it across file systems. Spikeinterface deletes an extension folder before
+    writing it again, so the linked files are never modified in place.
+    """
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class ExtensionCache:
+    """
+    Content-addressed on-disk cache of the analyzer extensions.
+
+    Each entry is an extension folder, keyed by the analyzer's fingerprint, the extension's parameters
+    and the keys of the extensions it depends on, so that rerunning on the same session restores the
+    extensions instead of computing them again. When the cache exceeds its size, the least recently
+    used entries are evicted.
+    """
+
+    def __init__(self, folder: str, max_size_gb: float):
+        self.folder = folder
+        self.max_size = max_size_gb * 1e9
+
+        os.makedirs(folder, exist_ok=True)
+
+    def _entry(self, key: str) -> str:
+        return os.path.join(self.folder, key)
+
+    def keys(self, sorting_analyzer, extensions: List[str], params: Dict[str, dict]) -> Dict[str, Optional[str]]:
+        """
+        Key of each extension to compute, None when it can't be cached.
+
+        Parameters
+        ----------
+        sorting_analyzer : sorting_analyzer
+            A spikeinterface's object.
+        extensions : list
+            Extensions to compute, their dependencies first.
+        params : dict
+            Parameters of each extension to compute.
+
+        Returns
+        -------
+        keys : dict
+            Key of each extension.
+        """
+        fingerprint = analyzer_fingerprint(sorting_analyzer)
+        available = read_keys(sorting_analyzer)
+
+        keys = {}
+        for extension in extensions:
+            dependencies = [keys[dependency] if dependency in keys else available.get(dependency)
+                            for dependency in extension_dependencies.get(extension, [])]
+
+            # An extension computed without the cache can't be keyed, nor the ones depending on it
+            if fingerprint is None or None in dependencies:
+                keys[extension] = None
+            else:
+                keys[extension] = _digest(fingerprint, extension, params[extension], dependencies)
+
+        return keys
+
+    def restore(self, sorting_analyzer, extensions: List[str], keys: Dict[str, Optional[str]]) -> List[str]:
+        """
+        Restore the cached extensions into the analyzer folder. An extension is only restored if
+        the ones it depends on are available, as computing them would delete it.
+
+        Returns
+        -------
+        missing : list
+            Extensions still to compute.
+        """
+        missing, restored = [], {}
+        for extension in extensions:
+            entry = self._entry(keys[extension]) if keys[extension] else None
+            dependencies = extension_dependencies.get(extension, [])
+
+            if entry is None or not os.path.isdir(entry) or any(dependency in missing for dependency in dependencies):
+                missing.append(extension)
+                continue
+
+            shutil.copytree(os.path.join(entry, 'extension'),
+                            os.path.join(sorting_analyzer.folder, 'extensions', extension),
+                            copy_function=_link_or_copy)
+            sorting_analyzer.load_extension(extension)
+            self._touch(entry)
+            restored[extension] = keys[extension]
+
+        if restored:
+            print(f"Restored from the cache: {', '.join(restored)}")
+            record_keys(sorting_analyzer, restored)
+
+        return missing
+
+    def store(self, sorting_analyzer, extensions: List[str], keys: Dict[str, Optional[str]]) -> None:
+        """
+        Add computed extensions of the analyzer to the cache, then evict the least recently used entries.
+        """
+        stored = {}
+        for extension in extensions:
+            key = keys[extension]
+            if key is None or not sorting_analyzer.has_extension(extension):
+                continue
+            stored[extension] = key
+
+            entry = self._entry(key)
+            if os.path.isdir(entry):
+                self._touch(entry)
+                continue
+
+            # Written under a temporary name first, so that an interrupted run never leaves a partial entry
+            tmp_entry = f'{entry}.tmp{os.getpid()}'
+            shutil.copytree(os.path.join(sorting_analyzer.folder, 'extensions', extension),
+                            os.path.join(tmp_entry, 'extension'),
+                            copy_function=_link_or_copy)
+            with open(os.path.join(tmp_entry, ENTRY_FILE), 'w') as f:
+                json.dump({'extension': extension, 'size': folder_size(tmp_entry), 'last_used': time.time()}, f)
+            try:
+                os.rename(tmp_entry, entry)
+            except OSError: # Stored meanwhile by another run
+                shutil.rmtree(tmp_entry)
+
+        if stored:
+            record_keys(sorting_analyzer, stored)
+            self._evict(keep=list(stored.values()))
+
+    def _touch(self, entry: str) -> None:
+        with open(os.path.join(entry, ENTRY_FILE), 'r') as f:
+            info = json.load(f)
+        info['last_used'] = time.time()
+        with open(os.path.join(entry, ENTRY_FILE), 'w') as f:
+            json.dump(info, f)
+
+    def _evict(self, keep: List[str]) -> None:
+        """
+        Delete the least recently used entries until the cache fits in its size,
+        the entries just stored being deleted last.
+        """
+        entries = []
+        for key in os.listdir(self.folder):
+            entry_file = os.path.join(self._entry(key), ENTRY_FILE)
+            if os.path.exists(entry_file):
+                with open(entry_file, 'r') as f:
+                    info = json.load(f)
+                entries.append((key in keep, info['last_used'], info['size'], key))
+
+        total = sum(size for _, _, size, _ in entries)
+        for _, _, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(self._entry(key))
+            total -= size
+
+def get_extension_cache(sorting_analyzer) -> Optional[ExtensionCache]:
+    """
+    The extension cache set in spykeparams['general']['cache_folder'], None if it isn't set
+    or if the analyzer isn't saved in a binary folder.
+    """
+    from . import spykeparams
+
+    folder = spykeparams['general']['cache_folder']
+    if not folder or sorting_analyzer.format != 'binary_folder':
+        return None
+
+    return ExtensionCache(folder, spykeparams['general']['cache_size_gb'])
+
+def preprocessed_fingerprint(recording, raw_recording) -> Optional[str]:
+    """
+    Fingerprint of a preprocessed recording: the raw recording it comes from, the preprocessing parameters
+    and its channels with their properties. Unlike recording_fingerprint, it doesn't depend on how the
+    preprocessed recording is read, e.g. from the binary files written at each run by the demultiplexer.
+
+    Parameters
+    ----------
+    recording : recording
+        The preprocessed recording.
+    raw_recording : recording
+        The raw recording it was preprocessed from.
+
+    Returns
+    -------
+    fingerprint : str
+        Hexadecimal digest, None if the raw recording can't be fingerprinted.
+    """
+    from . import spykeparams
+
+    raw = recording_fingerprint(raw_recording)
+    if raw is None:
+        return None
+
+    properties = {key: recording.get_property(key) for key in recording.get_property_keys()}
+
+    return _digest(raw,
+                   spykeparams['preprocessing'],
+                   spikeinterface.__version__,
+                   [str(channel_id) for channel_id in recording.channel_ids],
+                   properties,
+                   recording.get_dtype().str,
+                   [recording.get_num_samples(segment_index) for segment_index in range(recording.get_num_segments())])
+
+def _init_int16_worker(recording, file_paths, num_samples, scales):
+    return {
+        'recording': recording,
+        'stores': [np.memmap(file_path, dtype='int16', mode='r+', shape=(nb_samples, recording.get_num_channels()))
+                   for file_path, nb_samples in zip(file_paths, num_samples)],
+        'scales': scales
+    }
+
+def _int16_chunk(segment_index, start_frame, end_frame, worker_ctx):
+    traces = worker_ctx['recording'].get_traces(segment_index=segment_index, start_frame=start_frame, end_frame=end_frame)
+    traces = np.rint(traces.astype('float32') * worker_ctx['scales'])
+    worker_ctx['stores'][segment_index][start_frame:end_frame] = np.clip(traces, -32768, 32767)
+
+def _write_int16(recording, file_paths: List[str]) -> np.ndarray:
+    """
+    Write a recording as int16, each channel being scaled to the int16 range.
+
+    Returns
+    -------
+    scales : np.ndarray
+        Scale of each channel, the written traces being the recording's ones times it.
+    """
+    if recording.get_dtype() == np.dtype('int16'):
+        si.write_binary_recording(recording, file_paths=file_paths, dtype='int16')
+        return np.ones(recording.get_num_channels())
+
+    # The scale of each channel is set on random chunks, leaving room for larger values
+    chunks = si.get_random_data_chunks(recording, return_scaled=False)
+    peaks = np.abs(chunks).max(axis=0).astype('float64')
+    peaks[peaks == 0] = 1
+    scales = 32767 / (INT16_HEADROOM * peaks)
+
+    num_samples = [recording.get_num_samples(segment_index) for segment_index in range(recording.get_num_segments())]
+    for file_path, nb_samples in zip(file_paths, num_samples):
+        np.memmap(file_path, dtype='int16', mode='w+', shape=(nb_samples, recording.get_num_channels())).flush()
+
+    executor = ChunkRecordingExecutor(recording,
+                                      _int16_chunk,
+                                      _init_int16_worker,
+                                      (recording, file_paths, num_samples, scales.astype('float32')),
+                                      job_name='write int16 preprocessed recording',
+                                      **fix_job_kwargs({}))
+    executor.run()
+
+    return scales
+
+def materialize_recording(recording, raw_recording, folder: str):
+    """
+    Write a preprocessed recording once in the cache folder, as int16 with a scale per channel, 
+    and read it from there instead of preprocessing it again at each stage.
+    The written recording is reused by the later runs on the same raw recording and preprocessing parameters.
+
+    Parameters
+    ----------
+    recording : recording
+        The preprocessed recording.
+    raw_recording : recording
+        The raw recording it was preprocessed from.
+    folder : str
+        The cache folder.
+
+    Returns
+    -------
+    recording_cached : recording
+        The recording read from the cache, with the channels, properties and dtype of the preprocessed one.
+        The preprocessed recording itself if it can't be cached.
+    """
+    key = preprocessed_fingerprint(recording, raw_recording)
+    if key is None:
+        print("The raw recording can't be fingerprinted, the preprocessed recording isn't cached")
+        return recording
+
+    entry = os.path.join(folder, key)
+    file_paths = [os.path.join(entry, f'traces_seg{segment_index}.raw') for segment_index in range(recording.get_num_segments())]
+
+    if os.path.isdir(entry):
+        print(f"Reading the preprocessed recording from the cache: {entry}")
+        with open(os.path.join(entry, ENTRY_FILE), 'r') as f:
+            info = json.load(f)
+    else:
+        # Written under a temporary name first, so that an interrupted run never leaves a partial entry
+        tmp_entry = f'{entry}.tmp{os.getpid()}'
+        os.makedirs(tmp_entry, exist_ok=True)
+        scales = _write_int16(recording, [os.path.join(tmp_entry, os.path.basename(file_path)) for file_path in file_paths])
+
+        info = {'scales': scales.tolist(), 'dtype': recording.get_dtype().str}
+        with open(os.path.join(tmp_entry, ENTRY_FILE), 'w') as f:
+            json.dump(info, f)
+        try:
+            os.rename(tmp_entry, entry)
+        except OSError: # Written meanwhile by another run
+            shutil.rmtree(tmp_entry)
+        print(f"Preprocessed recording written to the cache: {entry}")
+
+    recording_cached = si.read_binary(file_paths,
+                                      recording.get_sampling_frequency(),
+                                      'int16',
+                                      recording.get_num_channels(),
+                                      channel_ids=recording.channel_ids)
+    recording.copy_metadata(recording_cached)
+
+    scales = np.asarray(info['scales'])
+    if np.dtype(info['dtype']) != np.dtype('int16'):
+        recording_cached = spre.scale(recording_cached, gain=1 / scales, dtype=info['dtype'])
+
+    return recording_cached
+
+def sorting_key(recording, raw_recording, sorter_name: str, params: dict) -> Optional[str]:
+    """
+    Key of the sorting of a preprocessed recording: its fingerprint, see preprocessed_fingerprint,
+    the sorter, its resolved parameters and the time shards the recording is sorted in. The parameters
+    planned from the resources free at run time, e.g. the batch size, are left out of them by the caller.
+
+    Returns
+    -------
+    key : str
+        Hexadecimal digest, None if the raw recording can't be fingerprinted.
+    """
+    from . import spykeparams
+
+    preprocessed = preprocessed_fingerprint(recording, raw_recording)
+    if preprocessed is None:
+        return None
+
+    shards = [spykeparams['spikesorting']['n_shards'], spykeparams['spikesorting']['shard_overlap_s']]
+    if shards[0] <= 1:
+        shards = None
+
+    return _digest(preprocessed, sorter_name, params, shards)
+
+
+class SortingCache:
+    """
+    Registry of the sorter outputs of the previous runs on a session, so that rerunning after a failure
+    of the curation or the exports loads the sorting instead of sorting again.
+
+    Each entry is the output folder of a sorting, keyed by sorting_key. The outputs stay in the folders
+    of the runs that sorted them, an entry whose folder was deleted or can't be read being dropped.
+    """
+
+    def __init__(self, file: str):
+        self.file = file
+        self.entries = {}
+
+        if os.path.exists(file):
+            with open(file, 'r') as f:
+                self.entries = json.load(f)
+
+    def load(self, key: Optional[str]) -> Optional[si.BaseSorting]:
+        """
+        The cached sorting of the key, through the sorter's extractor, None if there is none.
+        """
+        entry = self.entries.get(key) if key else None
+        if entry is None:
+            return None
+
+        try:
+            if entry['stitched']:
+                sorting = si.load(entry['folder'])
+            else:
+                try:
+                    sorting = sorter_dict[entry['sorter']]['extractor'](os.path.join(entry['folder'], 'sorter_output'))
+                except Exception: # Sorters whose extractor doesn't read their output folder
+                    sorting = ss.read_sorter_folder(entry['folder'], register_recording=False)
+        except Exception as error:
+            print(f"The cached sorting {entry['folder']} can't be read, it is sorted again: {error!r}")
+            self.entries.pop(key)
+            self.save()
+            return None
+
+        print(f"Sorting loaded from the cache: {entry['folder']}")
+        return sorting
+
+    def store(self, key: Optional[str], folder: str, sorter_name: str, stitched: bool = False,
+              overrides: Optional[dict] = None) -> None:
+        # The planned overrides, e.g. the batch size, are recorded with the entry but aren't part of its key
+        if key is None:
+            return
+        self.entries[key] = {'folder': os.path.abspath(folder), 'sorter': sorter_name, 'stitched': stitched,
+                             'overrides': overrides, 'created': time.time()}
+        self.save()
+
+    def save(self) -> None:
+        # Replaced in one step, the registry is never left half written
+        tmp_file = f'{self.file}.tmp{os.getpid()}'
+        with open(tmp_file, 'w') as f:
+            json.dump(self.entries, f, indent=4)
+        os.replace(tmp_file, self.file)
+
+def get_sorting_cache(paths) -> Optional[SortingCache]:
+    """
+    The sorting cache of the session, None if spykeparams['general']['sorting_cache'] isn't set.
+    """
+    from . import spykeparams
+
+    if not spykeparams['general']['sorting_cache']:
+        return None
+
+    return SortingCache(paths['sorting_cache'])
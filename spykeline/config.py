@@ -16,7 +16,15 @@ default_parameters = {
         "do_spikesort": True,
         "do_curation": False,
         "export_to_phy": False,
-        "export_to_klusters": False
+        "export_to_klusters": False,
+        "phy_binary": "copy",
+        "dat_files": None,
+        "cache_folder": None,
+        "cache_size_gb": 50,
+        "preprocessed_cache": False,
+        "preprocessed_cache_folder": None,
+        "sorting_cache": False,
+        "job_planner": True
     },
     "preprocessing": {
         "filter": {
@@ -26,21 +34,36 @@ default_parameters = {
         },
         "common_reference": {
             "method": "median"
-        }
+        },
+        "demultiplex": None,
+        "fused": False
     },
     "spikesorting": {
         "folder": None, 
         "execution_mode": "Local",
         "sorter": "kilosort4",
         "pipeline": "by_probe",  # or 'all', default is 'by_probe'
+        "extremum_spikes": 100,
+        "parallel_probes": 1,
+        "n_cores": None,
+        "ram_gb": None,
+        "n_shards": 1,
+        "shard_overlap_s": 60,
+        "parallel_shards": 0
     },
     "curation": {
         "recursive": True,
+        "max_depth": 10,
         "remove_noise_units": False, 
         "amplitude_threshold": 5000,
         "bin_size": 0.02,
         "distribution_threshold": 0.001,
-        "correlation_threshold": 0.8
+        "correlation_threshold": 0.8,
+        "chunk_size": 10000,
+        "n_workers": 1,
+        "cache_correlations": True,
+        "sample_size": None,
+        "report_agreement": False
     }
 }
 
@@ -51,7 +74,15 @@ parameters_description = {
         "plot_probe": "Plot the probe layout. Default is False.",
         "export_to_phy": "Export the sorted spikes to phy format. Default is True.",
         "export_to_klusters": "Export the sorted spikes to klusters format. Default is False.",
-        "do_curation": "To include the curation step after spikesorting. Recommended, Spykeline has been developed for this step. Default is True."
+        "dat_files": "Session recorded in several .dat files: either a glob pattern (e.g. 'amplifier_*.dat'), the files being sorted by name, or the list of the files in their order. Relative paths are relative to the input folder. They are read as a single recording, without concatenating them on disk. None uses amplifier.dat or <session>.dat. Default is None.",
+        "phy_binary": "'copy' writes the preprocessed recording in each phy folder. 'shared' writes the preprocessed recording of all the probes once in the Preprocessing folder, each phy folder pointing to its channels in it. The preprocessed binaries written by this run, with save_dat or the 'preprocessed' demultiplexing, are used instead when there is one for the whole recording, or one for each probe in the 'by_probe' pipeline. Default is 'copy'.",
+        "do_curation": "To include the curation step after spikesorting. Recommended, Spykeline has been developed for this step. Default is True.",
+        "cache_folder": "Folder of the analyzer extensions cache, shared by all the sessions. Rerunning with the same recording, preprocessing, sorting and extension parameters restores the extensions (waveforms, templates, ...) instead of computing them. None disables the cache. Default is None.",
+        "cache_size_gb": "Maximum size of the extensions cache in GB, the least recently used extensions being deleted beyond it. Default is 50.",
+        "preprocessed_cache": "Write the preprocessed recording once, as int16 with a scale per channel, and read it from there in the sorting, the analyzers and the exports instead of filtering and referencing the raw recording again. It is reused by the later runs with the same raw recording and preprocessing parameters. Default is False.",
+        "preprocessed_cache_folder": "Folder of the preprocessed recordings cache. None uses Preprocessed_cache in the input folder. Default is None.",
+        "sorting_cache": "Record the sorter outputs in Sorting_cache.json, in the input folder. A later run with the same raw recording, preprocessing, sorter and sorter parameters loads the sorting from the output folder of the run that sorted it instead of sorting again, e.g. after a failure of the curation or the exports. Default is False.",
+        "job_planner": "Plan the chunk size, the number of workers and the multiprocessing start method of each stage, and the sorter's sampling rate and batch size, from the cores, memory and disk of the machine and the channels, sampling rate and duration of the recording. The plan is saved in metadata.json. If False, the job kwargs set in config.py are used for every stage. Default is True."
     },
     "preprocessing": {
         "filter": {
@@ -61,17 +92,32 @@ parameters_description = {
         },
         "common_reference": {
             "method": "Method to use for the common reference. Default is median."
-        }
+        },
+        "demultiplex": "Write each probe of the recording to its own binary file in a single pass, for the 'by_probe' pipeline. 'raw' writes the raw channels, the filter being applied on the probe's file, 'preprocessed' writes the filtered and referenced channels of all the probes in the same pass. Default is None, the probes are read from the interleaved recording.",
+        "fused": "Compute the filter, the common reference and the whitening in a single pass per chunk, with numba if installed, instead of chaining spikeinterface's preprocessors. Default is False."
     },
     "spikesorting": {
-        "sorter": "Sorter to use for the spikesorting. Default is kilosort2_5."
+        "sorter": "Sorter to use for the spikesorting. Default is kilosort2_5.",
+        "extremum_spikes": "Number of spikes per unit averaged to find its extremum channel, which defines its shank. Default is 100.",
+        "parallel_probes": "Maximum number of probes sorted at once in the 'by_probe' pipeline, each in its own process. Sorters running on the GPU are always run one probe after another. Default is 1.",
+        "n_cores": "CPU cores shared by the probes sorted at once, each sorter job getting an equal part. None uses all the cores. Default is None.",
+        "ram_gb": "RAM in GB shared by the probes sorted at once. A probe is only launched if its traces, as float32, fit in what the running probes leave. None uses the machine's memory. Default is None.",
+        "n_shards": "Number of time shards a recording is cut into, sorted as independent jobs and stitched back into one sorting by matching the units of neighbouring shards on the window they share. It bounds the memory of a sorter run on very long recordings. 1 sorts the whole recording at once. Default is 1.",
+        "shard_overlap_s": "Duration in seconds shared by two neighbouring shards, where their units are matched. Default is 60.",
+        "parallel_shards": "Maximum number of shards of a recording sorted at once, each in its own process, in both pipelines, within the 'n_cores' and 'ram_gb' budget. 0 sorts all the shards at once. Sorters running on the GPU are always run one shard after another. Default is 0."
     },
     "curation": {
         "amplitude_threshold": "Threshold on spike amplitude. Default is 5000.",
         "bin_size": "Bin size to create the distribution. Default is 0.02.",
         "distribution_threshold": "Proportion of spike used as a threshold to classify distributions. Default is 0.001.",
         "recursive": "Recursive curation. Default is True.",
-        "remove_noise_units": "Either to delete units identify as noise. Default is False."
+        "max_depth": "Maximum number of levels a mua is split into by the recursive curation. Default is 10.",
+        "remove_noise_units": "Either to delete units identify as noise. Default is False.",
+        "chunk_size": "Number of spikes correlated at once, bounds the memory used by the curation. Default is 10000.",
+        "n_workers": "Number of processes analyzing the units in parallel, 1 runs them one after another. Default is 1.",
+        "cache_correlations": "Save the spikes correlations with their template in Correlations_cache, in the input folder, so that rerunning the curation of the same sorting, e.g. with other thresholds, doesn't recompute them. Default is True.",
+        "sample_size": "Maximum number of spikes per unit whose waveforms are extracted and used to classify the unit, the thresholds found being then applied to all its spikes. None uses every spike. Default is None.",
+        "report_agreement": "When sampling, also curate the sampled units on all their spikes and save the agreement of both in Sampling_agreement.json, to choose the sample size. Default is False."
     }
 }
 
@@ -113,6 +159,7 @@ else:
     op = np
 
 ### SETTING JOBS KWARGS DEPENDING ON CPU ###
+# Defaults until the jobs are planned for the recording, see planner.py
 
 si.set_global_job_kwargs(n_jobs=0.75,
                          chunk_size=20000,
@@ -1,4 +1,4 @@
-from .curate import run_curation, apply_curation, analyze_channel, analyze_units
-from .unit import Unit
-from .functions import split_unit, spikes_pearson, split_unit
+from .curate import run_curation, apply_curation, analyze_channel, analyze_unit, analyze_units
+from .unit import Unit, save_units, load_units
+from .functions import split_unit, spikes_pearson, pearson_matrix
 from .classifier import clean_units, find_noise_units, identify
\ No newline at end of file
@@ -0,0 +1,113 @@
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+
+from typing import Dict, Optional
+
+from ..tools import loader
+
+
+def correlation_fingerprint(sorting_analyzer) -> str:
+    """
+    Fingerprint of everything the spike to template correlations depend on:
+    the spikes, the waveforms selection and parameters, the sparsity and the templates.
+
+    Parameters
+    ----------
+    sorting_analyzer : sorting_analyzer
+        A spikeinterface's object. Containing information about the sorting.
+
+    Returns
+    -------
+    fingerprint : str
+        Hexadecimal digest.
+    """
+    fingerprint = hashlib.sha1()
+
+    spike_vector = sorting_analyzer.sorting.to_spike_vector()
+    fingerprint.update(np.ascontiguousarray(spike_vector['sample_index']).tobytes())
+    fingerprint.update(np.ascontiguousarray(spike_vector['unit_index']).tobytes())
+    fingerprint.update(np.ascontiguousarray(loader(sorting_analyzer, 'random_spikes').get_data()).tobytes())
+    fingerprint.update(np.ascontiguousarray(sorting_analyzer.sparsity.mask).tobytes())
+    fingerprint.update(np.ascontiguousarray(loader(sorting_analyzer, 'templates').get_data()).tobytes())
+    fingerprint.update(json.dumps(loader(sorting_analyzer, 'waveforms').params, sort_keys=True, default=str).encode())
+
+    return fingerprint.hexdigest()
+
+
+def subset_key(channel: int, ids: np.ndarray, median: bool) -> str:
+    """
+    Key of the correlations of a channel's spikes subset.
+
+    Parameters
+    ----------
+    channel : int
+        Index of the channel among the unit's sparse channels.
+    ids : array
+        Ids of the spikes the correlations are computed on.
+    median : bool
+        True when the template is the median of the subset, False when it is the unit's template.
+
+    Returns
+    -------
+    key : str
+    """
+    digest = hashlib.sha1(np.ascontiguousarray(ids, dtype=np.int64).tobytes()).hexdigest()[:20]
+
+    return f"{channel}_{'m' if median else 't'}_{digest}"
+
+
+class CorrelationCache:
+    """
+    On-disk cache of the spikes to template pearson correlations computed by identify().
+
+    The correlations don't depend on the curation thresholds, so they are stored, one .npz per unit,
+    and only the histogram and classification steps are redone when the curation parameters change.
+    The whole cache is dropped as soon as the analyzer's fingerprint changes.
+    """
+
+    def __init__(self, folder: str, fingerprint: str):
+        self.folder = folder
+        self.fingerprint = fingerprint
+
+        fingerprint_file = os.path.join(folder, 'fingerprint.json')
+        if os.path.exists(fingerprint_file):
+            with open(fingerprint_file, 'r') as f:
+                previous = json.load(f)['fingerprint']
+            if previous != fingerprint:
+                print("The sorting changed since the correlations were cached, clearing the cache...")
+                shutil.rmtree(folder)
+
+        os.makedirs(folder, exist_ok=True)
+        with open(fingerprint_file, 'w') as f:
+            json.dump({'fingerprint': fingerprint}, f)
+
+    def _unit_file(self, u_id) -> str:
+        return os.path.join(self.folder, f'unit_{u_id}.npz')
+
+    def load(self, u_id) -> Dict[str, np.ndarray]:
+        """
+        Load the cached correlations of a unit, empty dict if there are none.
+        """
+        unit_file = self._unit_file(u_id)
+        if not os.path.exists(unit_file):
+            return {}
+
+        with np.load(unit_file) as data:
+            return {key: data[key] for key in data.files}
+
+    def save(self, u_id, entries: Optional[Dict[str, np.ndarray]]) -> None:
+        """
+        Save the correlations of a unit, written to a temporary file first so that
+        an interrupted run never leaves a corrupted cache behind.
+        """
+        if not entries:
+            return
+
+        unit_file = self._unit_file(u_id)
+        tmp_file = unit_file[:-len('.npz')] + '.tmp.npz'
+        np.savez(tmp_file, **entries)
+        os.replace(tmp_file, unit_file)
@@ -1,10 +1,13 @@
 import math
 
+import numpy as np
+
 from scipy.signal import find_peaks
 
 from ..config import op
 from ..tools import loader
-from .functions import spikes_pearson, find_last_unique_one
+from .functions import spikes_pearson, median_template, normalized_template, find_last_unique_one, _to_numpy
+from .cache import subset_key
 
 
 def classify_obvious_units(sorting_analyzer, metrics):
@@ -29,17 +32,18 @@ def classify_obvious_units(sorting_analyzer, metrics):
     required_metrics = ['num_spikes', 'presence_ratio', 'firing_rate', 'amplitude_cutoff', 'isi_violations_count']
     assert all(metric in metrics.keys() for metric in required_metrics)
     
-    labels = op.zeros(len(sorting_analyzer.unit_ids))
+    # Object array, so that labelized units hold their label and the others stay at 0
+    labels = np.zeros(len(sorting_analyzer.unit_ids), dtype=object)
 
     # Some units have no noise in the refractory period, meaning there is no further need to clean them
     cleans = [True if v == 0 else False for v in metrics['rp_violations']]
-    labels = op.where(cleans, 'clean', labels)
+    labels = np.where(cleans, 'clean', labels)
 
     # Some units have a nb of spike that doesn't allow us to find their metrics, 
     # therefore, these units will stay as they are, be marked as 'raw', and then 
     # they will be identified or merged (most likely) on Phy.
     raws = [v < 3000 and not cleans[i] for i, v in enumerate(metrics['num_spikes'])]
-    labels = op.where(raws, 'raw', labels)
+    labels = np.where(raws, 'raw', labels)
     
     ## Noise units
     noises = find_noise_units(metrics)
@@ -160,27 +164,192 @@ def find_noise_units(metrics):
 
     return noise_units
 
-def identify(channel, spikes, template=None, table=None, split=None):
+def _classify_level(hist, threshold):
+    """
+    Classify one level of the splitting from the distribution of the spikes' pearson correlation.
+
+    Parameters
+    ----------
+    hist : Array
+        Distribution of the spikes' pearson correlation with the template.
+    threshold : float
+        Number of spikes under which a bin of the distribution is considered empty.
+
+    Returns
+    -------
+    label : str
+        Label of the level.
+    gap : int or None
+        Last empty bin before the main bump, the spikes below it aren't part of the unit.
+        None for noise and raw distributions.
+    lim : int or None
+        Threshold on the distribution, None if the distribution couldn't be classified.
+    last_var : int or None
+        Last variation of the distribution.
+    """
+    # Identification of bad channels
+    if hist[-1] == 0:
+        return 'noise', None, None, None
+
+    gap = len(hist) - 2
+    while hist[gap] != 0:
+        if gap == 0:
+            return 'raw', None, None, None
+        gap -= 1
+
+    # Classification based on distribution
+    deriv = np.diff(hist)
+    try:
+        last_var = find_last_unique_one(np.sign(deriv)) + 1
+
+        under_th = len(hist) - 2
+        while hist[under_th] > threshold:
+            under_th -= 1
+
+        label, lim = classify(hist, under_th, last_var, deriv)
+    except (IndexError, TypeError, ValueError):
+        return 'raw', gap, None, None
+
+    return label, gap, lim, last_var
+
+def _level_correlations(channel, spikes, ids, template, cache, chunk_size, record=False):
+    """
+    Pearson correlation of the spikes in ids with the template, or with their median if template is None.
+    Read from and stored to the cache when one is given.
+    The template is also returned, only computed from a cached level when it has to be recorded.
+    """
+    key = subset_key(channel.id, ids, median=template is None)
+    cached = cache is not None and key in cache
+
+    if template is None and (record or not cached):
+        template = median_template(spikes, ids)
+
+    if cached:
+        correlations = cache[key]
+    else:
+        correlations, _ = spikes_pearson(spikes, template, channel.center, ids=ids, chunk_size=chunk_size)
+        if cache is not None:
+            cache[key] = correlations
+
+    return correlations, template
+
+def _apply_level(level, ids, correlations):
+    """
+    Apply the decisions taken at one level of the splitting to spikes, from their correlation with the level's template.
+
+    Parameters
+    ----------
+    level : dict
+        Decisions of the level, see identify().
+    ids : Array
+        Ids of the spikes reaching this level.
+    correlations : Array
+        Pearson correlation of these spikes with the level's template.
+
+    Returns
+    -------
+    remove : list
+        Arrays of spikes ids to remove.
+    group : Array or None
+        Spikes ids split out at this level, None if the splitting stops here.
+    ids : Array or None
+        Ids of the spikes reaching the next level.
+    """
+    kept = correlations >= level['gap']
+    remove = [ids[~kept]]
+    group, next_ids = None, None
+
+    if level['action'] == 'clean':
+        remove.append(ids[correlations < level['lim']])
+    elif level['action'] == 'remove':
+        remove.append(ids)
+    elif level['action'] == 'split':
+        group = ids[(correlations < level['split']) & kept]
+        next_ids = ids[(correlations < level['lim']) & kept]
+
+    return remove, group, next_ids
+
+def project_levels(levels, ids, correlate):
+    """
+    Replay the levels recorded by identify() on other spikes, without classifying them again.
+
+    Parameters
+    ----------
+    levels : list
+        Levels recorded by identify().
+    ids : Array
+        Ids of the spikes to project.
+    correlate : callable
+        correlate(level, ids) returns the pearson correlation of the spikes with the level's template.
+
+    Returns
+    -------
+    remove : list
+        Arrays of spikes ids to remove.
+    split : list
+        Spikes ids split out, one array per level that split spikes out.
+    """
+    remove, split = [], []
+
+    for level in levels:
+        if len(ids) == 0:
+            break
+
+        removed, group, ids = _apply_level(level, ids, correlate(level, ids))
+        remove.extend(removed)
+        if group is None:
+            break
+        split.append(group)
+
+    return remove, split
+
+def gather_levels(label, remove, split):
+    """
+    Gather the spikes ids of all the levels into the format of Channel.remove and Channel.split.
+    """
+    from .. import spykeparams
+
+    remove = np.unique(np.concatenate(remove)) if remove else np.empty(0, dtype=np.int64)
+
+    if label != 'mua':
+        split = np.empty(0, dtype=np.int64)
+    elif not spykeparams['curation']['recursive']:
+        split = split[0]
+
+    return remove, split
+
+def identify(channel, spikes, template=None, ids=None, cache=None, scale=1., levels=None):
     """
     Clean and classify the unit.
-    This is done in 3 steps, that mainly relies on the distribution of the spikes' pearson correlation with the unit template:
+    This mainly relies on the distribution of the spikes' pearson correlation with the unit template:
         - Classify :
             Based on the shape of the pearson distribution
         - Identify :
             Delete or split based on the distribution
 
+    A mua is split level by level: the spikes below the distribution's last variation are split out,
+    then classified again against their own median template, until they form a single unit,
+    until they are too few to be classified (then removed), or until spykeparams['curation']['max_depth'] is reached.
+    Each level only works on the ids of its spikes, the spikes themselves are never copied.
+
     Parameters
     ----------
     channel : Channel
         Channel object
     spikes : Array
-        Shape [n_samples].
+        Spikes of the channel, shape [n_spikes, n_samples].
     template : Array, optional
-        Template of the unit on its highest amplitude channel. The default is None.
-    table : list, optional
-        In case of recursive cleaning, stores the spikes to be removed, organized by group of new cluster. The default is None.
-    split : list, optional
-        List of spikes to split out, again organized by group in case of recursive cleaning. The default is None.
+        Template of the unit on the channel. The default is None, the median of the spikes is used.
+    ids : Array, optional
+        Ids of the spikes to analyze, among the channel's spikes. The default is None, all the spikes.
+    cache : dict, optional
+        Cached correlations of the unit, see CorrelationCache. Filled with the computed correlations. The default is None.
+    scale : float, optional
+        Number of spikes of the unit each given spike stands for, above 1 when the spikes are a sample of the unit. 
+        The default is 1.
+    levels : list, optional
+        If given, filled with the decisions taken at each level (thresholds, normalized template and its spike area),
+        so that they can be applied to other spikes with project_levels(). The default is None.
 
     Returns
     -------
@@ -188,77 +357,69 @@ def identify(channel, spikes, template=None, table=None, split=None):
         Unit's label.
     lim: int 
         threshold on correlation distribution.
-    remove : list
+    remove : Array
         Spikes ids to remove from the unit.
-    split : list
+    split : Array or list
         Spikes ids to keep in a separated unit, empty except for mua.
+        For the recursive curation, one array of ids per level.
     """
     from .. import spykeparams
 
-    if table is None:
-        table = []
-    if split is None:
-        split = []
+    params = spykeparams['curation']
 
-    remove = []
-    threshold = spykeparams['curation']['distib_th'] * spikes.shape[0]
-    if template is None:
-        template = op.median(spikes, axis = 0)
+    ids = np.arange(spikes.shape[0]) if ids is None else np.asarray(ids)
+    bins = np.arange(-1, 1 + params['bin_size'], params['bin_size'])
 
-    # Step 1: Getting distribution based on pearson correlation
-    distrib = spikes_pearson(spikes, template, channel.center)
-    hist, bin_edges = op.histogram([x[1] for x in distrib], op.arange(-1, 1 + spykeparams['curation']['bin_size'], spykeparams['curation']['bin_size']))
-    deriv = op.diff(hist)
+    label, lim = None, None
+    remove, split = [], []
 
-    # Step 2: Identification of bad channels
-    if hist[-1] == 0:
-        return 'noise', remove, split
+    for depth in range(params['max_depth']):
+        if len(ids) == 0:
+            break
 
-    j = len(hist) - 2
-    while hist[j] != 0:
-        if j == 0:
-            return 'raw', remove, split
-        j -= 1
+        # Step 1: Getting distribution based on pearson correlation
+        correlations, level_template = _level_correlations(channel, spikes, ids, template if depth == 0 else None, 
+                                                           cache, params['chunk_size'], record=levels is not None)
+        hist, bin_edges = np.histogram(correlations, bins)
 
-    # Step 3: Cleaning based on distribution
-    for i, v in distrib:
-        if v < bin_edges[j + 1]:
-            remove.append(i)
+        # Step 2: Classification based on distribution
+        level_label, gap, level_lim, last_var = _classify_level(hist, params['distribution_threshold'] * len(ids))
+        if depth == 0:
+            label, lim = level_label, level_lim
 
-    # Step 4: Classification based on distribution
-    last_var = find_last_unique_one(op.sign(deriv)) + 1
+        if gap is None:
+            break
 
-    under_th = len(hist) - 2
-    try:
-        while hist[under_th] > threshold:
-            under_th -= 1
-
-        label, lim = classify(hist, under_th, last_var, deriv)
-    except:
-        return 'raw', remove, split
-
-    # Step 5: Identification of the spikes group to remove
-    if label == 'mua':  # recursive code
-        mask = [v < bin_edges[lim] and i not in remove for i, v in distrib]
-        if spykeparams['curation']['recursive']:
-            if table:
-                if len(mask) <= 3000:
-                    table.append([i for i, v in distrib])
-                    remove = table
-                    return label, remove, split
-                table.append(remove)
-                split.append([i for i, v in distrib if v < bin_edges[last_var] and i not in remove])
-            else:
-                split = [[i for i, v in distrib if v < bin_edges[last_var] and i not in remove]]
-                table = [remove]
-
-            identify(channel, spikes[mask], template=None, table=table, split=split)
+        # Step 3: Cleaning and identification of the spikes group to remove or split out
+        if level_lim is None:
+            action = 'raw'
+        elif level_label != 'mua':
+            action = 'clean'
+        elif depth > 0 and len(ids) * scale <= 3000:
+            action = 'remove'
         else:
-            split = [i for i, v in distrib if v < bin_edges[last_var] and i not in remove]
-    else:
-        remove.extend([i for i, v in distrib if v < bin_edges[lim]])
-        if split:
-            table.append(remove)
-            remove = table
+            action = 'split'
+
+        level = {'action': action,
+                 'gap': bin_edges[gap + 1],
+                 'lim': None if level_lim is None else bin_edges[level_lim],
+                 'split': None if last_var is None else bin_edges[last_var]}
+
+        if levels is not None:
+            spike_area, normalized = normalized_template(level_template, channel.center)
+            level['area'] = (spike_area.start, spike_area.stop)
+            level['template'] = _to_numpy(normalized)[0]
+            levels.append(level)
+
+        removed, group, ids = _apply_level(level, ids, correlations)
+        remove.extend(removed)
+        if group is None:
+            break
+        split.append(group)
+
+        if not params['recursive']:
+            break
+
+    remove, split = gather_levels(label, remove, split)
 
-    return label, lim, remove, split
\ No newline at end of file
+    return label, lim, remove, split
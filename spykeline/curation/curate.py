@@ -1,95 +1,185 @@
 import os
-import pickle
 import shutil
+import multiprocessing
 
+import numpy as np
 import spikeinterface.core as si
 import spikeinterface.curation as sc
 
-from collections import Counter, defaultdict
-from typing import Dict, Any, Union, Tuple
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Any, Union, Tuple, Optional
 
 from ..config import op
-from ..tools import loader, exporter
+from ..tools import loader, load_extensions, derive_analyzer, derive_templates
 from .classifier import classify_obvious_units, identify
-from .unit import Unit, Channel
-from .functions import split_unit, spikes_pearson
+from .unit import Unit, Channel, save_units
+from .cache import CorrelationCache, correlation_fingerprint
+from .functions import split_unit, spikes_peak, template_matrix, reassign_spikes
+from .sampling import sampled_units, project_units, sampling_agreement
 
 def analyze_channel(id: int, 
-                    templates,
+                    template,
                     unit: Unit, 
-                    spikes: op.ndarray) -> None: # type: ignore
+                    spikes: op.ndarray, # type: ignore
+                    cache: Optional[Dict[str, np.ndarray]] = None,
+                    scale: float = 1.) -> None:
     """
     Analyze a unit's channel. 
 
     Parameters
     ----------
     id : int
-        Id of the channel to analyze.
+        Index of the channel to analyze, among the unit's sparse channels.
+    template : Array
+        Template of the unit on its sparse channels, shape (n_samples, n_channels).
     unit : Unit
         Instance of the Unit class, unit that is being analyzed, channel by channel.
     spikes : Array
         Array with all the spikes from the unit.
-    sorting_analyzer : sorting_analyzer
-        A spikeinterface's object. Containing information about the sorting.
+    cache : dict, optional
+        Cached correlations of the unit, filled with the ones computed here.
+    scale : float, optional
+        Number of spikes of the unit each given spike stands for. Above 1 when the spikes are a sample of the unit,
+        the decisions of each level are then kept in channel.levels, to be projected on all the spikes.
 
     Returns
     -------
-    raw_units : dict
-        Dict of instances of Unit, with all the required information for the curation.
+    None
 
     """
     from .. import spykeparams
 
+    # View on the channel, the spikes are never copied, only their ids are
     raw_spikes = spikes[:, :, id]
-    mask = op.max(abs(raw_spikes), axis = 1) < spykeparams['curation']['amplitude_threshold'].astype(int)
-    clean_spikes = raw_spikes[mask, :]
+    peaks, amplitudes = spikes_peak(raw_spikes, spykeparams['curation']['chunk_size'])
+    mask = amplitudes < int(spykeparams['curation']['amplitude_threshold'])
 
-    raw_remove = op.where(~mask)[0]
-    original_ids = op.where(mask)[0]
+    raw_remove = np.flatnonzero(~mask)
+    original_ids = np.flatnonzero(mask)
 
-    _count = Counter(list(map(lambda x : op.argmax(abs(x)), clean_spikes)))
-    center = _count.most_common(1)[0][0]
+    center = int(np.bincount(peaks[mask] if mask.any() else peaks).argmax())
 
     channel = Channel(id, unit, center)
 
-    label, threshold, remove, split = identify(channel, clean_spikes, templates[unit.id, :, id])
-
-    if spykeparams['curation']['recursive']:
-        try: 
-            # Putting back the ids to their originals
-            if isinstance(remove[0], list): # If the unit is an mua
-                tmp_split = [split[0]]
-                for j in range(1, len(split)):
-                    tmp_split.append([tmp_split[j-1][i] for i in split[j]]) # expending with a list of ids, each id is from the main ch
-                split = tmp_split
-                
-                # then need to modify remove
-                tmp_remove = []
-                for j in range(1, len(remove)):
-                    tmp_remove.extend([split[j-1][i] for i in remove[j]])
-                remove = tmp_remove
-        except:
-            pass
-    
-    raw_remove += original_ids[remove]
-    raw_split = original_ids[split]
+    levels = [] if scale > 1 else None
+    label, threshold, remove, split = identify(channel, raw_spikes, template[:, id], ids=original_ids, cache=cache,
+                                               scale=scale, levels=levels)
 
     channel.labelize(label)
-    channel.add('remove', raw_remove)
-    channel.add('split', raw_split)
+    channel.add('remove', np.union1d(raw_remove, remove))
+    channel.add('split', split)
     channel.add('threshold', threshold)
+    channel.add('levels', levels)
             
 
-def analyze_units(sorting_analyzer: si.AnalyzerExtension, metadata: Dict[str, Any]) -> Dict[int, Unit]:
+def analyze_unit(u_id: int,
+                 spikes: op.ndarray, # type: ignore
+                 template,
+                 main_ch: int,
+                 group,
+                 probe_id: int,
+                 cache: Optional[CorrelationCache] = None,
+                 nb_spikes: Optional[int] = None) -> Unit:
+    """
+    Analyze a unit, channel by channel, and gather the results of its channels.
+
+    Parameters
+    ----------
+    u_id : int
+        Id of the unit.
+    spikes : Array
+        Waveforms of the unit, shape (n_spikes, n_samples, n_channels).
+    template : Array
+        Template of the unit on its sparse channels, shape (n_samples, n_channels).
+    main_ch : int
+        Index of the unit's highest amplitude channel, among its sparse channels.
+    group : list
+        Channel ids of the unit's shank.
+    probe_id : int
+        Id of the probe the unit was recorded on.
+    cache : CorrelationCache, optional
+        Cache of the correlations, read before and updated after the analysis.
+    nb_spikes : int, optional
+        Number of spikes of the unit, when the given spikes are only a sample of them.
+        The unit is then analyzed on the sample, see project_units() to extend it to all the spikes.
+
+    Returns
+    -------
+    unit : Unit
+        The analyzed unit.
+
+    """
+    unit = Unit(u_id, len(spikes), main_ch, group, probe_id)
+
+    entries = cache.load(u_id) if cache is not None else None
+    nb_entries = len(entries) if entries is not None else 0
+
+    scale = nb_spikes / len(spikes) if nb_spikes else 1.
+
+    for channel in range(len(group)):
+        analyze_channel(channel, template, unit, spikes, entries, scale)
+
+    unit.complete_from_channels()
+
+    if cache is not None and len(entries) > nb_entries:
+        cache.save(u_id, entries)
+
+    return unit
+
+def _analyze_unit_from_disk(u_id: int,
+                            waveforms_file: str,
+                            rows: np.ndarray,
+                            nb_channels: int,
+                            template,
+                            main_ch: int,
+                            group,
+                            probe_id: int,
+                            cache: Optional[CorrelationCache] = None,
+                            nb_spikes: Optional[int] = None) -> Unit:
+    """
+    Worker of the parallel analysis: reads the unit's waveforms from the analyzer's folder
+    through a memmap, so that only the unit's rows are loaded and nothing but indices is sent to the workers.
+
+    """
+    waveforms = np.load(waveforms_file, mmap_mode='r')
+    spikes = np.asarray(waveforms[rows, :, :nb_channels])
+
+    return analyze_unit(u_id, spikes, template, main_ch, group, probe_id, cache, nb_spikes)
+
+def _waveforms_rows(sorting_analyzer) -> Dict[int, np.ndarray]:
+    """
+    Rows of the waveforms extension data belonging to each unit, in the order used by 
+    get_waveforms_one_unit().
+
+    """
+    random_spikes = loader(sorting_analyzer, 'random_spikes').get_data()
+    some_spikes = sorting_analyzer.sorting.to_spike_vector()[random_spikes]
+
+    return {u_id: np.flatnonzero(some_spikes['unit_index'] == u_index) 
+            for u_index, u_id in enumerate(sorting_analyzer.unit_ids)}
+
+def analyze_units(sorting_analyzer: si.AnalyzerExtension, 
+                  metadata: Dict[str, Any],
+                  cache: Optional[CorrelationCache] = None) -> Dict[int, Unit]:
     """
     Analyze units, classify them, and identify spikes to remove.
 
+    Units are independent, so with spykeparams['curation']['n_workers'] > 1 they are analyzed 
+    in a process pool. Workers read the waveforms from the analyzer's binary folder with memmaps.
+
+    When the analyzer only holds a sample of each unit's spikes (spykeparams['curation']['sample_size']),
+    the units are analyzed on their sample, then the thresholds found are projected on all their spikes.
+
     Parameters
     ----------
     sorting_analyzer : sorting_analyzer
         A spikeinterface's object. Containing information about the sorting.
     metadata : dict
         Dict with channel map information.
+    cache : CorrelationCache, optional
+        Cache of the spike to template correlations, so that only the classification is redone
+        when the curation parameters change.
 
     Returns
     -------
@@ -97,14 +187,16 @@ def analyze_units(sorting_analyzer: si.AnalyzerExtension, metadata: Dict[str, An
         Dict of instances of Unit, with all the required information for the curation.
 
     """
+    from .. import spykeparams, set_spykeparams
+
     assert sorting_analyzer.is_sparse(), "The sorting analyzer provided to 'analyze_units()' must be sparsed."
 
     raw_units = defaultdict(Unit)
 
-    waveform = loader(sorting_analyzer, 'waveforms')
-    qms = loader(sorting_analyzer, 'quality_metrics')
-    tmp = loader(sorting_analyzer, "templates")
-    templates = tmp.get_data()
+    extensions = load_extensions(sorting_analyzer, ['waveforms', 'templates', 'quality_metrics'])
+    waveform = extensions['waveforms']
+    qms = extensions['quality_metrics']
+    templates = extensions['templates'].get_data()
 
     groups = sorting_analyzer.sparsity.unit_id_to_channel_ids
 
@@ -113,31 +205,56 @@ def analyze_units(sorting_analyzer: si.AnalyzerExtension, metadata: Dict[str, An
                                                   mode='extremum')
     
     labels = classify_obvious_units(sorting_analyzer, qms.get_data())
+    nb_spikes = sorting_analyzer.sorting.count_num_spikes_per_unit()
 
-    for u_id in range(len(sorting_analyzer.unit_ids)):
-        # Getting the channel index according to the shank, as the sorting is sparsed
-        for shank, channels in enumerate(groups[u_id]):
-            if max_amp_ch[u_id] in channels:
-                max_ch = channels.index(max_amp_ch[u_id]) # Getting the channel index in the shank
+    n_workers = spykeparams['curation']['n_workers']
+    parallel = n_workers > 1 and sorting_analyzer.format == 'binary_folder'
+    if parallel:
+        waveforms_file = os.path.join(sorting_analyzer.folder, 'extensions', 'waveforms', 'waveforms.npy')
+        rows = _waveforms_rows(sorting_analyzer)
 
-        spikes = waveform.get_waveforms_one_unit(u_id)
+    jobs = []
+    for u_index, u_id in enumerate(sorting_analyzer.unit_ids):
+        # Getting the channel index according to the shank, as the sorting is sparsed
+        group = list(groups[u_id])
+        max_ch = group.index(max_amp_ch[u_id])
+        channels = sorting_analyzer.channel_ids_to_indices(group)
+        template = templates[u_index][:, channels]
 
         probe_id = [probe_id for probe_id, probe in enumerate(metadata['Anatomical_groups']) if max_amp_ch[u_id] in probe][0]
 
-        if labels[u_id] != 0:
-            raw_units[u_id] = Unit(u_id, len(spikes), max_ch, groups[u_id], probe_id)
-            raw_units[u_id].labelize(labels[u_id])
+        if labels[u_index] != 0:
+            raw_units[u_id] = Unit(u_id, nb_spikes[u_id], max_ch, group, probe_id)
+            raw_units[u_id].labelize(labels[u_index])
             continue
-        
-        raw_units[u_id] = Unit(u_id, len(spikes), max_ch, groups[u_id], probe_id)
-
-        for channel in groups[u_id]:
-            analyze_channel(channel, templates, raw_units[u_id], spikes, sorting_analyzer)
 
-        raw_units[u_id].complete_from_channels()
+        if parallel:
+            jobs.append((u_id, waveforms_file, rows[u_id], len(group), template, max_ch, group, probe_id, cache, nb_spikes[u_id]))
+        else:
+            spikes = waveform.get_waveforms_one_unit(u_id)
+            raw_units[u_id] = analyze_unit(u_id, spikes, template, max_ch, group, probe_id, cache, nb_spikes[u_id])
+
+    if parallel and jobs:
+        print(f'Analyzing {len(jobs)} units with {n_workers} workers...')
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=set_spykeparams,
+                                 initargs=(spykeparams,)) as executor:
+            # map() yields in submission order, so the merge doesn't depend on which worker ends first
+            for unit in executor.map(_analyze_unit_from_disk, *zip(*jobs)):
+                raw_units[unit.id] = unit
+
+    # Same order as the sorting's units, whatever the mode
+    raw_units = defaultdict(Unit, {u_id: raw_units[u_id] for u_id in sorting_analyzer.unit_ids})
 
     assert len(raw_units) == len(sorting_analyzer.unit_ids)
 
+    # Units analyzed on a sample of their spikes are extended to all their spikes
+    sampled = sampled_units(raw_units)
+    if sampled:
+        print(f'Projecting the curation of {len(sampled)} sampled units on all their spikes...')
+        raw_units = project_units(sorting_analyzer, raw_units, sampled)
+
     print('All Units have been analyzed, saving ...')
 
     return raw_units
@@ -169,6 +286,8 @@ def apply_curation(data: Dict[str, Union[si.BaseSorting, si.SortingAnalyzer]],
         The updated dict of units within the new sorting.
 
     """
+    from .. import spykeparams
+
     print("Applying the curation...")
     final_units = units.copy()
     cs = sc.CurationSorting(parent_sorting = data['sorting'])
@@ -177,31 +296,61 @@ def apply_curation(data: Dict[str, Union[si.BaseSorting, si.SortingAnalyzer]],
     for u_id in list(units.keys()):
         final_units, cs = split_unit(int(u_id), final_units, cs)
 
-    # creating a dense analyzer of the curated sorting
-    dense_analyzer = si.create_sorting_analyzer(cs.sorting, 
-                                                data['sorting']._recording,
-                                                folder=os.path.join(folder['tmp'], 'Curated_dense'),
+    # Waveforms are only extracted for the trash units, on the channels of their shank,
+    # the templates of the other units are derived from the waveforms of the source analyzer
+    trash_ids = [u_id for u_id in cs.sorting.unit_ids if final_units[u_id].label == 'trash']
+    if len(trash_ids) == 0:
+        return cs.sorting, final_units
+
+    recording = data['sorting']._recording
+    trash_groups = [final_units[u_id].group for u_id in trash_ids]
+    trash_sparsity = si.ChannelSparsity.from_unit_id_to_channel_ids({u_id: final_units[u_id].group for u_id in trash_ids},
+                                                                    trash_ids,
+                                                                    recording.channel_ids)
+    trash_analyzer = si.create_sorting_analyzer(cs.sorting.select_units(trash_ids), 
+                                                recording,
+                                                folder=os.path.join(folder['tmp'], 'Trash_analyzer'),
                                                 format='binary_folder',
-                                                sparse=False)
+                                                sparsity=trash_sparsity)
+
+    candidates = [u_id for u_id in cs.sorting.unit_ids 
+                  if final_units[u_id].label != 'trash' and final_units[u_id].group in trash_groups]
+    templates = derive_templates(data['sorting_analyzer'], 
+                                 cs.sorting, 
+                                 {u_id: final_units[u_id].group for u_id in cs.sorting.unit_ids},
+                                 candidates,
+                                 chunk_size=spykeparams['curation']['chunk_size'])
     
     # Applying the curation on the trash units to get the final units
     print('Re-assigning spikes to their respective units...')
     sorting, final_units = assign_trash(cs,
-                                        dense_analyzer, 
+                                        trash_analyzer,
+                                        templates, 
                                         final_units)
     
     return sorting, final_units
 
 def assign_trash(cs: sc.CurationSorting,
-                 analyzer: si.AnalyzerExtension,
+                 analyzer: si.SortingAnalyzer,
+                 templates: Dict[int, np.ndarray],
                  units: Dict[int, Unit]) -> Tuple[si.BaseSorting, Dict[int, Unit]]:
     """
     Assign the spikes from the trash units to the units with the highest correlation above the threshold.
 
+    The correlation of a spike with a unit is the one of spikes_pearson, over the unit's spike area on its
+    main channel. For each shank group, the templates of the non-trash units are stacked once into a
+    template matrix, and all the trash spikes are correlated against it by chunks of
+    spykeparams['curation']['chunk_size'] spikes. Both the templates and the trash waveforms
+    are on the channels of the shank.
+
     Parameters
     ----------
-    sorting : sorting
-        A spikeinterface's object. The sorting to update.
+    cs : CurationSorting
+        A spikeinterface's object. The curation sorting to update.
+    analyzer : sorting_analyzer
+        A spikeinterface's object, analyzer of the trash units, sparse on their shank.
+    templates : dict
+        Template of each candidate unit on the channels of its shank, see derive_templates().
     units : dict
         Dict of instances of Unit, with all the required information for the curation.
 
@@ -217,11 +366,7 @@ def assign_trash(cs: sc.CurationSorting,
     from .. import spykeparams
 
     waveforms = loader(analyzer, 'waveforms')
-    tmp = loader(analyzer, "templates")
-    templates = tmp.get_data()
-    del tmp
 
-    assert len(units) == len(templates)
     # Selecting the units of interest
     groups = [units[u_id].group for u_id in units.keys()]
     processed_groups = []
@@ -235,69 +380,66 @@ def assign_trash(cs: sc.CurationSorting,
         group_units = [u_id for u_id in units.keys() if units[u_id].group == ch_group]
         # Finding all trash units of this shank
         trash_units = [unit for unit in group_units if units[unit].label == 'trash']
+        candidates = [unit for unit in group_units if units[unit].label != 'trash']
 
-        if len(trash_units) == 0:
+        if len(trash_units) == 0 or len(candidates) == 0:
             continue
 
-        merges = defaultdict(defaultdict(list))
-        nb_spikes = defaultdict(int)
-        
-        # Computing the correlation between the spikes of the trash units and the templates of the other units
+        # Templates of the other units of the group, on the channels of the shank in the analyzer's order,
+        # restricted to their spike area on their main channel
+        shank_channels = [channel for channel in analyzer.channel_ids if channel in units[candidates[0]].group]
+        main_channels = [shank_channels.index(units[unit].group[units[unit].main_ch]) for unit in candidates]
+        centers = [units[unit].center if units[unit].center is not None
+                   else int(np.argmax(np.abs(templates[unit][:, channel])))
+                   for unit, channel in zip(candidates, main_channels)]
+        group_templates, group_areas = template_matrix(np.stack([templates[unit] for unit in candidates]),
+                                                       main_channels,
+                                                       centers)
+
+        remaining_trash = []
         for trash_unit in trash_units:
             spikes = waveforms.get_waveforms_one_unit(trash_unit)
-            nb_spikes[trash_unit] = len(spikes)
-            for spike_id, spike in enumerate(spikes): # For each spike of the trash unit
-                correlations = defaultdict(list)
-                for unit in group_units: # Comparing with all the other units of the group
-                    if unit in trash_unit: # If the unit isn't trash
-                        continue
-                    else:
-                        correlations[unit] = spikes_pearson(spike, templates, units[unit].center)[1]
-                max_corr = max(correlations, key=correlations.get)
-                if correlations[max_corr] > spykeparams['curation']['correlation_threshold']:   
-                    merges[trash_unit][max_corr].append(spike_id)
-                else:
-                    continue
-                    
-            del correlations
 
-        # Splitting the trash units according to the correlations
-        for trash_unit in trash_units:
-            indices_list = op.zeros(nb_spikes[trash_unit])
-            id = 1
-            for unit, spikes_ls in merges[trash_unit].items():
-                if len(spikes_ls) > 0:
-                    for spike_id in spikes_ls:
-                        assert indices_list[spike_id] == 0, "A spike has been assigned to multiple units"
-                        indices_list[spike_id] = id
-                    id += 1
-            nb_new = int(op.max([op.max(v) for v in indices_list]))
-            childs = cs._get_unused_id(nb_new)
-            cs.split(trash_unit, indices_list)
+            # Computing the correlation between the spikes of the trash unit and the templates of the other units
+            labels, _ = reassign_spikes(spikes, 
+                                        group_templates,
+                                        group_areas,
+                                        spykeparams['curation']['correlation_threshold'],
+                                        chunk_size=spykeparams['curation']['chunk_size'])
+
+            if np.all(labels < 0):
+                remaining_trash.append(trash_unit)
+                continue
+
+            # Splitting the trash unit in one go: 0 stays trash, k + 1 goes to the k-th candidate
+            indices_list = labels + 1
+            values, counts = np.unique(indices_list, return_counts=True)
+            childs = cs._get_unused_id(len(values))
+            cs.split(trash_unit, [indices_list], new_unit_ids=childs)
 
             # Merging the splitted trash unit into their respective units with highest correlation above threshold
-            merge_id = 0
-            for unit, spikes_ls in merges[trash_unit].items():
-                if len(spikes_ls) > 0:
-                    cs.merge([unit, childs[merge_id]],
-                            new_unit_id=unit)
-                    merge_id += 1
-                units[unit].add('nb_spikes', units[unit].nb_spikes + len(spikes_ls))
-
-            # Handling the current trash unit
-            if indices_list.count(0) == 0:
-                cs.remove_unit(trash_unit)
-                del units[trash_unit]
-            else:
-                units[trash_unit].add('nb_spikes', indices_list.count(0))
+            for child, value, count in zip(childs, values, counts):
+                if value == 0:
+                    units[child] = units.pop(trash_unit)
+                    units[child].add('id', child)
+                    units[child].add('nb_spikes', int(count))
+                    remaining_trash.append(child)
+                else:
+                    unit = candidates[value - 1]
+                    cs.merge([unit, child], new_unit_id=unit)
+                    units[unit].add('nb_spikes', units[unit].nb_spikes + int(count))
 
-            for i, trash in enumerate(trash_units):
-                try:
-                    units[trash]
-                except:
-                    del trash_units[i]
+            if trash_unit in units:
+                del units[trash_unit]
 
-            cs.merge(trash_units, new_unit_id = min(trash_units))
+        # Gathering what is left of the trash units of the shank into a single one
+        if len(remaining_trash) > 1:
+            trash_id = min(remaining_trash)
+            cs.merge(remaining_trash, new_unit_id=trash_id)
+            units[trash_id].add('nb_spikes', sum(units[trash].nb_spikes for trash in remaining_trash))
+            for trash in remaining_trash:
+                if trash != trash_id:
+                    del units[trash]
     
     return cs.sorting, units
 
@@ -327,31 +469,41 @@ def run_curation(data: list, metadata: list, folder: str) -> Tuple[Dict[str, Any
     recording = sorting._recording
     sorting_analyzer = data['sorting_analyzer']
 
+    from .. import spykeparams
+
+    if spykeparams['curation']['cache_correlations']:
+        cache = CorrelationCache(folder['correlations'], correlation_fingerprint(sorting_analyzer))
+    else:
+        cache = None
+
     # cleaning step, removing obvious noise from units
-    raw_units = analyze_units(sorting_analyzer, metadata)
+    raw_units = analyze_units(sorting_analyzer, metadata, cache)
 
     os.makedirs(folder['metadata'], exist_ok = True)
-    with open(folder['units'], 'wb') as pickle_file:
-        pickle.dump(raw_units, pickle_file)
+    save_units(raw_units, folder['units'])
+
+    if spykeparams['curation']['report_agreement'] and sampled_units(raw_units):
+        sampling_agreement(sorting_analyzer, raw_units, sampled_units(raw_units), folder)
     
     f_sorting, final_units = apply_curation(data, raw_units, folder)
 
-    with open(folder['units_final'], 'wb') as pickle_file:
-        pickle.dump(final_units, pickle_file)
+    save_units(final_units, folder['units_final'])
 
-    # exporter needed to get the sparsity for each sorting
-    final_recording, final_sorting, sorting_analyzer = exporter(recording,
-                                                                f_sorting,
-                                                                folder,
-                                                                metadata,
-                                                                mode=1)
+    # The curated analyzer is derived from the source one, the curation only relabeled spikes
+    final_analyzer = derive_analyzer(sorting_analyzer,
+                                     f_sorting,
+                                     {u_id: final_units[u_id].group for u_id in f_sorting.unit_ids},
+                                     folder,
+                                     metadata,
+                                     chunk_size=spykeparams['curation']['chunk_size'])
+    final_sorting = final_analyzer.sorting
     
     if not final_sorting.has_recording():
-        final_sorting.register_recording(final_recording)
+        final_sorting.register_recording(recording)
     
     data = {
             'sorting' : final_sorting,
-            'sorting_analyzer' : sorting_analyzer
+            'sorting_analyzer' : final_analyzer
             }
 
     return data, final_units
\ No newline at end of file
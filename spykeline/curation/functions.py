@@ -1,9 +1,7 @@
+import numpy as np
 
-from scipy.stats import pearsonr
-from collections import defaultdict
 from typing import List, Tuple, Dict, Optional
 
-
 from ..config import op
 from ..curation.unit import Unit
 
@@ -93,38 +91,272 @@ def _derivate(data, dx: int = 1):
     return dy_dx
 
 
-def spikes_pearson(spikes, template, center: int) -> List[Tuple[int, float]]:
+def _to_numpy(data) -> np.ndarray:
+    '''
+    Bring an array of the `op` backend back to host memory.
+
+    Parameters
+    ----------
+    data : array-like
+        Array living either on the CPU (NumPy) or on the GPU (CuPy).
+
+    Returns
+    -------
+    np.ndarray
+        The same data as a NumPy array.
+    '''
+    if hasattr(op, 'asnumpy'):
+        return op.asnumpy(data)
+    return np.asarray(data)
+
+def _normalize_rows(data):
+    '''
+    Center each row and scale it to unit norm, so that a dot product between
+    two normalized rows is their Pearson correlation coefficient.
+
+    Parameters
+    ----------
+    data : array-like
+        Shape (n_rows, n_samples).
+
+    Returns
+    -------
+    array-like
+        The normalized rows, as float64. Flat rows are left at 0.
+    '''
+    data = op.asarray(data, dtype=op.float64)
+    data = data - data.mean(axis=1, keepdims=True)
+    norms = op.sqrt((data * data).sum(axis=1, keepdims=True))
+    norms[norms == 0] = 1
+
+    return data / norms
+
+def pearson_matrix(spikes, templates):
+    '''
+    Calculate the Pearson correlation between every spike and every template
+    in a single matrix product.
+
+    Parameters
+    ----------
+    spikes : array-like
+        Shape (n_spikes, n_samples).
+    templates : array-like
+        Shape (n_templates, n_samples).
+
+    Returns
+    -------
+    array-like
+        Shape (n_spikes, n_templates), on the `op` backend.
+    '''
+    return _normalize_rows(spikes) @ _normalize_rows(templates).T
+
+def normalized_template(template, center: int):
+    '''
+    Restrict a template to its spike area and normalize it, so that its dot product
+    with a normalized spike gives their Pearson correlation.
+
+    Parameters
+    ----------
+    template : array-like
+        The template data.
+    center : int
+        The center index.
+
+    Returns
+    -------
+    spike_area : slice
+        Samples of the spike area.
+    array-like
+        The normalized template, shape (1, n_area_samples), on the `op` backend.
+    '''
+    start, stop = _define_spike_area(_derivate(template), center)
+    spike_area = slice(start, stop + 1)
+
+    return spike_area, _normalize_rows(op.asarray(template)[None, spike_area])
+
+def spikes_pearson(spikes, template, center: int, ids=None, chunk_size: int = 10000) -> Tuple[np.ndarray, np.ndarray]:
     '''
     Calculate the Pearson correlation between spikes and a template.
 
+    The correlation is restricted to the spike area of the template, and is
+    computed by chunks of spikes, so that only chunk_size rows of the spike area
+    are copied at once.
+
     Parameters
     ----------
     spikes : array-like
-        The spike data.
+        The spike data, shape (n_spikes, n_samples).
     template : array-like
         The template data.
     center : int
         The center index.
+    ids : array-like, optional
+        Rows of the spikes to correlate, all of them if None.
+    chunk_size : int, optional
+        Number of spikes correlated at once. Default is 10000.
 
     Returns
     -------
-    List[Tuple[int, float]]
-        A list of tuples containing the spike index and its Pearson correlation coefficient.
+    correlations : np.ndarray
+        Pearson correlation coefficient of each spike with the template.
+        Spikes that are flat over the spike area get 0.
+    order : np.ndarray
+        Indices sorting the spikes by increasing correlation.
     '''
-    limits = _define_spike_area(_derivate(template), center)
-    spike_area = op.linspace(*limits, limits[1] - limits[0] + 1, dtype=int)
+    spike_area, template = normalized_template(template, center)
 
-    pears = defaultdict(float)
+    if ids is None:
+        ids = np.arange(len(spikes))
 
-    for i, spike in enumerate(spikes):
-        template_area = op.asnumpy(template[spike_area])
-        spike_area_data = op.asnumpy(spike[spike_area])
+    correlations = np.empty(len(ids))
+    for chunk_start in range(0, len(ids), chunk_size):
+        chunk = slice(chunk_start, chunk_start + chunk_size)
+        pears = _normalize_rows(op.asarray(spikes[ids[chunk], spike_area])) @ template.T
+        correlations[chunk] = _to_numpy(pears[:, 0])
 
-        pears[i], _ = pearsonr(template_area, spike_area_data)
+    order = np.argsort(correlations, kind='stable')
 
-    indexed_list = sorted(pears.items(), key=lambda x: x[1])
+    return correlations, order
 
-    return indexed_list
+def median_template(spikes, ids):
+    '''
+    Median of a subset of spikes. The rows of the subset are gathered in a single
+    pass, in increasing order so that memmapped spikes are read sequentially.
+
+    Parameters
+    ----------
+    spikes : array-like
+        The spike data, shape (n_spikes, n_samples).
+    ids : array-like
+        Rows of the spikes to use.
+
+    Returns
+    -------
+    array-like
+        The median template, shape (n_samples,).
+    '''
+    return op.median(op.asarray(spikes[np.sort(ids)]), axis=0).astype(op.float64)
+
+def spikes_peak(spikes, chunk_size: int = 10000) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Find the sample and the absolute amplitude of each spike's peak.
+
+    Parameters
+    ----------
+    spikes : array-like
+        The spike data, shape (n_spikes, n_samples).
+    chunk_size : int, optional
+        Number of spikes processed at once. Default is 10000.
+
+    Returns
+    -------
+    peaks : np.ndarray
+        Sample of the highest absolute value of each spike.
+    amplitudes : np.ndarray
+        Absolute value of each spike at its peak.
+    '''
+    nb_spikes = len(spikes)
+    peaks = np.empty(nb_spikes, dtype=np.int64)
+    amplitudes = np.empty(nb_spikes)
+
+    for start in range(0, nb_spikes, chunk_size):
+        chunk = slice(start, start + chunk_size)
+        data = abs(op.asarray(spikes[chunk]))
+        peaks[chunk] = _to_numpy(op.argmax(data, axis=1))
+        amplitudes[chunk] = _to_numpy(op.max(data, axis=1))
+
+    return peaks, amplitudes
+
+def template_matrix(templates, channels, centers):
+    '''
+    Build the template matrices of a group of units, to correlate spikes against all of them at once
+    as spikes_pearson does: over each unit's spike area, on its main channel.
+
+    Parameters
+    ----------
+    templates : array-like
+        Shape (n_units, n_samples, n_channels).
+    channels : array-like
+        Main channel of each unit, among the templates' channels.
+    centers : array-like
+        Center of each unit's spike area.
+
+    Returns
+    -------
+    templates : array-like
+        Shape (n_units, n_samples * n_channels), each unit's normalized template over its spike area
+        on its main channel, 0 elsewhere, on the `op` backend.
+    areas : array-like
+        Shape (n_units, n_samples * n_channels), 1 over each unit's spike area on its main channel, 0 elsewhere.
+    '''
+    templates = op.asarray(templates)
+    nb_units = templates.shape[0]
+
+    matrix = op.zeros(templates.shape, dtype=op.float64)
+    areas = op.zeros(templates.shape, dtype=op.float64)
+    for k, (channel, center) in enumerate(zip(channels, centers)):
+        spike_area, normalized = normalized_template(templates[k, :, channel], center)
+        matrix[k, spike_area, channel] = normalized[0]
+        areas[k, spike_area, channel] = 1
+
+    return matrix.reshape(nb_units, -1), areas.reshape(nb_units, -1)
+
+def reassign_spikes(spikes, templates, areas, threshold: float, chunk_size: int = 10000) -> Tuple[np.ndarray, np.ndarray]:
+    '''
+    Assign each spike to the template it correlates the most with, as long as
+    this correlation is above the threshold.
+
+    The correlation with each template is the one of spikes_pearson, restricted to the template's
+    spike area on its main channel. As the templates are centered over their area, it is the dot
+    product of the spike with the template divided by the norm of the centered spike over the area,
+    both computed for all the templates by matrix products. The spikes are processed by chunks, so
+    that the memory used by the step is bounded by chunk_size, whatever the number of spikes.
+
+    Parameters
+    ----------
+    spikes : array-like
+        Shape (n_spikes, n_samples, n_channels).
+    templates : array-like
+        Template matrix, as returned by template_matrix.
+    areas : array-like
+        Spike areas of the templates, as returned by template_matrix.
+    threshold : float
+        Minimum correlation for a spike to be assigned to a template.
+    chunk_size : int, optional
+        Number of spikes correlated at once. Default is 10000.
+
+    Returns
+    -------
+    labels : np.ndarray
+        Index of the assigned template for each spike, -1 if none.
+    correlations : np.ndarray
+        Highest correlation of each spike, 0 for a spike flat over every spike area.
+    '''
+    nb_spikes = len(spikes)
+    labels = np.full(nb_spikes, -1, dtype=np.int64)
+    correlations = np.zeros(nb_spikes)
+    lengths = areas.sum(axis=1)
+
+    for start in range(0, nb_spikes, chunk_size):
+        stop = min(start + chunk_size, nb_spikes)
+        chunk = op.asarray(spikes[start:stop], dtype=op.float64).reshape(stop - start, -1)
+
+        # Norm of each spike centered over each spike area
+        sums = chunk @ areas.T
+        norms = op.sqrt(op.maximum((chunk * chunk) @ areas.T - sums * sums / lengths, 0))
+        flat = norms == 0
+        norms[flat] = 1
+
+        pears = (chunk @ templates.T) / norms
+        pears[flat] = 0
+        best = op.argmax(pears, axis=1)
+        best_corr = pears[op.arange(stop - start), best]
+
+        best, best_corr = _to_numpy(best), _to_numpy(best_corr)
+        labels[start:stop] = np.where(best_corr > threshold, best, -1)
+        correlations[start:stop] = best_corr
+
+    return labels, correlations
 
 def find_last_unique_one(arr) -> Optional[int]:
     '''
@@ -151,7 +383,7 @@ def find_last_unique_one(arr) -> Optional[int]:
         
     return None
 
-def split_unit(u_id: int, units: Dict[int, Unit], cs) -> Dict[int, Unit]:
+def split_unit(u_id: int, units: Dict[int, Unit], cs) -> Tuple[Dict[int, Unit], object]:
     """
     Split a unit into multiple units based on its label.
 
@@ -168,84 +400,53 @@ def split_unit(u_id: int, units: Dict[int, Unit], cs) -> Dict[int, Unit]:
     -------
     Dict[int, Unit]
         The updated dictionary of Unit objects.
+    cs : spikeinterface curationsorting
+        The updated curationsorting object.
     """
     from .. import spykeparams
 
     if units[u_id].label in ['raw', 'clean']:
-        return units
+        return units, cs
     
     if units[u_id].label == 'noise':
         if spykeparams['curation']['remove_noise_units']:
             cs.remove_unit(u_id)
             del units[u_id]
-        return units
+        return units, cs
         
-    indices_list = units[u_id].get_indices_list()
+    unit = units[u_id]
 
-    if units[u_id].label == 'mua':
-        nb_new = int(op.max([op.max(v) for v in indices_list]) + 1)
-        childs = cs._get_unused_id(nb_new)
-        
-        cs.split(u_id, indices_list)
-            
-        units[childs[0]] = Unit(childs[0], 
-                                len([v for v in indices_list[0] if v == 0]), 
-                                units[u_id].main_ch, 
-                                units[u_id].group,
-                                units[u_id].probe,
-                                mother = u_id)
-        
-        units[childs[0]].labelize('good')
-        
-        if units[u_id].remove:
-            units[childs[-1]] = Unit(childs[-1], 
-                                     len(units[u_id].remove), 
-                                     units[u_id].main_ch,
-                                     units[u_id].group,
-                                     units[u_id].probe,
-                                     mother = u_id)
-            units[childs[-1]].labelize('trash')
-
-            for i in range(1, nb_new - 2):
-                units[childs[i]] = Unit(childs[i], 
-                                        len([v for v in indices_list[0] if v == i]), 
-                                        units[u_id].main_ch, 
-                                        units[u_id].group, 
-                                        units[u_id].probe,
-                                        mother = u_id)
-                units[childs[i]].labelize('child')
-        else:
-            for i in range(1, nb_new - 1):
-                units[childs[i]] = Unit(childs[i],
-                                        len([v for v in indices_list[0] if v == i]), 
-                                        units[u_id].main_ch, 
-                                        units[u_id].group,
-                                        units[u_id].probe, 
-                                        mother = u_id)
-                units[childs[i]].labelize('child')
-        del units[u_id]
-        
+    # Nothing to split out of the unit
+    if unit.label != 'mua' and len(unit.remove) == 0:
+        return units, cs
+
+    indices_list = unit.get_indices_list()
+
+    # Number given to the spikes to remove, see Unit.get_indices_list()
+    if unit.label == 'mua':
+        trash_value = (len(unit.split) if isinstance(unit.split, list) else 1) + 1
     else:
-        childs = cs._get_unused_id(2)
-        cs.split(u_id, indices_list)
-        
-        if units[u_id].remove:
-            units[childs[0]] = Unit(childs[0],
-                                    len([v for v in indices_list[0] if v == 0]),
-                                    units[u_id].main_ch,
-                                    units[u_id].group,
-                                    units[u_id].probe,
-                                    mother = u_id)
-            units[childs[0]].labelize('good')
-
-            units[childs[1]] = Unit(childs[1],
-                                    len([v for v in indices_list[0] if v == 1]),
-                                    units[u_id].main_ch,
-                                    units[u_id].group,
-                                    units[u_id].probe,
-                                    mother = u_id)
-            units[childs[1]].labelize('trash')
-        
-        del units[u_id]
+        trash_value = 1
+
+    # One new unit per number actually given to spikes, the ids being chosen here so that they match the units dict
+    values, counts = np.unique(indices_list[0], return_counts=True)
+    childs = cs._get_unused_id(len(values))
+    cs.split(u_id, indices_list, new_unit_ids=childs)
+
+    for child, value, count in zip(childs, values, counts):
+        units[child] = Unit(child,
+                            int(count),
+                            unit.main_ch,
+                            unit.group,
+                            unit.probe,
+                            mother = u_id)
+        if value == 0:
+            units[child].labelize('good')
+        elif value == trash_value:
+            units[child].labelize('trash')
+        else:
+            units[child].labelize('child')
+
+    del units[u_id]
 
-    return units, cs
\ No newline at end of file
+    return units, cs
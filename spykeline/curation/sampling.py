@@ -0,0 +1,245 @@
+import os
+import json
+import shutil
+
+import numpy as np
+
+from typing import Dict, Any, List
+
+from ..config import op
+from ..tools import loader
+from .unit import Unit
+from .classifier import project_levels, gather_levels
+from .functions import _normalize_rows, _to_numpy
+
+
+def sampled_units(units: Dict[int, Unit]) -> List[int]:
+    """
+    Ids of the units that were analyzed on a sample of their spikes.
+    """
+    return [u_id for u_id, unit in units.items()
+            if any(channel.levels is not None for channel in unit.channels)]
+
+def _spike_ranks(spike_vector, nb_units: int) -> np.ndarray:
+    """
+    Index of each spike of the spike vector in its unit's spike train.
+    """
+    unit_index = spike_vector['unit_index']
+    order = np.argsort(unit_index, kind='stable')
+    counts = np.bincount(unit_index, minlength=nb_units)
+
+    ranks = np.empty(len(spike_vector), dtype=np.int64)
+    ranks[order] = np.arange(len(spike_vector)) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    return ranks
+
+def _unit_waveforms(sorting_analyzer, unit_ids, chunk_duration: float = 1.):
+    """
+    Read the waveforms of all the spikes of some units from the recording, in a single pass, chunk by chunk.
+    The waveforms have the same window and sparse channels as the analyzer's waveforms extension.
+
+    Yields
+    ------
+    u_id : int
+        Id of the unit.
+    ids : np.ndarray
+        Index of the spikes in the unit's spike train.
+    waveforms : np.ndarray
+        Waveforms of these spikes, shape (n_spikes, n_samples, n_channels).
+    """
+    recording = sorting_analyzer.recording
+    waveforms_ext = loader(sorting_analyzer, 'waveforms')
+    nbefore, nafter = waveforms_ext.nbefore, waveforms_ext.nafter
+    window = np.arange(nbefore + nafter)
+
+    spike_vector = sorting_analyzer.sorting.to_spike_vector()
+    ranks = _spike_ranks(spike_vector, len(sorting_analyzer.unit_ids))
+
+    unit_indices = sorting_analyzer.sorting.ids_to_indices(unit_ids)
+    channels = {u_index: np.flatnonzero(sorting_analyzer.sparsity.mask[u_index]) for u_index in unit_indices}
+    selected = np.isin(spike_vector['unit_index'], unit_indices)
+
+    chunk_size = int(chunk_duration * recording.sampling_frequency)
+
+    for segment_index in range(recording.get_num_segments()):
+        nb_frames = recording.get_num_frames(segment_index)
+        segment_spikes = np.flatnonzero(selected & (spike_vector['segment_index'] == segment_index))
+        samples = spike_vector['sample_index'][segment_spikes]
+
+        for start in range(0, nb_frames, chunk_size):
+            first, last = np.searchsorted(samples, [start, start + chunk_size])
+            if first == last:
+                continue
+            chunk_spikes = segment_spikes[first:last]
+
+            # Traces from start - nbefore to start + chunk_size + nafter, padded with zeros at the segment's borders
+            start_frame, end_frame = max(start - nbefore, 0), min(start + chunk_size + nafter, nb_frames)
+            traces = recording.get_traces(segment_index=segment_index,
+                                          start_frame=start_frame,
+                                          end_frame=end_frame,
+                                          return_scaled=sorting_analyzer.return_scaled)
+            traces = np.pad(traces, ((start_frame - (start - nbefore), start + chunk_size + nafter - end_frame), (0, 0)))
+
+            positions = (samples[first:last] - start)[:, None] + window[None, :]
+            chunk_units = spike_vector['unit_index'][chunk_spikes]
+
+            for u_index in np.unique(chunk_units):
+                in_unit = chunk_units == u_index
+                waveforms = traces[:, channels[u_index]][positions[in_unit]]
+
+                yield sorting_analyzer.unit_ids[u_index], ranks[chunk_spikes[in_unit]], waveforms
+
+def _correlator(spikes):
+    """
+    Correlation function of project_levels(), for spikes of shape (n_spikes, n_samples).
+    """
+    def correlate(level, ids):
+        spike_area = slice(*level['area'])
+        pears = _normalize_rows(op.asarray(spikes[ids, spike_area])) @ op.asarray(level['template'])
+        return _to_numpy(pears)
+
+    return correlate
+
+def project_units(sorting_analyzer, units: Dict[int, Unit], unit_ids: List[int]) -> Dict[int, Unit]:
+    """
+    Extend the curation of units analyzed on a sample of their spikes to all their spikes.
+
+    The distributions, labels and thresholds are the ones found on the sample, only the
+    correlations of the spikes with the template of each level are computed, in a single
+    pass over the recording.
+
+    Parameters
+    ----------
+    sorting_analyzer : sorting_analyzer
+        A spikeinterface's object. Containing information about the sorting.
+    units : dict
+        Dict of instances of Unit, as returned by analyze_units().
+    unit_ids : list
+        Ids of the units to project, see sampled_units().
+
+    Returns
+    -------
+    units : dict
+        The same dict, the projected units now covering all their spikes.
+    """
+    from .. import spykeparams
+
+    threshold = int(spykeparams['curation']['amplitude_threshold'])
+    nb_spikes = sorting_analyzer.sorting.count_num_spikes_per_unit()
+
+    # Spikes ids gathered over the chunks, for each channel of each unit, and each level for the split ones
+    removes = {u_id: [[] for _ in units[u_id].channels] for u_id in unit_ids}
+    splits = {u_id: [[[] for level in channel.levels if level['action'] == 'split'] for channel in units[u_id].channels]
+              for u_id in unit_ids}
+
+    for u_id, ids, waveforms in _unit_waveforms(sorting_analyzer, unit_ids):
+        for c, channel in enumerate(units[u_id].channels):
+            spikes = waveforms[:, :, c]
+            mask = np.max(np.abs(spikes), axis=1) < threshold
+            removes[u_id][c].append(ids[~mask])
+
+            remove, split = project_levels(channel.levels, np.flatnonzero(mask), _correlator(spikes))
+            removes[u_id][c].extend(ids[rows] for rows in remove)
+            for level, rows in enumerate(split):
+                splits[u_id][c][level].append(ids[rows])
+
+    for u_id in unit_ids:
+        unit = units[u_id]
+        for c, channel in enumerate(unit.channels):
+            split = [np.concatenate(groups) if groups else np.empty(0, dtype=np.int64) for groups in splits[u_id][c]]
+            remove, split = gather_levels(channel.label, removes[u_id][c], split)
+            channel.add('remove', remove)
+            channel.add('split', split)
+
+        unit.add('nb_spikes', int(nb_spikes[u_id]))
+        unit.complete_from_channels()
+
+    return units
+
+def _spike_classes(unit: Unit) -> np.ndarray:
+    """
+    Fate of each spike of a unit: 0 kept, 1 split out, 2 removed.
+    """
+    classes = np.zeros(unit.nb_spikes, dtype=np.int8)
+    for group in (unit.split if isinstance(unit.split, list) else [unit.split]):
+        classes[group] = 1
+    classes[unit.remove] = 2
+
+    return classes
+
+def sampling_agreement(sorting_analyzer, units: Dict[int, Unit], unit_ids: List[int], folder: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Compare the curation of units analyzed on a sample of their spikes with their curation on all their spikes,
+    and save the report in the metadata folder as 'Sampling_agreement.json'.
+
+    All the waveforms of these units are read into temporary memmaps and curated again,
+    this is as costly as the full curation and only meant to choose the sample size.
+
+    Parameters
+    ----------
+    sorting_analyzer : sorting_analyzer
+        A spikeinterface's object. Containing information about the sorting.
+    units : dict
+        Dict of instances of Unit, the sampled ones being projected on all their spikes.
+    unit_ids : list
+        Ids of the sampled units.
+    folder : dict
+        Dict with all the required paths.
+
+    Returns
+    -------
+    report : dict
+        Agreement of the labels and of the spikes' fate (kept, split out or removed), per unit and overall.
+    """
+    from .. import spykeparams
+    from .curate import analyze_unit
+
+    tmp_folder = os.path.join(folder['tmp'], 'Sampling_agreement')
+    os.makedirs(tmp_folder, exist_ok=True)
+
+    templates = loader(sorting_analyzer, 'templates').get_data()
+    nb_spikes = sorting_analyzer.sorting.count_num_spikes_per_unit()
+    random_spikes = loader(sorting_analyzer, 'random_spikes').get_data()
+    nb_sampled = np.bincount(sorting_analyzer.sorting.to_spike_vector()['unit_index'][random_spikes],
+                             minlength=len(sorting_analyzer.unit_ids))
+
+    nb_samples = templates.shape[1]
+    waveforms = {u_id: np.lib.format.open_memmap(os.path.join(tmp_folder, f'unit_{u_id}.npy'),
+                                                 mode='w+',
+                                                 dtype=np.float32,
+                                                 shape=(nb_spikes[u_id], nb_samples, len(units[u_id].group)))
+                 for u_id in unit_ids}
+
+    for u_id, ids, unit_waveforms in _unit_waveforms(sorting_analyzer, unit_ids):
+        waveforms[u_id][ids] = unit_waveforms
+
+    report = {'sample_size': spykeparams['curation']['sample_size'], 'units': {}}
+    for u_id in unit_ids:
+        unit = units[u_id]
+        u_index = sorting_analyzer.sorting.id_to_index(u_id)
+        template = templates[u_index][:, sorting_analyzer.channel_ids_to_indices(unit.group)]
+
+        full = analyze_unit(u_id, waveforms[u_id], template, unit.main_ch, unit.group, unit.probe)
+
+        report['units'][str(u_id)] = {
+            'nb_spikes': int(nb_spikes[u_id]),
+            'nb_sampled': int(nb_sampled[u_index]),
+            'label_sampled': unit.label,
+            'label_full': full.label,
+            'spike_agreement': float(np.mean(_spike_classes(unit) == _spike_classes(full)))
+        }
+
+    del waveforms
+    shutil.rmtree(tmp_folder)
+
+    details = list(report['units'].values())
+    if details:
+        report['label_agreement'] = float(np.mean([unit['label_sampled'] == unit['label_full'] for unit in details]))
+        report['spike_agreement'] = float(np.average([unit['spike_agreement'] for unit in details],
+                                                     weights=[unit['nb_spikes'] for unit in details]))
+        print(f"Sampling agreement: {report['label_agreement']:.1%} of the labels, {report['spike_agreement']:.1%} of the spikes")
+
+    with open(os.path.join(folder['metadata'], 'Sampling_agreement.json'), 'w') as f:
+        json.dump(report, f, indent=4)
+
+    return report
@@ -1,30 +1,90 @@
+import os
+import json
+
+import numpy as np
+
 from collections import Counter
 
-from ..config import op
+# Label codes, 0 is kept for unlabeled units
+LABELS = ('good', 'mua', 'noisy', 'noise', 'raw', 'clean', 'trash', 'child')
+LABEL_CODES = {label: code for code, label in enumerate(LABELS, start=1)}
+
+def _as_ids(data) -> np.ndarray:
+    """
+    Convert spike ids to a flat int32 array, the storage format of the units.
+    """
+    if data is None:
+        return np.empty(0, dtype=np.int32)
+    if hasattr(data, 'get'): # CuPy array
+        data = data.get()
+    return np.asarray(data, dtype=np.int32).reshape(-1)
+
+def _is_grouped(data) -> bool:
+    """
+    Whether spike ids are organized by group (list of lists), as in the recursive curation of mua.
+    """
+    return isinstance(data, (list, tuple)) and len(data) > 0 and not np.isscalar(data[0])
 
 class Unit:
 
+    __slots__ = ('id', 'nb_spikes', 'main_ch', 'group', 'probe', 'mother',
+                 'center', 'channels', '_label', '_remove', '_split')
+
     def __init__(self,
                  unit_id,
                  nb_spikes,
                  main_ch,
-                 group, 
+                 group,
                  probe,
                  mother = None):
-        
+
         self.id = unit_id
         self.nb_spikes = nb_spikes
         self.main_ch = main_ch
         self.group = group
         self.probe = probe
         self.mother = mother
-    
+
         self.label = None
-        self.remove = list()
-        self.split = list()
+        self.remove = None
+        self.split = None
         self.center = None
         self.channels = list()
-    
+
+    @property
+    def label(self):
+        return LABELS[self._label - 1] if self._label else None
+
+    @label.setter
+    def label(self, label):
+        self._label = 0 if label is None else LABEL_CODES[str(label)]
+
+    @property
+    def remove(self):
+        """
+        Ids of the spikes to remove from the unit, as an int32 array.
+        """
+        return self._remove
+
+    @remove.setter
+    def remove(self, data):
+        self._remove = _as_ids(data)
+
+    @property
+    def split(self):
+        """
+        Ids of the spikes to split out of the unit, either an int32 array,
+        or a list of int32 arrays (one per group) for the recursive curation of mua.
+        """
+        return self._split
+
+    @split.setter
+    def split(self, data):
+        if _is_grouped(data):
+            self._split = [_as_ids(group) for group in data]
+        else:
+            self._split = _as_ids(data)
+
     def labelize(self, label):
         self.label = label
 
@@ -51,77 +111,77 @@ class Unit:
             List that shall be used for splitting
 
         """
-        indices_list = op.zeros(self.nb_spikes)
+        indices_list = np.zeros(self.nb_spikes, dtype=np.int64)
 
         assert self.label is not None
-        
+
         if self.label == 'mua':
-            if isinstance(self.split[0], list):
+            if isinstance(self.split, list):
                 nb_split = len(self.split)
+                # The last groups are labelled first, a spike keeps the first number it gets
                 for j in range(nb_split, 0, -1):
-                    for i in self.split[j - 1]:
-                        if indices_list[i] == 0:
-                            indices_list[i] = j
-            elif isinstance(self.split[0], int):
-                for i in self.split:
-                    nb_split = 1
-                    indices_list[i] = nb_split
+                    group = self.split[j - 1]
+                    indices_list[group[indices_list[group] == 0]] = j
+            elif len(self.split) > 0:
+                nb_split = 1
+                indices_list[self.split] = nb_split
             else :
                 raise TypeError('Unit\' splitting list not in the correct format, should either be a list of int or a list of list of int')
-            
-            for i in self.remove:
-                indices_list[i] = nb_split + 1
+
+            indices_list[self.remove] = nb_split + 1
         else:
-            for i in self.remove:
-                indices_list[i] = 1
+            indices_list[self.remove] = 1
 
         return [indices_list]
-    
+
     def complete_from_channels(self):
         """
         Completes the unit's information (spike to remove or split out) from its channels.
 
         """
+        remove = np.concatenate([_as_ids(channel.remove) for channel in self.channels])
 
         if 'mua' in [channel.label for channel in self.channels]:
             self.label = 'mua'
 
-            remove = []
+            # Union of the channels' groups, level by level
+            levels = []
             for channel in self.channels:
-                remove.extend(channel.remove)
+                groups = channel.split if isinstance(channel.split, list) else [channel.split]
+                for nb_split, group in enumerate(groups):
+                    if nb_split == len(levels):
+                        levels.append([])
+                    levels[nb_split].append(_as_ids(group))
+            split = [np.unique(np.concatenate(level)) for level in levels]
 
-            for nb_split in range(max([len(channel.split) for channel in self.channels])):
-                tmp = []
-                for channel in self.channels:
-                    try:
-                        tmp.extend(channel.split[nb_split])
-                    except IndexError:
-                        pass
-                self.split.append(list(set(tmp)))
+            if any(isinstance(channel.split, list) for channel in self.channels):
+                self.split = split
+            else:
+                self.split = split[0] if split else None
 
-            self.remove = [i for i in remove if i not in self.split[0]]
+            self.remove = np.setdiff1d(remove, split[0]) if split else np.unique(remove)
 
         else:
             self.label = self.channels[self.main_ch].label
 
-            remove, split = [], []
-            for channel in self.channels:
-                remove.extend(channel.remove)
-                split.extend(channel.split)
+            split = np.concatenate([_as_ids(channel.split) for channel in self.channels])
 
-            self.remove = list(set(remove))
-            self.split = [spike_id for spike_id in split if spike_id not in self.remove]
+            self.remove = np.unique(remove)
+            self.split = split[~np.isin(split, self.remove)]
 
         _count = Counter([channel.center for channel in self.channels])
         self.center = _count.most_common(1)[0][0]
 
 
 class Channel(Unit):
+
+    __slots__ = ('threshold', 'units', 'levels')
+
     def __init__(self,
-                 id, 
+                 id,
                  unit,
                  center):
-        
+
         self.id = id
         self.center = center
 
@@ -130,6 +190,7 @@ class Channel(Unit):
         self.split = None
         self.threshold = None
         self.units = list()
+        self.levels = None
 
         unit.add_channel(self)
 
@@ -138,4 +199,99 @@ class Channel(Unit):
 
     def add(self, key, data):
         assert key in dir(Channel), f"The provided key isn't an attribute of this class, correct attributes are: {repr(dir(Channel))}"
-        setattr(self, key, data)
\ No newline at end of file
+        setattr(self, key, data)
+
+
+def _offsets(sizes) -> np.ndarray:
+    return np.concatenate([[0], np.cumsum(sizes, dtype=np.int64)])
+
+def save_units(units, folder: str) -> None:
+    """
+    Save a dict of units in a columnar layout: one .npy file per attribute,
+    the spike ids of all the units being concatenated in flat int32 arrays with their offsets.
+    The channels' details are not saved, only the unit level information is.
+
+    Parameters
+    ----------
+    units : dict
+        Dict of instances of Unit.
+    folder : str
+        Folder where the units are saved.
+    """
+    os.makedirs(folder, exist_ok=True)
+
+    ordered = list(units.values())
+
+    # For each unit, its split groups (a single group when split isn't grouped)
+    grouped = [isinstance(unit.split, list) for unit in ordered]
+    split_groups = [unit.split if is_grouped else [unit.split] for unit, is_grouped in zip(ordered, grouped)]
+    split_flat = [group for groups in split_groups for group in groups]
+
+    columns = {
+        'id': np.array([unit.id for unit in ordered], dtype=np.int64),
+        'nb_spikes': np.array([unit.nb_spikes for unit in ordered], dtype=np.int64),
+        'main_ch': np.array([unit.main_ch for unit in ordered], dtype=np.int32),
+        'probe': np.array([unit.probe for unit in ordered], dtype=np.int32),
+        'mother': np.array([-1 if unit.mother is None else unit.mother for unit in ordered], dtype=np.int64),
+        'label': np.array([unit._label for unit in ordered], dtype=np.int8),
+        'center': np.array([-1 if unit.center is None else unit.center for unit in ordered], dtype=np.int32),
+        'group': np.concatenate([np.asarray(unit.group, dtype=np.int64) for unit in ordered]) if ordered else np.empty(0, dtype=np.int64),
+        'group_offsets': _offsets([len(unit.group) for unit in ordered]),
+        'remove': np.concatenate([unit.remove for unit in ordered]) if ordered else np.empty(0, dtype=np.int32),
+        'remove_offsets': _offsets([len(unit.remove) for unit in ordered]),
+        'split': np.concatenate(split_flat) if split_flat else np.empty(0, dtype=np.int32),
+        'split_offsets': _offsets([len(group) for group in split_flat]),
+        'split_groups': _offsets([len(groups) for groups in split_groups]),
+        'split_grouped': np.array(grouped, dtype=bool),
+    }
+
+    for name, column in columns.items():
+        np.save(os.path.join(folder, f'{name}.npy'), column)
+
+    with open(os.path.join(folder, 'units.json'), 'w') as f:
+        json.dump({'nb_units': len(ordered), 'labels': LABELS}, f)
+
+def load_units(folder: str):
+    """
+    Load units saved by save_units(). The spike ids are memory-mapped,
+    so they are only read from the disk when accessed.
+
+    Parameters
+    ----------
+    folder : str
+        Folder where the units were saved.
+
+    Returns
+    -------
+    units : dict
+        Dict of instances of Unit.
+    """
+    def column(name, mmap_mode=None):
+        return np.load(os.path.join(folder, f'{name}.npy'), mmap_mode=mmap_mode)
+
+    ids, nb_spikes, main_ch, probe = column('id'), column('nb_spikes'), column('main_ch'), column('probe')
+    mother, label, center = column('mother'), column('label'), column('center')
+    group, group_offsets = column('group'), column('group_offsets')
+    remove, remove_offsets = column('remove', 'r'), column('remove_offsets')
+    split, split_offsets = column('split', 'r'), column('split_offsets')
+    split_groups, split_grouped = column('split_groups'), column('split_grouped')
+
+    units = {}
+    for i, u_id in enumerate(ids.tolist()):
+        unit = Unit(u_id,
+                    int(nb_spikes[i]),
+                    int(main_ch[i]),
+                    group[group_offsets[i]:group_offsets[i + 1]].tolist(),
+                    int(probe[i]),
+                    mother = None if mother[i] < 0 else int(mother[i]))
+        unit._label = int(label[i])
+        unit.center = None if center[i] < 0 else int(center[i])
+
+        # Views on the memory-mapped columns, nothing is copied here
+        unit._remove = remove[remove_offsets[i]:remove_offsets[i + 1]]
+        groups = [split[split_offsets[g]:split_offsets[g + 1]] for g in range(split_groups[i], split_groups[i + 1])]
+        unit._split = groups if split_grouped[i] else groups[0]
+
+        units[u_id] = unit
+
+    return units
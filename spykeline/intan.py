@@ -0,0 +1,113 @@
+import os
+import mmap
+
+import numpy as np
+
+from spikeinterface.core import BaseRecording, BaseRecordingSegment
+
+from .tools import read_rhd
+
+
+class IntanRHDRecording(BaseRecording):
+    """
+    Amplifier channels of Intan's traditional .rhd files, a header followed by data blocks,
+    read in place without converting them to a .dat file first.
+
+    The data blocks of each file are memory-mapped, and the amplifier channels are exposed as a
+    strided view on them, (n_blocks, block_size, n_channels), nothing being read before get_traces().
+    The unsigned samples are shifted to int16, as in Intan's amplifier.dat, and the gain to uV is
+    set on the channels, so it is only applied when scaled traces are requested.
+    Several files are concatenated in a single segment, in the given order.
+
+    Parameters
+    ----------
+    file_paths : str or list
+        Path of the .rhd file(s).
+    """
+
+    def __init__(self, file_paths):
+        if isinstance(file_paths, (str, os.PathLike)):
+            file_paths = [file_paths]
+        file_paths = [os.path.abspath(str(file_path)) for file_path in file_paths]
+
+        infos = [read_rhd(file_path) for file_path in file_paths]
+        for file_path, info in zip(file_paths[1:], infos[1:]):
+            if info['data_dtype'] != infos[0]['data_dtype'] or info['sampling_rate'] != infos[0]['sampling_rate']:
+                raise ValueError(f"{file_path} doesn't have the same channels and sampling rate as {file_paths[0]}")
+
+        sampling_frequency = float(infos[0]['sampling_rate'])
+        channel_ids = list(range(len(infos[0]['amplifier_fields'])))
+
+        BaseRecording.__init__(self, sampling_frequency, channel_ids, 'int16')
+
+        segment = IntanRHDRecordingSegment(file_paths, infos, sampling_frequency)
+        self.add_recording_segment(segment)
+
+        self.set_channel_gains(infos[0]['gain_to_uV'])
+        self.set_channel_offsets(0.)
+        self.annotate(is_filtered=False,
+                      rhd_files=[{'file': file_path, 'num_samples': int(num_samples)}
+                                 for file_path, num_samples in zip(file_paths, segment.file_samples)])
+
+        self._kwargs = {'file_paths': file_paths}
+
+
+class IntanRHDRecordingSegment(BaseRecordingSegment):
+
+    def __init__(self, file_paths, infos, sampling_frequency):
+        BaseRecordingSegment.__init__(self, sampling_frequency=sampling_frequency)
+
+        self.block_size = infos[0]['block_size']
+        self.files, self.amplifiers, self.file_samples = [], [], []
+
+        for file_path, info in zip(file_paths, infos):
+            data_dtype = np.dtype([tuple(field) for field in info['data_dtype']])
+            fields = info['amplifier_fields']
+
+            # The amplifier fields are contiguous in a block, each being block_size uint16 samples
+            first = data_dtype.fields[fields[0]][1]
+            assert all(data_dtype.fields[field][1] == first + i * self.block_size * 2 for i, field in enumerate(fields))
+
+            nb_blocks = (os.path.getsize(file_path) - info['header_size']) // data_dtype.itemsize
+
+            file = open(file_path, 'rb')
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            amplifier = np.ndarray(shape=(nb_blocks, self.block_size, len(fields)),
+                                   dtype='<u2',
+                                   buffer=buffer,
+                                   offset=info['header_size'] + first,
+                                   strides=(data_dtype.itemsize, 2, self.block_size * 2))
+
+            self.files.append((file, buffer))
+            self.amplifiers.append(amplifier)
+            self.file_samples.append(nb_blocks * self.block_size)
+
+        self.file_starts = np.concatenate([[0], np.cumsum(self.file_samples)])
+
+    def get_num_samples(self) -> int:
+        return int(self.file_starts[-1])
+
+    def get_traces(self, start_frame=None, end_frame=None, channel_indices=None) -> np.ndarray:
+        start_frame = 0 if start_frame is None else start_frame
+        end_frame = self.get_num_samples() if end_frame is None else end_frame
+        if channel_indices is None:
+            channel_indices = slice(None)
+
+        nb_channels = self.amplifiers[0][:1, :1, channel_indices].shape[2]
+        traces = np.empty((end_frame - start_frame, nb_channels), dtype='int16')
+
+        for amplifier, file_start, file_end in zip(self.amplifiers, self.file_starts[:-1], self.file_starts[1:]):
+            start, end = max(start_frame, file_start) - file_start, min(end_frame, file_end) - file_start
+            if start >= end:
+                continue
+
+            # Only the blocks overlapping the frames are read
+            first_block, last_block = start // self.block_size, -(-end // self.block_size)
+            blocks = amplifier[first_block:last_block, :, channel_indices]
+            samples = blocks.reshape(-1, nb_channels)[start - first_block * self.block_size:end - first_block * self.block_size]
+
+            # Unsigned to int16, the same as subtracting 32768
+            position = file_start + start - start_frame
+            traces[position:position + len(samples)] = (samples ^ np.uint16(0x8000)).view('int16')
+
+        return traces
@@ -0,0 +1,193 @@
+import os
+import sys
+import shutil
+
+import numpy as np
+import spikeinterface.core as si
+
+from typing import Optional
+
+from .spikesorting.scheduler import total_memory_gb
+
+# Float32 copies of a chunk held by a worker at once (read, filtered with its margins, referenced),
+# and fraction of the available memory the workers of a stage may use
+CHUNK_COPIES = 4
+MEMORY_FRACTION = 0.5
+# Duration of a chunk when the memory doesn't limit it
+CHUNK_DURATION_S = 1.0
+# Float32 copies of a sorter batch held on the GPU, a rough upper bound of kilosort's working memory
+BATCH_COPIES = 32
+STAGES = ['preprocessing', 'sorting', 'postprocessing']
+
+
+def available_memory_gb() -> Optional[float]:
+    """
+    Memory of the machine not used by the other processes in GB, its total memory if it can't be read.
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().available / 1e9
+    except ImportError:
+        pass
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024 / 1e9
+    except OSError:
+        pass
+
+    return total_memory_gb()
+
+def available_cores() -> int:
+    # The cores this process may run on, which can be fewer than the machine's
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def gpu_memory_gb() -> Optional[float]:
+    """
+    Free memory of the GPU in GB, None without GPU.
+    """
+    from .config import has_gpu
+
+    if not has_gpu:
+        return None
+    try:
+        import cupy as cp
+        return cp.cuda.runtime.memGetInfo()[0] / 1e9
+    except Exception:
+        return None
+
+def _stage_job_kwargs(recording, cores: int, memory_gb: Optional[float], mp_context: str) -> dict:
+    """
+    Chunk size and number of workers of a stage, the chunks of all the workers fitting in the memory.
+    """
+    fs = recording.get_sampling_frequency()
+    frame_bytes = recording.get_num_channels() * 4 * CHUNK_COPIES
+    n_jobs = max(1, int(0.75 * cores))
+    chunk_size = int(CHUNK_DURATION_S * fs)
+
+    if memory_gb is not None:
+        budget = MEMORY_FRACTION * memory_gb * 1e9
+        # Fewer workers first, then shorter chunks, down to a tenth of the default duration
+        n_jobs = max(1, min(n_jobs, int(budget // (chunk_size * frame_bytes))))
+        chunk_size = max(int(0.1 * CHUNK_DURATION_S * fs), min(chunk_size, int(budget // (n_jobs * frame_bytes))))
+
+    return {
+        'n_jobs': n_jobs,
+        'chunk_size': chunk_size,
+        'progress_bar': True,
+        'mp_context': mp_context
+    }
+
+def _sorter_overrides(sorter_name: str, recording, gpu_gb: Optional[float]) -> dict:
+    """
+    Sorter parameters depending on the recording: its sampling rate, and the batch size, which keeps
+    the duration set in sorter_dict and is reduced when the batch can't fit in the GPU's memory.
+    """
+    from .spikesorting.sorter_params import sorter_dict
+
+    params = sorter_dict[sorter_name]['params']
+    fs = recording.get_sampling_frequency()
+
+    overrides = {}
+    if 'fs' in params:
+        overrides['fs'] = fs
+    if params.get('batch_size') is not None:
+        batch_size = int(params['batch_size'] * fs / params.get('fs', fs))
+        if gpu_gb is not None:
+            batch_bytes = recording.get_num_channels() * 4 * BATCH_COPIES
+            batch_size = min(batch_size, max(int(0.5 * fs), int(MEMORY_FRACTION * gpu_gb * 1e9 // batch_bytes)))
+        overrides['batch_size'] = batch_size
+
+    return overrides
+
+def plan_jobs(recording, paths: dict, metadata: dict) -> dict:
+    """
+    Plan the resources of each stage of the pipeline from the machine and the recording, instead of
+    the global job kwargs set in config.py, and record the plan in metadata['Job_plan'].
+
+    Each stage gets the chunk size and number of workers whose chunks fit in the memory available, and
+    its multiprocessing start method: fork on Linux without GPU before the sorting, which starts the
+    workers faster, spawn otherwise, as a sorter or a GPU library loaded in the process can't be forked.
+    The sorter's sampling rate and batch size are set for the recording.
+
+    Parameters
+    ----------
+    recording : BaseRecording
+        The raw recording.
+    paths : dict
+        Dict with all the required paths.
+    metadata : dict
+        Dict with channel map information.
+
+    Returns
+    -------
+    plan : dict
+        The machine, the recording, the job kwargs of each stage and the sorter's parameters.
+    """
+    from . import spykeparams
+    from .config import has_gpu
+
+    cores = spykeparams['spikesorting']['n_cores'] or available_cores()
+    memory_gb = available_memory_gb()
+    if spykeparams['spikesorting']['ram_gb']:
+        memory_gb = min(memory_gb or np.inf, spykeparams['spikesorting']['ram_gb'])
+    gpu_gb = gpu_memory_gb()
+
+    scratch = paths['output_folder']
+    while not os.path.exists(scratch):
+        scratch = os.path.dirname(scratch)
+    disk_gb = shutil.disk_usage(scratch).free / 1e9
+
+    nb_samples = sum(recording.get_num_samples(segment_index) for segment_index in range(recording.get_num_segments()))
+    recording_gb = nb_samples * recording.get_num_channels() * recording.get_dtype().itemsize / 1e9
+
+    fork = sys.platform.startswith('linux') and not has_gpu
+    mp_contexts = {
+        'preprocessing': 'fork' if fork else 'spawn',
+        'sorting': 'spawn',
+        'postprocessing': 'spawn'
+    }
+
+    plan = {
+        'machine': {
+            'cores': cores,
+            'available_memory_gb': memory_gb,
+            'gpu_memory_gb': gpu_gb,
+            'scratch_free_gb': disk_gb
+        },
+        'recording': {
+            'channels': recording.get_num_channels(),
+            'sampling_frequency': recording.get_sampling_frequency(),
+            'duration_s': nb_samples / recording.get_sampling_frequency(),
+            'dtype': recording.get_dtype().str,
+            'size_gb': recording_gb
+        },
+        'stages': {stage: _stage_job_kwargs(recording, cores, memory_gb, mp_contexts[stage]) for stage in STAGES},
+        'sorter': _sorter_overrides(spykeparams['spikesorting']['sorter'], recording, gpu_gb)
+    }
+
+    # The sorter writes the whitened traces, the caches a copy of the preprocessed ones
+    needed_gb = recording_gb * (2 + spykeparams['general']['save_dat'] + spykeparams['general']['preprocessed_cache'])
+    if disk_gb < needed_gb:
+        plan['disk_warning'] = f"{disk_gb:.0f} GB free in {scratch}, the run may write up to {needed_gb:.0f} GB"
+        print(f"Warning: {plan['disk_warning']}")
+
+    metadata['Job_plan'] = plan
+
+    print(f"Job plan: {cores} cores, {memory_gb or 0:.0f} GB available, chunks of "
+          f"{plan['stages']['preprocessing']['chunk_size']} frames on {plan['stages']['preprocessing']['n_jobs']} workers")
+
+    return plan
+
+def apply_stage(metadata: dict, stage: str) -> None:
+    """
+    Set spikeinterface's global job kwargs to the planned ones of the stage, if the jobs were planned.
+    """
+    plan = metadata.get('Job_plan')
+    if plan is None:
+        return
+
+    si.set_global_job_kwargs(**plan['stages'][stage])
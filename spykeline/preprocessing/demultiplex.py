@@ -0,0 +1,109 @@
+import os
+import time
+
+import numpy as np
+import spikeinterface.core as si
+
+from typing import List, Tuple
+from spikeinterface.core.job_tools import ChunkRecordingExecutor, fix_job_kwargs
+
+
+def _init_demultiplex_worker(source, file_paths, shapes, dtypes, columns):
+    # Each worker maps the output files once, the chunks being written in place
+    return {
+        'source': source,
+        'stores': [np.memmap(file_path, dtype=dtype, mode='r+', shape=shape)
+                   for file_path, shape, dtype in zip(file_paths, shapes, dtypes)],
+        'columns': columns
+    }
+
+def _demultiplex_chunk(segment_index, start_frame, end_frame, worker_ctx):
+    # The chunk of every probe is read in a single call
+    traces = worker_ctx['source'].get_traces(segment_index=segment_index, start_frame=start_frame, end_frame=end_frame)
+    for store, columns in zip(worker_ctx['stores'], worker_ctx['columns']):
+        store[start_frame:end_frame] = traces[:, columns]
+
+def demultiplex(recordings: list, file_paths: List[str], raw, fused: bool = False) -> Tuple[list, dict]:
+    """
+    Write the probes of an interleaved recording into one contiguous binary file each, 
+    in a single pass over its chunks.
+
+    Each probe is then read from its own file, instead of reading the whole interleaved recording
+    and discarding the other probes' channels at each traversal.
+
+    Parameters
+    ----------
+    recordings : list
+        Recording of each probe, single segment.
+    file_paths : list
+        Binary file of each probe.
+    raw : recording
+        The interleaved recording the probes come from.
+    fused : bool
+        If False, the probes are channel subsets of raw, which is read once per chunk.
+        If True, the probes are preprocessed recordings of raw, aggregated so that their 
+        preprocessing is applied in the same pass. Default is False.
+
+    Returns
+    -------
+    stores : list
+        Binary recordings of the written files, with the channels, probe and properties of the originals.
+    report : dict
+        Bytes read and written, and the reads saved at each traversal of the probes.
+    """
+    start = time.perf_counter()
+
+    if fused:
+        source = recordings[0] if len(recordings) == 1 else si.aggregate_channels(recordings)
+        offsets = np.cumsum([0] + [rec.get_num_channels() for rec in recordings])
+        columns = [np.arange(offsets[i], offsets[i + 1]) for i in range(len(recordings))]
+    else:
+        source = raw
+        columns = [raw.ids_to_indices(rec.channel_ids) for rec in recordings]
+
+    assert source.get_num_segments() == 1, "Only single segment recordings can be demultiplexed"
+    nb_samples = source.get_num_samples()
+
+    shapes = [(nb_samples, rec.get_num_channels()) for rec in recordings]
+    dtypes = [rec.get_dtype() for rec in recordings]
+    for file_path, shape, dtype in zip(file_paths, shapes, dtypes):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        np.memmap(file_path, dtype=dtype, mode='w+', shape=shape).flush()
+
+    executor = ChunkRecordingExecutor(source,
+                                      _demultiplex_chunk,
+                                      _init_demultiplex_worker,
+                                      (source, file_paths, shapes, dtypes, columns),
+                                      job_name='demultiplex',
+                                      **fix_job_kwargs({}))
+    executor.run()
+
+    stores = []
+    for rec, file_path in zip(recordings, file_paths):
+        store = si.read_binary(file_path,
+                               rec.get_sampling_frequency(),
+                               rec.get_dtype(),
+                               rec.get_num_channels(),
+                               channel_ids=rec.channel_ids)
+        rec.copy_metadata(store)
+        stores.append(store)
+
+    # Without demultiplexing, each probe's traversal reads the whole interleaved chunks
+    interleaved = nb_samples * raw.get_num_channels() * raw.get_dtype().itemsize
+    written = [os.path.getsize(file_path) for file_path in file_paths]
+    report = {
+        'duration_s': time.perf_counter() - start,
+        'read_MB': interleaved / 1e6,
+        'written_MB': [size / 1e6 for size in written],
+        'traversal_read_MB': {
+            'interleaved': len(recordings) * interleaved / 1e6,
+            'demultiplexed': sum(written) / 1e6
+        }
+    }
+    report['traversal_saved_MB'] = report['traversal_read_MB']['interleaved'] - report['traversal_read_MB']['demultiplexed']
+
+    print(f"Demultiplexed {len(recordings)} probes in {report['duration_s']:.1f}s, "
+          f"each traversal of all the probes now reads {report['traversal_read_MB']['demultiplexed']:.0f} MB "
+          f"instead of {report['traversal_read_MB']['interleaved']:.0f} MB")
+
+    return stores, report
@@ -0,0 +1,359 @@
+import time
+
+import numpy as np
+import scipy.signal
+
+from typing import Optional
+
+from spikeinterface.core import get_chunk_with_margin, get_closest_channels
+from spikeinterface.preprocessing.basepreprocessor import BasePreprocessor, BasePreprocessorSegment
+from spikeinterface.preprocessing.filter import fix_dtype
+from spikeinterface.preprocessing.whiten import compute_whitening_matrix
+
+try:
+    import numba
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+
+if HAVE_NUMBA:
+    # The kernels are single threaded, the chunks being already processed in parallel by spikeinterface's jobs
+
+    @numba.njit(cache=True)
+    def _sos_row(sos, state, row):
+        # Transposed direct form II, as scipy.signal.sosfilt, on all the channels of a sample at once
+        for s in range(sos.shape[0]):
+            b0, b1, b2, a1, a2 = sos[s, 0], sos[s, 1], sos[s, 2], sos[s, 4], sos[s, 5]
+            for c in range(row.shape[0]):
+                value = row[c]
+                out = b0 * value + state[s, 0, c]
+                state[s, 0, c] = b1 * value - a1 * out + state[s, 1, c]
+                state[s, 1, c] = b2 * value - a2 * out
+                row[c] = out
+
+    @numba.njit(cache=True)
+    def _sosfiltfilt(traces, sos, zi, padlen):
+        # scipy.signal.sosfiltfilt with its default odd padding, the traces being filtered in place
+        nb_samples, nb_channels = traces.shape
+        state = np.empty((sos.shape[0], 2, nb_channels))
+        row = np.empty(nb_channels)
+
+        # The odd extensions are taken before the traces are overwritten
+        left = np.empty((padlen, nb_channels))
+        right = np.empty((padlen, nb_channels))
+        for k in range(padlen):
+            left[k] = 2 * traces[0] - traces[padlen - k]
+            right[k] = 2 * traces[nb_samples - 1] - traces[nb_samples - 2 - k]
+
+        for s in range(sos.shape[0]):
+            for j in range(2):
+                state[s, j] = zi[s, j] * left[0]
+        for k in range(padlen):
+            _sos_row(sos, state, left[k])
+        for i in range(nb_samples):
+            row[:] = traces[i]
+            _sos_row(sos, state, row)
+            traces[i] = row
+        for k in range(padlen):
+            _sos_row(sos, state, right[k])
+
+        for s in range(sos.shape[0]):
+            for j in range(2):
+                state[s, j] = zi[s, j] * right[padlen - 1]
+        for k in range(padlen - 1, -1, -1):
+            _sos_row(sos, state, right[k])
+        for i in range(nb_samples - 1, -1, -1):
+            row[:] = traces[i]
+            _sos_row(sos, state, row)
+            traces[i] = row
+
+    @numba.njit(cache=True)
+    def _reference(traces, set_indices, set_offsets, channel_sets, median):
+        # The shifts of a sample are all computed before its channels are referenced
+        nb_samples, nb_channels = traces.shape
+        nb_sets = len(set_offsets) - 1
+        shifts = np.empty(nb_sets)
+        values = np.empty(len(set_indices))
+        for i in range(nb_samples):
+            for s in range(nb_sets):
+                size = set_offsets[s + 1] - set_offsets[s]
+                if median:
+                    # Insertion sort, the sets being a few channels
+                    for k in range(size):
+                        value = traces[i, set_indices[set_offsets[s] + k]]
+                        j = k
+                        while j > 0 and values[j - 1] > value:
+                            values[j] = values[j - 1]
+                            j -= 1
+                        values[j] = value
+                    if size % 2:
+                        shifts[s] = values[size // 2]
+                    else:
+                        shifts[s] = (values[size // 2 - 1] + values[size // 2]) / 2
+                else:
+                    total = 0.
+                    for k in range(size):
+                        total += traces[i, set_indices[set_offsets[s] + k]]
+                    shifts[s] = total / size
+            for c in range(nb_channels):
+                if channel_sets[c] < 0:
+                    traces[i, c] = 0
+                else:
+                    traces[i, c] -= shifts[channel_sets[c]]
+
+else:
+    def _sosfiltfilt(traces, sos, zi, padlen):
+        traces[:] = scipy.signal.sosfiltfilt(sos, traces, axis=0)
+
+    def _reference(traces, set_indices, set_offsets, channel_sets, median):
+        operator = np.median if median else np.mean
+        shifts = np.stack([operator(traces[:, set_indices[start:stop]], axis=1)
+                           for start, stop in zip(set_offsets[:-1], set_offsets[1:])], axis=1)
+        outside = channel_sets < 0
+        traces -= shifts[:, np.maximum(channel_sets, 0)]
+        traces[:, outside] = 0
+
+
+class FusedPreprocessingRecording(BasePreprocessor):
+    """
+    Bandpass (or highpass) filter, common reference and whitening of a recording, computed in a single
+    pass per chunk instead of a chain of three preprocessors.
+
+    The chunk is copied once in a float32 buffer, filtered then referenced in place sample by sample,
+    then whitened. With an integer dtype, the intermediate results are rounded as the
+    chain spre.filter, spre.common_reference and spre.whiten does, so that both give the same traces.
+
+    Parameters
+    ----------
+    recording : recording
+        A spikeinterface object, not filtered.
+    band : float or list
+        Cutoff frequency of a highpass filter, or band of a bandpass filter.
+    btype : str
+        'bandpass' or 'highpass'.
+    ftype : str
+        Filter type for scipy.signal.iirfilter.
+    filter_order : int
+        Order of the filter, applied forward and backward. Default is 5.
+    margin_ms : float
+        Margin read on each side of the chunks for the filter. Default is 5.
+    reference : str
+        'global' to reference the channel groups, 'local' to reference each channel by its annulus.
+    operator : str
+        'median' or 'average'.
+    groups : list, optional
+        Channel ids of each group, for the 'global' reference. The channels outside of the groups are set to 0.
+    local_radius : tuple
+        Exclude and include radius of the annulus, for the 'local' reference.
+    W : array-like, optional
+        Whitening matrix, no whitening if None.
+    int_scale : float, optional
+        Scale of the whitened traces.
+    dtype : dtype, optional
+        Dtype of the traces, the recording's one if None.
+    """
+
+    def __init__(self, recording, band, btype, ftype, filter_order=5, margin_ms=5.0, reference='global',
+                 operator='median', groups=None, local_radius=(22, 55), W=None, int_scale=None, dtype=None):
+        assert operator in ('median', 'average'), "'operator' must be 'median' or 'average'"
+        fs = recording.get_sampling_frequency()
+        sos = scipy.signal.iirfilter(filter_order, band, fs=fs, analog=False, btype=btype, ftype=ftype, output='sos')
+        dtype = fix_dtype(recording, dtype)
+
+        # Channels referenced by each set, and set of each channel (-1 for the channels outside of the groups)
+        num_chans = recording.get_num_channels()
+        if reference == 'local':
+            closest_inds, dist = get_closest_channels(recording)
+            sets = [closest_inds[i, (dist[i, :] > local_radius[0]) & (dist[i, :] <= local_radius[1])] for i in range(num_chans)]
+            assert all(len(s) > 0 for s in sets), "No reference channels available in the local annulus for selection."
+            channel_sets = np.arange(num_chans)
+        else:
+            sets = [recording.ids_to_indices(group) for group in groups] if groups is not None else [np.arange(num_chans)]
+            channel_sets = np.full(num_chans, -1)
+            for s, indices in enumerate(sets):
+                channel_sets[indices] = s
+
+        BasePreprocessor.__init__(self, recording, dtype=dtype)
+        self.annotate(is_filtered=True)
+
+        if "offset_to_uV" in self.get_property_keys():
+            self.set_channel_offsets(0)
+
+        W = np.asarray(W, dtype='float32') if W is not None else None
+        margin = int(margin_ms * fs / 1000.0)
+        for parent_segment in recording._recording_segments:
+            self.add_recording_segment(FusedPreprocessingRecordingSegment(parent_segment,
+                                                                          sos,
+                                                                          margin,
+                                                                          np.concatenate(sets).astype('int64'),
+                                                                          np.cumsum([0] + [len(s) for s in sets]).astype('int64'),
+                                                                          channel_sets.astype('int64'),
+                                                                          operator == 'median',
+                                                                          W,
+                                                                          int_scale,
+                                                                          dtype))
+
+        self._kwargs = dict(recording=recording,
+                            band=band,
+                            btype=btype,
+                            ftype=ftype,
+                            filter_order=filter_order,
+                            margin_ms=margin_ms,
+                            reference=reference,
+                            operator=operator,
+                            groups=groups,
+                            local_radius=local_radius,
+                            W=W.tolist() if W is not None else None,
+                            int_scale=float(int_scale) if int_scale is not None else None,
+                            dtype=dtype.str)
+
+
+class FusedPreprocessingRecordingSegment(BasePreprocessorSegment):
+
+    def __init__(self, parent_recording_segment, sos, margin, set_indices, set_offsets, channel_sets, median, W, int_scale, dtype):
+        BasePreprocessorSegment.__init__(self, parent_recording_segment)
+
+        self.sos = sos
+        self.zi = scipy.signal.sosfilt_zi(sos)
+        # Padding of scipy.signal.sosfiltfilt
+        self.padlen = 3 * (2 * len(sos) + 1 - min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum()))
+        self.margin = margin
+        self.set_indices = set_indices
+        self.set_offsets = set_offsets
+        self.channel_sets = channel_sets
+        self.median = median
+        self.W = W
+        self.int_scale = int_scale
+        self.dtype = dtype
+
+    def get_traces(self, start_frame, end_frame, channel_indices):
+        traces_chunk, left_margin, right_margin = get_chunk_with_margin(self.parent_recording_segment,
+                                                                        start_frame,
+                                                                        end_frame,
+                                                                        slice(None),
+                                                                        self.margin)
+        integer = np.issubdtype(self.dtype, np.integer)
+
+        # The only copy of the chunk, which is then processed in place
+        buffer = np.array(traces_chunk, dtype='float32')
+        _sosfiltfilt(buffer, self.sos, self.zi, self.padlen)
+        if integer:
+            np.rint(buffer, out=buffer)
+
+        traces = buffer[left_margin:buffer.shape[0] - right_margin]
+        _reference(traces, self.set_indices, self.set_offsets, self.channel_sets, self.median)
+        if integer:
+            np.trunc(traces, out=traces)
+
+        if self.W is not None:
+            traces = traces @ self.W
+        if channel_indices is not None:
+            traces = traces[:, channel_indices]
+        if self.int_scale is not None:
+            traces *= self.int_scale
+
+        return traces.astype(self.dtype, order='C')
+
+
+def fused_preprocessing(recording, channel_groups: Optional[list] = None):
+    """
+    Apply the filter, the common reference and the whitening of the parameters to a recording, in a single pass per chunk.
+    Gives the same traces as apply_filter, apply_common_ref and spre.whiten chained.
+
+    Parameters
+    ----------
+    recording : recording
+        A spikeinterface object, not filtered.
+    channel_groups : list, optional
+        Channel ids of each shank to reference, if None the channels are referenced by radius.
+
+    Returns
+    -------
+    recording_preprocessed : recording
+        Preprocessed recording.
+    """
+    from .. import spykeparams
+
+    filter_params = spykeparams['preprocessing']['filter']
+    if filter_params['freq_max'] is None:
+        btype = "highpass"
+        band = filter_params['freq_min']
+    else:
+        btype = "bandpass"
+        band = [filter_params['freq_min'], filter_params['freq_max']]
+
+    kwargs = dict(band=band,
+                  btype=btype,
+                  ftype=filter_params['type'],
+                  reference='local' if channel_groups is None else 'global',
+                  operator=spykeparams['preprocessing']['common_reference']['method'],
+                  groups=channel_groups)
+
+    recording_preprocessed = FusedPreprocessingRecording(recording, **kwargs)
+
+    if spykeparams["preprocessing"]["whiten"]:
+        # Computed on the referenced traces, as spre.whiten
+        W, _ = compute_whitening_matrix(recording_preprocessed, "global", {}, apply_mean=False, radius_um=100.0)
+        recording_preprocessed = FusedPreprocessingRecording(recording, W=W, int_scale=1000, **kwargs)
+
+    return recording_preprocessed
+
+def benchmark_fused(recording, channel_groups: Optional[list] = None, duration_s: float = 10.,
+                    chunk_duration_s: float = 1.) -> dict:
+    """
+    Compare the throughput of the fused preprocessing with the chained preprocessors, and the difference of their traces.
+
+    Parameters
+    ----------
+    recording : recording
+        A spikeinterface object, not filtered.
+    channel_groups : list, optional
+        Channel ids of each shank to reference, if None the channels are referenced by radius.
+    duration_s : float
+        Duration of the recording read by each of them. Default is 10.
+    chunk_duration_s : float
+        Duration of the chunks read. Default is 1.
+
+    Returns
+    -------
+    report : dict
+        Samples per second of each of them, the speedup and the largest difference of the traces.
+    """
+    from .. import spykeparams
+    from .preprocess import apply_filter, apply_common_ref
+    import spikeinterface.preprocessing as spre
+
+    fused = fused_preprocessing(recording, channel_groups)
+    chained = apply_common_ref(apply_filter(recording), channel_groups)
+    if spykeparams["preprocessing"]["whiten"]:
+        # The same whitening matrix, the chunks it is computed on being random
+        chained = spre.whiten(chained, int_scale=1000, W=np.asarray(fused._kwargs['W'], dtype='float32'))
+
+    fs = recording.get_sampling_frequency()
+    chunk_size = int(chunk_duration_s * fs)
+    nb_samples = min(int(duration_s * fs), recording.get_num_samples(segment_index=0))
+
+    report = {'max_abs_diff': 0.}
+    for name, rec in [('chained', chained), ('fused', fused)]:
+        # Compiles the numba kernels before timing them
+        rec.get_traces(segment_index=0, start_frame=0, end_frame=min(chunk_size, nb_samples))
+        start = time.perf_counter()
+        for frame in range(0, nb_samples, chunk_size):
+            rec.get_traces(segment_index=0, start_frame=frame, end_frame=min(frame + chunk_size, nb_samples))
+        report[f'{name}_samples_per_s'] = nb_samples / (time.perf_counter() - start)
+
+    for frame in range(0, nb_samples, chunk_size):
+        end_frame = min(frame + chunk_size, nb_samples)
+        diff = (fused.get_traces(segment_index=0, start_frame=frame, end_frame=end_frame).astype('float64')
+                - chained.get_traces(segment_index=0, start_frame=frame, end_frame=end_frame).astype('float64'))
+        report['max_abs_diff'] = max(report['max_abs_diff'], float(np.abs(diff).max()))
+
+    report['speedup'] = report['fused_samples_per_s'] / report['chained_samples_per_s']
+    report['numba'] = HAVE_NUMBA
+
+    print(f"Fused preprocessing: {report['fused_samples_per_s']:.0f} samples/s, "
+          f"chained: {report['chained_samples_per_s']:.0f} samples/s (x{report['speedup']:.1f}), "
+          f"largest difference {report['max_abs_diff']:.3g}")
+
+    return report
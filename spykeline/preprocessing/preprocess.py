@@ -6,7 +6,10 @@ import spikeinterface.preprocessing as spre
 from collections import Counter, defaultdict
 
 from .probe import create_probe
+from .demultiplex import demultiplex
+from .fused import fused_preprocessing
 from ..tools import rename_annot
+from ..cache import materialize_recording, preprocessed_fingerprint
 
 def apply_filter(recording):
     """
@@ -95,8 +98,9 @@ def run_preprocessing(recording, paths, metadata):
     else:
         all_ch_disc = spykeparams["general"]["discard_channels"]
     
-    # Apply the initial filter
-    recording_filtered = apply_filter(recording)
+    # Apply the initial filter, unless it is fused with the common reference
+    fused = spykeparams['preprocessing']['fused']
+    recording_filtered = recording if fused else apply_filter(recording)
 
     probegroup, shanks_groups, metadata = create_probe(metadata)
 
@@ -107,6 +111,9 @@ def run_preprocessing(recording, paths, metadata):
 
     metadata["Shanks_groups"] = [grouped[k] for k in grouped.keys()]
 
+    # Preprocessed binaries written by this run, which the phy export may reuse
+    metadata['Preprocessed_binaries'] = []
+
     rec_probe = recording_filtered.set_probegroup(probegroup)
 
     if spykeparams['spikesorting']['pipeline'] == 'all':
@@ -117,16 +124,23 @@ def run_preprocessing(recording, paths, metadata):
 
         rec = rec_probe.select_channels(ch_keep)
 
-        rec_cmr = apply_common_ref(rec, metadata["Shanks_groups"])
-
-        # Apply whitening
-        if spykeparams["preprocessing"]["whiten"]:
-            rec_preprocessed = spre.whiten(rec_cmr, int_scale=1000)
+        if fused:
+            rec_preprocessed = fused_preprocessing(rec, metadata["Shanks_groups"])
         else:
-            rec_preprocessed = rec_cmr
+            rec_cmr = apply_common_ref(rec, metadata["Shanks_groups"])
+
+            # Apply whitening
+            if spykeparams["preprocessing"]["whiten"]:
+                rec_preprocessed = spre.whiten(rec_cmr, int_scale=1000)
+            else:
+                rec_preprocessed = rec_cmr
 
         rec_preprocessed.set_property("shank", [channel for probe in shanks_groups for channel in probe])
 
+        # All the later stages read the preprocessed traces from the cache
+        if spykeparams["general"]["preprocessed_cache"]:
+            rec_preprocessed = materialize_recording(rec_preprocessed, recording, paths['preprocessed_cache'])
+
         if spykeparams["general"]["save_dat"]:
             pp_folder = paths['preprocessing']
             os.makedirs(pp_folder, exist_ok=True)
@@ -136,15 +150,23 @@ def run_preprocessing(recording, paths, metadata):
                 dtype="uint16",
                 verbose=True
             )
+            metadata['Preprocessed_binaries'].append(os.path.join(pp_folder, "preprocessed_rec.dat"))
+
+        # The analyzers are keyed on the raw recording and the preprocessing, not on the files read at this run
+        rec_preprocessed.annotate(preprocessed_fingerprint=preprocessed_fingerprint(rec_preprocessed, recording))
 
         print("Preprocessing done!")
 
         return [rec_preprocessed]
     else:
+        demultiplex_mode = spykeparams['preprocessing']['demultiplex']
+        if demultiplex_mode == 'raw':
+            # The probes are split before the filter, which then reads the probe's own file only
+            rec_probe = recording.set_probegroup(probegroup)
         recordings = rec_probe.split_by('group', 'list')
 
-        preprocessed_recordings = []
-
+        probe_ids = []
+        probe_recordings = []
         for id, rec in enumerate(recordings):
             ch_keep = [ch for ch in rec.get_channel_ids() if not ch in all_ch_disc]
             ch_disc = [ch for ch in rec.get_channel_ids() if ch in all_ch_disc]
@@ -152,20 +174,35 @@ def run_preprocessing(recording, paths, metadata):
                 print(f"skipping probe {id}, as all its channels are to be discarded")
                 continue
             
-            rec = rec.select_channels(ch_keep)
-            
+            probe_ids.append(id)
+            probe_recordings.append(rec.select_channels(ch_keep))
+
+        if demultiplex_mode == 'raw':
+            probe_recordings, metadata['Demultiplex'] = demultiplex(probe_recordings,
+                                                                    [os.path.join(paths[f'Probe_{id}']['preprocessing'], 'raw_rec.dat') for id in probe_ids],
+                                                                    rec_probe)
+            if not fused:
+                probe_recordings = [apply_filter(rec) for rec in probe_recordings]
+
+        preprocessed_recordings = []
+
+        for id, rec in zip(probe_ids, probe_recordings):
             # Apply Common Reference
             if metadata['Probes'][id]['Architecture'] == 'Linear':
-                rec_cmr = apply_common_ref(rec)
+                shanks = None
             else:
                 shanks = [shank for shank in metadata["Shanks_groups"] if any(electrode in rec.get_channel_ids() for electrode in shank)]
-                rec_cmr = apply_common_ref(rec, shanks)
 
-            # Apply whitening
-            if spykeparams["preprocessing"]["whiten"]:
-                rec_preprocessed = spre.whiten(rec_cmr, int_scale=1000)
+            if fused:
+                rec_preprocessed = fused_preprocessing(rec, shanks)
             else:
-                rec_preprocessed = rec_cmr
+                rec_cmr = apply_common_ref(rec, shanks)
+
+                # Apply whitening
+                if spykeparams["preprocessing"]["whiten"]:
+                    rec_preprocessed = spre.whiten(rec_cmr, int_scale=1000)
+                else:
+                    rec_preprocessed = rec_cmr
 
             rec_preprocessed.set_property("shank", shanks_groups[id])
 
@@ -173,16 +210,38 @@ def run_preprocessing(recording, paths, metadata):
 
             preprocessed_recordings.append(rec_renamed)
 
-        # Save the processed recording
-        if spykeparams["general"]["save_dat"]:
-            pp_folder = paths[f'Probe_{id}']['preprocessing']
-            os.makedirs(pp_folder, exist_ok=True)
-            si.write_binary_recording(
-                recording=rec_renamed,
-                file_paths=os.path.join(pp_folder, "preprocessed_rec.dat"),
-                dtype="uint16",
-                verbose=True
-            )
+        if demultiplex_mode == 'preprocessed':
+            # The filter, common reference and whitening of all the probes are computed in the same pass
+            dat_paths = [os.path.join(paths[f'Probe_{id}']['preprocessing'], 'preprocessed_rec.dat') for id in probe_ids]
+            preprocessed_recordings, metadata['Demultiplex'] = demultiplex(preprocessed_recordings,
+                                                                           dat_paths,
+                                                                           recording,
+                                                                           fused=True)
+            metadata['Preprocessed_binaries'] += dat_paths
+        if demultiplex_mode:
+            metadata['Demultiplex']['mode'] = demultiplex_mode
+            metadata['Demultiplex']['probes'] = probe_ids
+
+        # All the later stages read the preprocessed traces from the cache
+        if spykeparams["general"]["preprocessed_cache"]:
+            preprocessed_recordings = [materialize_recording(rec, recording, paths['preprocessed_cache']) for rec in preprocessed_recordings]
+
+        # Save the processed recording of each probe, already written by the demultiplexer when preprocessed
+        if spykeparams["general"]["save_dat"] and demultiplex_mode != 'preprocessed':
+            for id, rec in zip(probe_ids, preprocessed_recordings):
+                pp_folder = paths[f'Probe_{id}']['preprocessing']
+                os.makedirs(pp_folder, exist_ok=True)
+                si.write_binary_recording(
+                    recording=rec,
+                    file_paths=os.path.join(pp_folder, "preprocessed_rec.dat"),
+                    dtype="uint16",
+                    verbose=True
+                )
+                metadata['Preprocessed_binaries'].append(os.path.join(pp_folder, "preprocessed_rec.dat"))
+
+        # The analyzers are keyed on the raw recording and the preprocessing, not on the files read at this run
+        for rec in preprocessed_recordings:
+            rec.annotate(preprocessed_fingerprint=preprocessed_fingerprint(rec, recording))
 
         print("Preprocessing done!")
 
@@ -4,11 +4,11 @@ import time
 import shutil
 
 from . import set_spykeparams
-from .GUI import SpykelineGUI
 from .tools import define_paths, load_data, convert_json_compatible, open_sorting, export_results, delete_temp_files
 from .preprocessing.preprocess import run_preprocessing
 from .spikesorting.sorting import run_sorting
 from .curation.curate import run_curation
+from .planner import plan_jobs, apply_stage
 
 def run_spykeline(input_path, secondary_path, spykeparams, probe_dict):
     """
@@ -23,7 +23,8 @@ def run_spykeline(input_path, secondary_path, spykeparams, probe_dict):
 
     Returns
     -------
-    None
+    output_folder : str
+        The folder of Spykeline's results.
     """
     start_time = time.time()
 
@@ -33,7 +34,12 @@ def run_spykeline(input_path, secondary_path, spykeparams, probe_dict):
 
     recording, metadata = load_data(paths, probe_dict)
 
+    # The resources of each stage are planned from the machine and the recording
+    if spykeparams['general']['job_planner']:
+        plan_jobs(recording, paths, metadata)
+
     # Preprocessing
+    apply_stage(metadata, 'preprocessing')
     pp_recording = run_preprocessing(recording,
                                       paths, 
                                       metadata)
@@ -41,16 +47,20 @@ def run_spykeline(input_path, secondary_path, spykeparams, probe_dict):
     # SpikeSorting
     if spykeparams['general']['do_spikesort']:
         print("Starting SpikeSorting...")
+        apply_stage(metadata, 'sorting')
         data = run_sorting(
             pp_recording, 
             paths, 
-            metadata
+            metadata,
+            recording
             )
     else:
         print("Skipping SpikeSorting...")
+        apply_stage(metadata, 'postprocessing')
         data = open_sorting(paths, pp_recording, metadata)
 
     # Curation
+    apply_stage(metadata, 'postprocessing')
     if spykeparams['general']['do_curation']:
         if spykeparams['general']['pipeline'] == 'all':
             curated_data, units = run_curation(probe_data, metadata, paths)
@@ -58,6 +68,11 @@ def run_spykeline(input_path, secondary_path, spykeparams, probe_dict):
             curated_data = []
             units = []
             for probe_id, probe_data in enumerate(data):
+                # Probes whose sorting failed
+                if probe_data is None:
+                    curated_data.append(None)
+                    units.append(None)
+                    continue
                 curated_probe_data, probe_units = run_curation(probe_data, metadata, paths[f'Probe_{probe_id}'])
                 curated_data.append(curated_probe_data)
                 units.append(probe_units)
@@ -86,7 +101,11 @@ def run_spykeline(input_path, secondary_path, spykeparams, probe_dict):
 
     print(f'\nTo check your results, access the folder: \n\n\t{paths["output_folder"]} \n\nClosing Spykeline...')
 
+    return paths['output_folder']
+
 def main():
+    # Imported here, so that the pipeline can run without Tk, see batch.py
+    from .GUI import SpykelineGUI
 
     gui = SpykelineGUI()
     gui_params, input_path, secondary_path, probe_dict = gui.GUI()
@@ -0,0 +1,177 @@
+import os
+import copy
+import multiprocessing
+
+import spikeinterface.core as si
+import spikeinterface.sorters as ss
+
+from typing import List, Optional, Union
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+
+def total_memory_gb() -> Optional[float]:
+    """
+    Physical memory of the machine in GB, None if it can't be read.
+    """
+    try:
+        import psutil
+        return psutil.virtual_memory().total / 1e9
+    except ImportError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1e9
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def job_memory_gb(recording) -> float:
+    """
+    Memory a sorter job is expected to use: the traces of its recording as float32,
+    as held by the sorters caching their preprocessing in memory.
+    """
+    return recording.get_total_memory_size() * 4 / recording.get_dtype().itemsize / 1e9
+
+def split_n_jobs(sorter_name: str, params: dict, n_jobs: int) -> dict:
+    """
+    Copy of the sorter's parameters with its number of jobs set, either in its job_kwargs or as a parameter.
+    """
+    params = copy.deepcopy(params)
+    defaults = ss.get_default_sorter_params(sorter_name)
+    if 'job_kwargs' in defaults:
+        params['job_kwargs'] = {**params.get('job_kwargs', {}), 'n_jobs': n_jobs}
+    elif 'n_jobs' in defaults:
+        params['n_jobs'] = n_jobs
+
+    return params
+
+def _run_sorter_job(sorter_name: str, recording, folder: str, image: Optional[str], params: dict, job_kwargs: Optional[dict]):
+    """
+    Run a sorter, the spikeinterface's jobs it launches using the job_kwargs of the caller, with its
+    share of the cores. The sorting is read back from its folder by the caller.
+    """
+    if job_kwargs is not None:
+        si.set_global_job_kwargs(**job_kwargs)
+
+    ss.run_sorter(sorter_name,
+                  recording,
+                  folder,
+                  docker_image=image,
+                  verbose=True,
+                  **params)
+
+    return folder
+
+def schedule_sorting(sorter_name: str,
+                     recordings: list,
+                     folders: List[str],
+                     params: List[dict],
+                     image: Optional[str] = None,
+                     n_workers: Optional[int] = None) -> List[Union[si.BaseSorting, Exception]]:
+    """
+    Run the sorter on independent recordings, concurrently under the CPU cores and RAM budget of
+    spykeparams['spikesorting'].
+
+    Up to n_workers jobs run at once, the 'n_cores' being split between them. A job is only
+    launched in the recordings' order when its expected memory fits in what the running jobs leave
+    of 'ram_gb', a job larger than the whole budget running alone. Sorters running on the GPU, i.e.
+    when one is available or the sorter requires it, and recordings that can't be sent to another
+    process, are run one after another.
+
+    Parameters
+    ----------
+    sorter_name : str
+        Name of the sorter.
+    recordings : list
+        The recordings to sort.
+    folders : list
+        Output folder of each recording.
+    params : list
+        Sorter parameters of each recording.
+    image : str, optional
+        Docker image of the sorter.
+    n_workers : int, optional
+        Maximum number of jobs run at once. Default is spykeparams['spikesorting']['parallel_probes'].
+
+    Returns
+    -------
+    sortings : list
+        Sorting of each recording in their order, or the exception raised by its sorter,
+        so that a failure doesn't discard the other recordings.
+    """
+    from .. import spykeparams, set_spykeparams
+    from ..config import has_gpu
+
+    n_cores = spykeparams['spikesorting']['n_cores'] or os.cpu_count()
+    ram_gb = spykeparams['spikesorting']['ram_gb'] or total_memory_gb() or float('inf')
+
+    n_workers = min(n_workers or spykeparams['spikesorting']['parallel_probes'], len(recordings))
+    gpu_capability = ss.sorter_dict[sorter_name].gpu_capability
+    if n_workers > 1 and (gpu_capability == 'nvidia-required' or (has_gpu and gpu_capability != 'not-supported')):
+        print(f"{sorter_name} runs on the GPU, the recordings are sorted one after another")
+        n_workers = 1
+    if n_workers > 1 and not all(rec.check_serializability('pickle') for rec in recordings):
+        print("The recordings can't be sent to other processes, they are sorted one after another")
+        n_workers = 1
+
+    sortings = [None] * len(recordings)
+
+    if n_workers == 1:
+        for i, (rec, folder, probe_params) in enumerate(zip(recordings, folders, params)):
+            try:
+                sortings[i] = ss.run_sorter(sorter_name,
+                                            rec,
+                                            folder,
+                                            docker_image=image,
+                                            verbose=True,
+                                            **probe_params)
+            except Exception as error:
+                print(f"Sorting of {folder} failed: {error!r}")
+                sortings[i] = error
+
+        return sortings
+
+    n_jobs = max(1, n_cores // n_workers)
+    # The workers start with the job kwargs of config.py, the planned ones are passed along
+    job_kwargs = {**si.get_global_job_kwargs(), 'n_jobs': n_jobs}
+    memory = [job_memory_gb(rec) for rec in recordings]
+    print(f"Sorting {len(recordings)} recordings, up to {n_workers} at once with {n_jobs} cores each, within {ram_gb:.0f} GB")
+
+    pending = list(range(len(recordings)))
+    running = {}
+    with ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=set_spykeparams,
+                             initargs=(spykeparams,)) as executor:
+        while pending or running:
+            # Launched in order, while the next job fits in the workers and the memory left
+            while pending and len(running) < n_workers:
+                i = pending[0]
+                if running and sum(memory[j] for j in running.values()) + memory[i] > ram_gb:
+                    break
+                pending.pop(0)
+                try:
+                    future = executor.submit(_run_sorter_job,
+                                             sorter_name,
+                                             recordings[i],
+                                             folders[i],
+                                             image,
+                                             split_n_jobs(sorter_name, params[i], n_jobs),
+                                             job_kwargs)
+                except Exception as error: # The pool is broken, e.g. a worker was killed
+                    print(f"Sorting of {folders[i]} failed: {error!r}")
+                    sortings[i] = error
+                    continue
+                running[future] = i
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                try:
+                    sortings[i] = ss.read_sorter_folder(future.result(), register_recording=False)
+                except Exception as error:
+                    print(f"Sorting of {folders[i]} failed: {error!r}")
+                    sortings[i] = error
+
+    return sortings
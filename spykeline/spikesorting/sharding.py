@@ -0,0 +1,244 @@
+import os
+
+import numpy as np
+import spikeinterface.core as si
+
+from typing import List, Tuple
+from scipy.optimize import linear_sum_assignment
+from spikeinterface.comparison.comparisontools import make_agreement_scores
+
+
+def shard_bounds(num_samples: int, n_shards: int, overlap: int) -> List[dict]:
+    """
+    Frames of the time shards of a recording.
+
+    The recording is cut in n_shards equal cores, each shard extending over half the overlap
+    on both sides of its core, so that two neighbouring shards share 'overlap' frames centered
+    on the cut between their cores.
+
+    Returns
+    -------
+    bounds : list
+        For each shard, a dict with its 'start' and 'end' frames, and the 'core_start'
+        and 'core_end' frames of the spikes it keeps.
+    """
+    cuts = np.linspace(0, num_samples, n_shards + 1).astype(int)
+    before = overlap // 2
+    after = overlap - before
+
+    bounds = []
+    for i in range(n_shards):
+        bounds.append({
+            'start': int(max(0, cuts[i] - before)) if i > 0 else 0,
+            'end': int(min(num_samples, cuts[i + 1] + after)) if i < n_shards - 1 else num_samples,
+            'core_start': int(cuts[i]),
+            'core_end': int(cuts[i + 1])
+        })
+
+    return bounds
+
+def split_shards(recording, folder: str) -> Tuple[list, List[str], List[dict]]:
+    """
+    Cut a recording into the overlapping time shards of spykeparams['spikesorting'].
+
+    Parameters
+    ----------
+    recording : BaseRecording
+        The recording to sort, single segment.
+    folder : str
+        Output folder of the recording's sorting, the shards being sorted in its Shards folder.
+
+    Returns
+    -------
+    shards : list
+        Recording of each shard.
+    folders : list
+        Sorter output folder of each shard.
+    bounds : list
+        Frames of each shard, see shard_bounds.
+    """
+    from .. import spykeparams
+
+    assert recording.get_num_segments() == 1, "Only single segment recordings can be sharded"
+
+    num_samples = recording.get_num_samples()
+    overlap = int(spykeparams['spikesorting']['shard_overlap_s'] * recording.get_sampling_frequency())
+    n_shards = spykeparams['spikesorting']['n_shards']
+    if overlap >= num_samples // n_shards:
+        raise ValueError(f"The shards overlap ({spykeparams['spikesorting']['shard_overlap_s']}s) must be shorter "
+                         f"than a shard ({num_samples / n_shards / recording.get_sampling_frequency():.0f}s)")
+
+    bounds = shard_bounds(num_samples, n_shards, overlap)
+    shards = [recording.frame_slice(start_frame=shard['start'], end_frame=shard['end']) for shard in bounds]
+    folders = [os.path.join(folder, 'Shards', f'shard_{i}') for i in range(n_shards)]
+
+    return shards, folders, bounds
+
+def _window_trains(trains: dict, start: int, end: int) -> dict:
+    # Spikes of each unit between the frames start and end
+    return {unit: train[(train >= start) & (train < end)] for unit, train in trains.items()}
+
+def _window_templates(recording, windows: List[dict], start: int, end: int, ms_before: float, ms_after: float,
+                      max_spikes: int, chunk_size: int) -> List[dict]:
+    """
+    Mean waveform of the units of several sortings, from up to max_spikes of their spikes between
+    the frames start and end, which are read once, chunk by chunk.
+    """
+    nbefore = int(ms_before * recording.get_sampling_frequency() / 1000)
+    nafter = int(ms_after * recording.get_sampling_frequency() / 1000)
+    num_samples = recording.get_num_samples()
+    rng = np.random.default_rng(0)
+
+    # Spikes of every unit of every sortings, labelled by their position in the list of units
+    keys, frames, labels = [], [], []
+    for i, trains in enumerate(windows):
+        for unit, train in trains.items():
+            train = train[(train >= nbefore) & (train < num_samples - nafter)]
+            if len(train) > max_spikes:
+                train = np.sort(rng.choice(train, max_spikes, replace=False))
+            frames.append(train)
+            labels.append(np.full(len(train), len(keys)))
+            keys.append((i, unit))
+    frames = np.concatenate(frames) if frames else np.zeros(0, dtype=np.int64)
+    labels = np.concatenate(labels) if labels else np.zeros(0, dtype=np.int64)
+    order = np.argsort(frames, kind='stable')
+    frames, labels = frames[order], labels[order]
+
+    sums = np.zeros((len(keys), nbefore + nafter, recording.get_num_channels()), dtype=np.float64)
+    counts = np.bincount(labels, minlength=len(keys))
+    offsets = np.arange(-nbefore, nafter)
+    for chunk_start in range(start, end, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, end)
+        lo, hi = np.searchsorted(frames, [chunk_start, chunk_end])
+        if lo == hi:
+            continue
+        first = frames[lo] - nbefore
+        traces = recording.get_traces(start_frame=first, end_frame=frames[hi - 1] + nafter, return_scaled=False)
+        np.add.at(sums, labels[lo:hi], traces[frames[lo:hi, None] - first + offsets])
+
+    templates = [{} for _ in windows]
+    for key, total, count in zip(keys, sums, counts):
+        if count > 0:
+            templates[key[0]][key[1]] = total / count
+
+    return templates
+
+def _template_similarity(templates1: dict, units1: list, templates2: dict, units2: list) -> np.ndarray:
+    # Cosine similarity of the flattened templates, 0 for the units without spikes in the window
+    similarity = np.zeros((len(units1), len(units2)))
+    for i, unit1 in enumerate(units1):
+        for j, unit2 in enumerate(units2):
+            if unit1 in templates1 and unit2 in templates2:
+                a, b = templates1[unit1].ravel(), templates2[unit2].ravel()
+                norm = np.linalg.norm(a) * np.linalg.norm(b)
+                similarity[i, j] = a @ b / norm if norm > 0 else 0
+
+    return similarity
+
+def stitch_shards(recording,
+                  sortings: list,
+                  bounds: List[dict],
+                  delta_ms: float = 0.4,
+                  min_agreement: float = 0.5,
+                  min_similarity: float = 0.8,
+                  max_spikes: int = 200) -> Tuple[si.BaseSorting, dict]:
+    """
+    Stitch the sortings of the time shards of a recording into a single sorting.
+
+    At each cut, the units of the two shards are compared on the window they share: the agreement
+    of their spikes in it, and the similarity of their mean waveforms in it. The pairs whose both
+    scores pass the thresholds are matched one to one, maximizing the agreement, and the matched
+    units form a single unit. Each shard keeps the spikes of its core only, so that the spikes of
+    the overlap aren't counted twice, and the spikes close to its edges are left to its neighbour.
+
+    Parameters
+    ----------
+    recording : BaseRecording
+        The sharded recording.
+    sortings : list
+        Sorting of each shard, in the frames of the shard.
+    bounds : list
+        Frames of each shard, see shard_bounds.
+    delta_ms : float
+        Time in ms within which two spikes are the same. Default is 0.4.
+    min_agreement : float
+        Minimum agreement of the spikes of two matched units. Default is 0.5.
+    min_similarity : float
+        Minimum cosine similarity of the templates of two matched units. Default is 0.8.
+    max_spikes : int
+        Maximum number of spikes per unit averaged into its template. Default is 200.
+
+    Returns
+    -------
+    sorting : BaseSorting
+        The stitched sorting, in the frames of the recording.
+    report : dict
+        Units of each shard, units matched at each cut, and units of the stitched sorting.
+    """
+    sampling_frequency = recording.get_sampling_frequency()
+    delta_frames = int(delta_ms * sampling_frequency / 1000)
+
+    # Spike trains of each shard in the frames of the recording
+    trains = []
+    for sorting, shard in zip(sortings, bounds):
+        trains.append({unit: sorting.get_unit_spike_train(unit, segment_index=0).astype(np.int64) + shard['start']
+                       for unit in sorting.unit_ids})
+
+    # Units matched across a cut take the stitched id of their unit in the previous shard
+    next_id = 0
+    stitched_ids = [{}]
+    for unit in trains[0]:
+        stitched_ids[0][unit] = next_id
+        next_id += 1
+
+    matches = []
+    for k in range(len(bounds) - 1):
+        start, end = bounds[k + 1]['start'], bounds[k]['end']
+        left = _window_trains(trains[k], start, end)
+        right = _window_trains(trains[k + 1], start, end)
+        units_left, units_right = list(left), list(right)
+
+        pairs = []
+        if units_left and units_right:
+            agreement = make_agreement_scores(si.NumpySorting.from_unit_dict(left, sampling_frequency),
+                                              si.NumpySorting.from_unit_dict(right, sampling_frequency),
+                                              delta_frames).values
+            templates = _window_templates(recording, [left, right], start, end, 1.0, 2.0, max_spikes,
+                                          int(sampling_frequency))
+            similarity = _template_similarity(templates[0], units_left, templates[1], units_right)
+
+            score = np.where((agreement >= min_agreement) & (similarity >= min_similarity), agreement, 0)
+            rows, cols = linear_sum_assignment(score, maximize=True)
+            pairs = [(units_left[i], units_right[j]) for i, j in zip(rows, cols) if score[i, j] > 0]
+
+        matched = dict((right_unit, left_unit) for left_unit, right_unit in pairs)
+        stitched_ids.append({})
+        for unit in trains[k + 1]:
+            if unit in matched:
+                stitched_ids[k + 1][unit] = stitched_ids[k][matched[unit]]
+            else:
+                stitched_ids[k + 1][unit] = next_id
+                next_id += 1
+        matches.append(len(pairs))
+
+    # Spikes of the cores only, the units without any being dropped
+    units = {}
+    for shard_trains, shard_ids, shard in zip(trains, stitched_ids, bounds):
+        core = _window_trains(shard_trains, shard['core_start'], shard['core_end'])
+        for unit, train in core.items():
+            units.setdefault(shard_ids[unit], []).append(train)
+    units = {stitched_id: np.sort(np.concatenate(parts)) for stitched_id, parts in sorted(units.items())}
+    units = {unit_id: train for unit_id, train in enumerate(train for train in units.values() if len(train) > 0)}
+
+    sorting = si.NumpySorting.from_unit_dict(units, sampling_frequency)
+
+    report = {
+        'bounds': bounds,
+        'units_per_shard': [len(shard_trains) for shard_trains in trains],
+        'matched_per_cut': matches,
+        'units': len(units)
+    }
+    print(f"Stitched {len(bounds)} shards: {report['units_per_shard']} units, {matches} matched at the cuts, "
+          f"{report['units']} units in total")
+
+    return sorting, report
@@ -1,11 +1,109 @@
 import os
+import copy
 
 import spikeinterface.core as si
-import spikeinterface.sorters as ss
 
 from .sorter_params import sorter_dict
+from .scheduler import schedule_sorting
+from .sharding import split_shards, stitch_shards
 
-def run_sorting(recordings, paths, metadata):
+def sorter_params(sorter_name, recording, overrides=None):
+    """
+    Copy of the sorter's parameters, with the peaks selection of the sorters that need it
+    scaled to the recording's duration, and the overrides planned for the recording, see planner.py.
+    """
+    params = copy.deepcopy(sorter_dict[sorter_name]['params'])
+    params.update(overrides or {})
+    if sorter_name in ['spykingcircus2', 'tridesclous2']:
+        full_time = recording.get_duration()
+        params['selection']['n_peaks_per_channel'] = int(0.1 * full_time)
+        params['selection']['min_n_peaks'] = int(0.02 * full_time)
+
+    return params
+
+def sort_recordings(sorter_name, recordings, folders, image, metadata, raw_recording=None, cache=None):
+    """
+    Sort independent recordings with the scheduler, each recording being cut into time shards
+    whose sortings are stitched back when spykeparams['spikesorting']['n_shards'] is above 1.
+    The recordings already sorted by a previous run are loaded from the sorting cache.
+
+    Returns
+    -------
+    sortings : list
+        Sorting of each recording, or the exception raised by its sorter or its stitching.
+    """
+    from .. import spykeparams
+    from ..cache import sorting_key
+
+    n_shards = spykeparams['spikesorting']['n_shards']
+    # Each of the probes sorted at once sorts its shards at once
+    n_workers = spykeparams['spikesorting']['parallel_probes']
+    if n_shards > 1:
+        n_workers *= min(spykeparams['spikesorting']['parallel_shards'] or n_shards, n_shards)
+    overrides = metadata.get('Job_plan', {}).get('sorter')
+
+    # The planned batch size depends on the GPU memory free at run time, only the sampling rate is keyed
+    key_overrides = {'fs': overrides['fs']} if overrides and 'fs' in overrides else None
+
+    keys = [None] * len(recordings)
+    cached = [None] * len(recordings)
+    if cache is not None and raw_recording is not None:
+        for i, rec in enumerate(recordings):
+            keys[i] = sorting_key(rec, raw_recording, sorter_name, sorter_params(sorter_name, rec, key_overrides))
+            cached[i] = cache.load(keys[i])
+            if cached[i] is not None:
+                metadata.setdefault('Sorting_cache', {})[folders[i]] = cache.entries[keys[i]]['folder']
+
+    # The shards of all the recordings are sorted as independent jobs
+    jobs, job_folders, shards = [], [], []
+    for rec, folder, sorting in zip(recordings, folders, cached):
+        if sorting is not None:
+            shard_recordings, shard_folders, bounds = [], [], None
+        elif n_shards > 1:
+            shard_recordings, shard_folders, bounds = split_shards(rec, folder)
+        else:
+            shard_recordings, shard_folders, bounds = [rec], [folder], None
+        shards.append((len(jobs), len(shard_recordings), bounds))
+        jobs.extend(shard_recordings)
+        job_folders.extend(shard_folders)
+
+    job_sortings = []
+    if jobs:
+        job_sortings = schedule_sorting(sorter_name,
+                                        jobs,
+                                        job_folders,
+                                        [sorter_params(sorter_name, rec, overrides) for rec in jobs],
+                                        image,
+                                        n_workers)
+
+    sortings = []
+    for rec, folder, key, sorting, (first, count, bounds) in zip(recordings, folders, keys, cached, shards):
+        if sorting is not None:
+            sortings.append(sorting)
+            continue
+
+        shard_sortings = job_sortings[first:first + count]
+        errors = [sorting for sorting in shard_sortings if isinstance(sorting, Exception)]
+        if bounds is None or errors:
+            sorting = errors[0] if errors else shard_sortings[0]
+            if cache is not None and not errors:
+                cache.store(key, folder, sorter_name, overrides=overrides)
+            sortings.append(sorting)
+            continue
+        try:
+            sorting, report = stitch_shards(rec, shard_sortings, bounds)
+            sorting = sorting.save(folder=os.path.join(folder, 'Stitched_sorting'), overwrite=True)
+            metadata.setdefault('Sharding', {})[folder] = report
+            if cache is not None:
+                cache.store(key, os.path.join(folder, 'Stitched_sorting'), sorter_name, stitched=True, overrides=overrides)
+        except Exception as error:
+            print(f"Stitching of {folder} failed: {error!r}")
+            sorting = error
+        sortings.append(sorting)
+
+    return sortings
+
+def run_sorting(recordings, paths, metadata, raw_recording=None):
     """
     Run sorting pipeline.
 
@@ -17,6 +115,9 @@ def run_sorting(recordings, paths, metadata):
         Dict with all the required paths.
     metadata : dict
         Dict with channel map information.
+    raw_recording : BaseRecording, optional
+        The raw recording the recordings were preprocessed from, to find their sorting in the
+        sorting cache. The cache isn't used if None.
 
     Returns
     -------
@@ -27,6 +128,8 @@ def run_sorting(recordings, paths, metadata):
     """
     from .. import spykeparams
     from ..tools import exporter
+    from ..cache import get_sorting_cache
+    from ..planner import apply_stage
 
     sorter_name = spykeparams['spikesorting']['sorter']
 
@@ -39,17 +142,16 @@ def run_sorting(recordings, paths, metadata):
     if spykeparams['spikesorting']['pipeline'] == 'all':
         merged_recording = si.aggregate_channels(recordings)
 
-        if sorter_name in ['spykingcircus2', 'tridesclous2']:
-                full_time = rec.get_duration()
-                sorter_dict[sorter_name]['params']['selection']['n_peaks_per_channel'] = int(0.1 * full_time)
-                sorter_dict[sorter_name]['params']['selection']['min_n_peaks'] = int(0.02 * full_time)
-
-        sorting = ss.run_sorter(sorter_name,
-                                merged_recording,
-                                paths['output_folder'],
-                                docker_image=image,
-                                verbose=True,
-                                **sorter_dict[sorter_name]['params'])
+        sorting = sort_recordings(sorter_name,
+                                  [merged_recording],
+                                  [paths['output_folder']],
+                                  image,
+                                  metadata,
+                                  raw_recording,
+                                  get_sorting_cache(paths))[0]
+        if isinstance(sorting, Exception):
+            raise sorting
+        apply_stage(metadata, 'postprocessing')
         
         if spykeparams['general']['do_curation'] or spykeparams['general']['export_to_phy'] or spykeparams['general']['export_to_klusters']:
                 final_recording, final_sorting, sorting_analyzer = exporter(None, 
@@ -71,19 +173,23 @@ def run_sorting(recordings, paths, metadata):
         }
         
     elif spykeparams['spikesorting']['pipeline'] == 'by_probe':
+        # The probes are independent, they are sorted concurrently within the resources set
+        sortings = sort_recordings(sorter_name,
+                                   recordings,
+                                   [paths[f'Probe_{id}']['base_folder'] for id in range(len(recordings))],
+                                   image,
+                                   metadata,
+                                   raw_recording,
+                                   get_sorting_cache(paths))
+        apply_stage(metadata, 'postprocessing')
+
         data = []
-        for id, rec in enumerate(recordings): 
-            if sorter_name in ['spykingcircus2', 'tridesclous2']:
-                full_time = rec.get_duration()
-                sorter_dict[sorter_name]['params']['selection']['n_peaks_per_channel'] = int(0.1 * full_time)
-                sorter_dict[sorter_name]['params']['selection']['min_n_peaks'] = int(0.02 * full_time)
-            
-            sorting = ss.run_sorter(sorter_name,
-                                    rec,
-                                    paths[f'Probe_{id}']['base_folder'],
-                                    docker_image=image,
-                                    verbose=True,
-                                    **sorter_dict[sorter_name]['params'])
+        for id, (rec, sorting) in enumerate(zip(recordings, sortings)):
+            if isinstance(sorting, Exception):
+                print(f"Skipping probe {id}, its sorting failed")
+                metadata.setdefault('Sorting_errors', {})[id] = repr(sorting)
+                data.append(None)
+                continue
 
             if spykeparams['general']['do_curation'] or spykeparams['general']['export_to_phy']:
                 final_recording, final_sorting, sorting_analyzer = exporter(id,
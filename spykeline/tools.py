@@ -1,12 +1,16 @@
 import os
+import glob
 import json
+import time
 import shutil
+import struct
 
 import numpy as np
 
 import spikeinterface.core as si
 import spikeinterface.exporters as sexp 
 
+from typing import Optional
 from packaging.version import Version as V
 
 from spykeline.config import op
@@ -55,6 +59,17 @@ extensions_dict = {
     }
 }
 
+# Extensions required to compute each extension
+extension_dependencies = {
+    'random_spikes': [],
+    'waveforms': ['random_spikes'],
+    'templates': ['waveforms'],
+    'noise_levels': [],
+    'spike_amplitudes': ['templates'],
+    'principal_components': ['waveforms'],
+    'quality_metrics': ['noise_levels', 'spike_amplitudes'],
+}
+
 def define_paths(base_folder, probe_dict, secondary_path = None):
     """
     Create a dictionary of required paths for Spykeline
@@ -80,16 +95,27 @@ def define_paths(base_folder, probe_dict, secondary_path = None):
     paths = {
         'base_folder' : base_folder,
         'dat' : os.path.join(base_folder, 'amplifier.dat'),
-        'rhd' : os.path.join(base_folder, 'info.rhd')
+        'rhd' : os.path.join(base_folder, 'info.rhd'),
+        'rhd_files' : [],
+        'dat_files' : []
     }
 
     dir_files = os.listdir(base_folder)
-    if 'amplifier.dat' in dir_files:
+    if spykeparams['general']['dat_files']:
+        # Session recorded in several .dat files, read as a single recording
+        paths['dat'] = None
+        paths['dat_files'] = resolve_dat_files(base_folder, spykeparams['general']['dat_files'])
+    elif 'amplifier.dat' in dir_files:
         paths['dat'] = os.path.join(base_folder, 'amplifier.dat')
     elif f'{session}.dat' in dir_files:
         paths['dat'] = os.path.join(base_folder, session + '.dat')
     else:
-        raise FileNotFoundError(f"Could not find the .dat file in {base_folder}. Please check the path or rename the file to either 'amplifier.dat' or {session}.dat.")
+        # Intan's traditional format, the data blocks are read from the .rhd files directly
+        paths['rhd_files'] = rhd_data_files(base_folder)
+        if not paths['rhd_files']:
+            raise FileNotFoundError(f"Could not find the .dat file in {base_folder}. Please check the path or rename the file to either 'amplifier.dat' or {session}.dat, or provide .rhd files holding the data.")
+        paths['dat'] = None
+        paths['rhd'] = paths['rhd_files'][0]
 
     if spykeparams['general']['secondary_path']:
         paths['output_folder'] = secondary_path
@@ -110,15 +136,21 @@ def define_paths(base_folder, probe_dict, secondary_path = None):
             paths['output_folder'] = os.path.join(base_folder, f'SpikeSorting_{i}')
         else:
             paths['output_folder'] = os.path.join(paths['base_folder'], 'SpikeSorting')
-    
+
+    # Shared by the runs on the session, unlike the output folder
+    paths['preprocessed_cache'] = spykeparams['general']['preprocessed_cache_folder'] or os.path.join(paths['base_folder'], 'Preprocessed_cache')
+    paths['sorting_cache'] = os.path.join(paths['base_folder'], 'Sorting_cache.json')
+
     if spykeparams['spikesorting']['pipeline'] == 'all':
         paths['tmp'] = os.path.join(paths['output_folder'], 'Tmp')
         paths['metadata'] = os.path.join(paths['output_folder'], 'Metadata')
         paths['preprocessing'] = os.path.join(paths['output_folder'], 'Preprocessing')
 
         if spykeparams['general']['do_curation']:
-            paths['units'] = os.path.join(paths['metadata'], 'Original_units.pkl')
-            paths['units_final'] = os.path.join(paths['metadata'], 'Final_units.pkl')
+            paths['units'] = os.path.join(paths['metadata'], 'Original_units')
+            paths['units_final'] = os.path.join(paths['metadata'], 'Final_units')
+            # Shared by the runs on the session, so that a rerun finds the correlations
+            paths['correlations'] = os.path.join(paths['base_folder'], 'Correlations_cache', 'All')
 
         if spykeparams['general']['export_to_phy']:
             paths['phy'] = os.path.join(paths['output_folder'], 'Phy')
@@ -135,8 +167,9 @@ def define_paths(base_folder, probe_dict, secondary_path = None):
             }
 
             if spykeparams['general']['do_curation']:
-                paths[f'Probe_{id}']['units'] = os.path.join(paths[f'Probe_{id}']['metadata'], 'Original_units.pkl')
-                paths[f'Probe_{id}']['units_final'] = os.path.join(paths[f'Probe_{id}']['metadata'], 'Final_units.pkl')
+                paths[f'Probe_{id}']['units'] = os.path.join(paths[f'Probe_{id}']['metadata'], 'Original_units')
+                paths[f'Probe_{id}']['units_final'] = os.path.join(paths[f'Probe_{id}']['metadata'], 'Final_units')
+                paths[f'Probe_{id}']['correlations'] = os.path.join(paths['base_folder'], 'Correlations_cache', f'Probe_{id}')
 
             if spykeparams['general']['export_to_phy']:
                 paths[f'Probe_{id}']['phy'] = os.path.join(paths[f'Probe_{id}']['base_folder'], 'Phy')
@@ -146,140 +179,251 @@ def define_paths(base_folder, probe_dict, secondary_path = None):
 
     return paths
 
-def read_rhd(filepath):
+# Header fields of the Intan's .rhd files
+rhd_global_header_base = [
+    ("magic_number", "uint32"),  # 0xC6912702
+    ("major_version", "int16"),
+    ("minor_version", "int16"),
+]
+
+rhd_global_header_part1 = [
+    ("sampling_rate", "float32"),
+    ("dsp_enabled", "int16"),
+    ("actual_dsp_cutoff_frequency", "float32"),
+    ("actual_lower_bandwidth", "float32"),
+    ("actual_upper_bandwidth", "float32"),
+    ("desired_dsp_cutoff_frequency", "float32"),
+    ("desired_lower_bandwidth", "float32"),
+    ("desired_upper_bandwidth", "float32"),
+    ("notch_filter_mode", "int16"),
+    ("desired_impedance_test_frequency", "float32"),
+    ("actual_impedance_test_frequency", "float32"),
+    ("note1", "QString"),
+    ("note2", "QString"),
+    ("note3", "QString"),
+]
+
+rhd_global_header_v11 = [
+    ("num_temp_sensor_channels", "int16"),
+]
+
+rhd_global_header_v13 = [
+    ("eval_board_mode", "int16"),
+]
+
+rhd_global_header_v20 = [
+    ("reference_channel", "QString"),
+]
+
+rhd_global_header_final = [
+    ("nb_signal_group", "int16"),
+]
+
+rhd_signal_group_header = [
+    ("signal_group_name", "QString"),
+    ("signal_group_prefix", "QString"),
+    ("signal_group_enabled", "int16"),
+    ("channel_num", "int16"),
+    ("amplified_channel_num", "int16"),
+]
+
+rhd_signal_channel_header = [
+    ("native_channel_name", "QString"),
+    ("custom_channel_name", "QString"),
+    ("native_order", "int16"),
+    ("custom_order", "int16"),
+    ("signal_type", "int16"),
+    ("channel_enabled", "int16"),
+    ("chip_channel_num", "int16"),
+    ("board_stream_num", "int16"),
+    ("spike_scope_trigger_mode", "int16"),
+    ("spike_scope_voltage_thresh", "int16"),
+    ("spike_scope_digital_trigger_channel", "int16"),
+    ("spike_scope_digital_edge_polarity", "int16"),
+    ("electrode_impedance_magnitude", "float32"),
+    ("electrode_impedance_phase", "float32"),
+]
+
+# Struct codes of the fixed size fields, the QStrings are decoded apart
+rhd_struct_codes = {'uint32': 'I', 'int16': 'h', 'float32': 'f'}
+
+def _compile_rhd_header(header) -> list:
     """
-    Read and parse a RHD file.
-
-    Parameters
-    ----------
-    path : str
-        Path to the .rhd file.
+    Group the consecutive fixed size fields of a header into precompiled little-endian structs.
 
     Returns
     -------
-    intan_info : IntanRecordingExtractor
-        Information about the recording, that is from the Intan's .rhd file.
+    compiled : list
+        (struct.Struct, field names) for each run of fixed size fields, (None, [name]) for each QString.
     """
-    rhd_global_header_base = [
-        ("magic_number", "uint32"),  # 0xC6912702
-        ("major_version", "int16"),
-        ("minor_version", "int16"),
-    ]
-
-    rhd_global_header_part1 = [
-        ("sampling_rate", "float32"),
-        ("dsp_enabled", "int16"),
-        ("actual_dsp_cutoff_frequency", "float32"),
-        ("actual_lower_bandwidth", "float32"),
-        ("actual_upper_bandwidth", "float32"),
-        ("desired_dsp_cutoff_frequency", "float32"),
-        ("desired_lower_bandwidth", "float32"),
-        ("desired_upper_bandwidth", "float32"),
-        ("notch_filter_mode", "int16"),
-        ("desired_impedance_test_frequency", "float32"),
-        ("actual_impedance_test_frequency", "float32"),
-        ("note1", "QString"),
-        ("note2", "QString"),
-        ("note3", "QString"),
-    ]
-
-    rhd_global_header_v11 = [
-        ("num_temp_sensor_channels", "int16"),
-    ]
-
-    rhd_global_header_v13 = [
-        ("eval_board_mode", "int16"),
-    ]
-
-    rhd_global_header_v20 = [
-        ("reference_channel", "QString"),
-    ]
-
-    rhd_global_header_final = [
-        ("nb_signal_group", "int16"),
+    compiled, codes, names = [], '', []
+    for field_name, field_type in header:
+        if field_type == 'QString':
+            if names:
+                compiled.append((struct.Struct('<' + codes), names))
+                codes, names = '', []
+            compiled.append((None, [field_name]))
+        else:
+            codes += rhd_struct_codes[field_type]
+            names.append(field_name)
+    if names:
+        compiled.append((struct.Struct('<' + codes), names))
+
+    return compiled
+
+rhd_headers = {
+    name: _compile_rhd_header(header) for name, header in [
+        ('base', rhd_global_header_base),
+        ('part1', rhd_global_header_part1),
+        ('v11', rhd_global_header_v11),
+        ('v13', rhd_global_header_v13),
+        ('v20', rhd_global_header_v20),
+        ('final', rhd_global_header_final),
+        ('signal_group', rhd_signal_group_header),
+        ('signal_channel', rhd_signal_channel_header)
     ]
+}
 
-    rhd_signal_group_header = [
-        ("signal_group_name", "QString"),
-        ("signal_group_prefix", "QString"),
-        ("signal_group_enabled", "int16"),
-        ("channel_num", "int16"),
-        ("amplified_channel_num", "int16"),
-    ]
+# Version of the parsed header cache, to bump when the content of read_rhd()'s output changes
+RHD_CACHE_VERSION = 2
 
-    rhd_signal_channel_header = [
-        ("native_channel_name", "QString"),
-        ("custom_channel_name", "QString"),
-        ("native_order", "int16"),
-        ("custom_order", "int16"),
-        ("signal_type", "int16"),
-        ("channel_enabled", "int16"),
-        ("chip_channel_num", "int16"),
-        ("board_stream_num", "int16"),
-        ("spike_scope_trigger_mode", "int16"),
-        ("spike_scope_voltage_thresh", "int16"),
-        ("spike_scope_digital_trigger_channel", "int16"),
-        ("spike_scope_digital_edge_polarity", "int16"),
-        ("electrode_impedance_magnitude", "float32"),
-        ("electrode_impedance_phase", "float32"),
-    ]
+class _RhdBuffer:
+    """
+    Header of a .rhd file read by large blocks into a single buffer, and decoded from it.
+    """
 
-    def read_qstring(f):
-        length = np.fromfile(f, dtype="uint32", count=1)[0]
+    def __init__(self, f, block_size: int = 1 << 16):
+        self.f = f
+        self.block_size = block_size
+        self.buffer = bytearray(f.read(block_size))
+        self.position = 0
+
+    def _ensure(self, nb_bytes: int):
+        # Only files whose header is larger than a block are read again
+        while self.position + nb_bytes > len(self.buffer):
+            block = self.f.read(max(self.block_size, nb_bytes))
+            if not block:
+                raise EOFError("The .rhd header is truncated")
+            self.buffer += block
+
+    def qstring(self) -> str:
+        self._ensure(4)
+        length, = struct.unpack_from('<I', self.buffer, self.position)
+        self.position += 4
         if length == 0xFFFFFFFF or length == 0:
             return ""
-        txt = f.read(length).decode("utf-16")
+        self._ensure(length)
+        txt = bytes(self.buffer[self.position:self.position + length]).decode("utf-16")
+        self.position += length
         return txt
 
-    def read_variable_header(f, header):
+    def read(self, compiled) -> dict:
         info = {}
-        for field_name, field_type in header:
-            if field_type == "QString":
-                field_value = read_qstring(f)
+        for header_struct, names in compiled:
+            if header_struct is None:
+                info[names[0]] = self.qstring()
             else:
-                field_value = np.fromfile(f, dtype=field_type, count=1)[0]
-            info[field_name] = field_value
+                self._ensure(header_struct.size)
+                info.update(zip(names, header_struct.unpack_from(self.buffer, self.position)))
+                self.position += header_struct.size
         return info
 
+def read_rhd(filepath):
+    """
+    Read and parse a RHD file.
+
+    The parsed information is cached next to the file in 'rhd_cache.json', keyed by the file's 
+    size and modification time, so that the header is only parsed once per file.
+
+    Parameters
+    ----------
+    path : str
+        Path to the .rhd file.
+
+    Returns
+    -------
+    intan_info : IntanRecordingExtractor
+        Information about the recording, that is from the Intan's .rhd file. 
+        Including the layout of the data blocks following the header: 'header_size' in bytes, 
+        'block_size' in samples, 'data_dtype' the fields of a block and 'amplifier_fields' 
+        the fields of the amplifier channels.
+    """
+    stat = os.stat(filepath)
+    key = {'file': os.path.basename(filepath), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'version': RHD_CACHE_VERSION}
+    cache_file = os.path.join(os.path.dirname(filepath), 'rhd_cache.json')
+
+    cache = {}
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'r') as f:
+                cache = json.load(f)
+        except ValueError:
+            cache = {}
+
+    cached = cache.get(key['file'])
+    if cached is not None and cached['key'] == key:
+        intan_info = cached['intan_info']
+        intan_info['accelerometer_channels'] = np.asarray(intan_info['accelerometer_channels'], dtype=int)
+        return intan_info
+
+    intan_info = _parse_rhd(filepath)
+
+    cache[key['file']] = {'key': key, 'intan_info': intan_info}
+    try:
+        with open(cache_file, 'w') as f:
+            json.dump(cache, f, default=convert_json_compatible)
+    except OSError: # Read-only input folder, the header is parsed at each launch
+        pass
+
+    return intan_info
+
+def _parse_rhd(filepath):
+    """
+    Parse the header of a RHD file, see read_rhd().
+    """
     with open(filepath, mode="rb") as f:
+        buffer = _RhdBuffer(f)
 
-        global_info = read_variable_header(f, rhd_global_header_base)
+        global_info = buffer.read(rhd_headers['base'])
 
         version = V("{major_version}.{minor_version}".format(**global_info))
 
         # the header size depends on the version :-(
-        header = list(rhd_global_header_part1)  # make a copy
+        header = list(rhd_headers['part1'])  # make a copy
 
         if version >= V("1.1"):
-            header = header + rhd_global_header_v11
+            header = header + rhd_headers['v11']
         else:
             global_info["num_temp_sensor_channels"] = 0
 
         if version >= V("1.3"):
-            header = header + rhd_global_header_v13
+            header = header + rhd_headers['v13']
         else:
             global_info["eval_board_mode"] = 0
 
         if version >= V("2.0"):
-            header = header + rhd_global_header_v20
+            header = header + rhd_headers['v20']
         else:
             global_info["reference_channel"] = ""
 
-        header = header + rhd_global_header_final
+        header = header + rhd_headers['final']
 
-        global_info.update(read_variable_header(f, header))
+        global_info.update(buffer.read(header))
 
         # read channel group and channel header
         channels_by_type = {k: [] for k in [0, 1, 2, 3, 4, 5]}
         for g in range(global_info["nb_signal_group"]):
-            group_info = read_variable_header(f, rhd_signal_group_header)
+            group_info = buffer.read(rhd_headers['signal_group'])
 
             if bool(group_info["signal_group_enabled"]):
                 for c in range(group_info["channel_num"]):
-                    chan_info = read_variable_header(f, rhd_signal_channel_header)
+                    chan_info = buffer.read(rhd_headers['signal_channel'])
                     if bool(chan_info["channel_enabled"]):
                         channels_by_type[chan_info["signal_type"]].append(chan_info)
 
+        # The data blocks start right after the header
+        header_size = buffer.position
+
     sr = global_info["sampling_rate"]
 
     # construct the data block dtype and reorder channels
@@ -411,8 +555,52 @@ def read_rhd(filepath):
 
     intan_info['num_channels'] = len(acc_ch) + ch_offset
 
+    ## Data blocks
+    intan_info['header_size'] = header_size
+    intan_info['block_size'] = BLOCK_SIZE
+    intan_info['data_dtype'] = [list(field) for field in data_dtype]
+    intan_info['amplifier_fields'] = [chan_info["native_channel_name"] for chan_info in channels_by_type[0]]
+
     return intan_info
 
+def resolve_dat_files(base_folder, dat_files) -> list:
+    """
+    Ordered list of the .dat files of a session recorded in several files.
+
+    Parameters
+    ----------
+    base_folder : str or path
+        Path to the folder containing input data, relative paths being relative to it.
+    dat_files : str or list
+        Either a glob pattern, the files being sorted by name, or a list of paths kept in its order.
+
+    Returns
+    -------
+    files : list
+        Paths of the .dat files.
+    """
+    if isinstance(dat_files, str):
+        files = sorted(glob.glob(os.path.join(base_folder, dat_files)))
+    else:
+        files = [os.path.join(base_folder, dat_file) for dat_file in dat_files]
+
+    if not files:
+        raise FileNotFoundError(f"No .dat file matches {dat_files} in {base_folder}.")
+    for dat_file in files:
+        if not os.path.isfile(dat_file):
+            raise FileNotFoundError(f"Could not find the .dat file {dat_file}.")
+
+    return files
+
+def rhd_data_files(folder) -> list:
+    """
+    The .rhd files of a folder holding data blocks after their header (Intan's traditional format),
+    sorted by name, that is by time as Intan suffixes them with their start time.
+    """
+    rhd_files = sorted(os.path.join(folder, file) for file in os.listdir(folder) if file.endswith('.rhd'))
+
+    return [rhd_file for rhd_file in rhd_files if os.path.getsize(rhd_file) > read_rhd(rhd_file)['header_size']]
+
 def load_data(paths, probe_dict):
     """
     Load the data from the paths.
@@ -473,16 +661,34 @@ def load_data(paths, probe_dict):
     rec_offsets = metadata['Offset_to_uV']
     
     # Opening of the recording
-    raw_recording = si.read_binary(paths['dat'],
-                                   metadata['Sampling_rate'],
-                                   metadata['Dtype'], 
-                                   metadata['Nb_channels'],                 
-                                   gain_to_uV=rec_gains,
-                                   offset_to_uV=rec_offsets,
-                                   is_filtered=metadata['Filtered']) 
+    if paths['rhd_files']:
+        from .intan import IntanRHDRecording
+
+        # Only the amplifier channels, memory-mapped from the .rhd files' data blocks
+        raw_recording = IntanRHDRecording(paths['rhd_files'])
+        metadata['Rhd_files'] = raw_recording.get_annotation('rhd_files')
+    else:
+        dat_files = paths['dat_files'] if paths['dat_files'] else [paths['dat']]
+        chunks = [si.read_binary(dat_file,
+                                 metadata['Sampling_rate'],
+                                 metadata['Dtype'], 
+                                 metadata['Nb_channels'],                 
+                                 gain_to_uV=rec_gains,
+                                 offset_to_uV=rec_offsets,
+                                 is_filtered=metadata['Filtered'])
+                  for dat_file in dat_files]
+
+        if len(chunks) == 1:
+            raw_recording = chunks[0]
+        else:
+            # A single segment over the files, the reads overlapping two files being handled by spikeinterface
+            raw_recording = si.concatenate_recordings(chunks)
+            metadata['Dat_files'] = [{'file': dat_file, 'num_samples': int(chunk.get_num_samples())} 
+                                     for dat_file, chunk in zip(dat_files, chunks)]
     
     # Removing accelerometer channels
-    recording = raw_recording.remove_channels(metadata['Accelerometer'])
+    recording = raw_recording.remove_channels([channel for channel in metadata['Accelerometer'] 
+                                               if channel in raw_recording.channel_ids])
 
     return recording, metadata
 
@@ -569,7 +775,142 @@ def open_sorting(paths, recordings, metadata):
     
     return data
 
-def loader(sorting_analyzer, extension: str):
+def _resolve_extensions(sorting_analyzer, extensions) -> list:
+    """
+    Extensions to compute to get the required ones, their dependencies first, 
+    without the ones already computed.
+    """
+    available = set(sorting_analyzer.get_saved_extension_names()) | set(sorting_analyzer.get_loaded_extension_names())
+    ordered = []
+
+    def visit(extension):
+        if extension in ordered or extension in available:
+            return
+        for dependency in extension_dependencies.get(extension, []):
+            visit(dependency)
+        ordered.append(extension)
+
+    for extension in extensions:
+        visit(extension)
+
+    return ordered
+
+def _covers_all_spikes(sorting_analyzer, params: dict) -> bool:
+    """
+    Whether the waveforms extension holds (or will hold) the waveform of every spike.
+    """
+    if 'random_spikes' in params:
+        random_spikes = params['random_spikes']
+        return random_spikes['method'] == 'all' or random_spikes['max_spikes_per_unit'] == op.inf
+    
+    nb_random_spikes = len(sorting_analyzer.get_extension('random_spikes').get_data())
+    return nb_random_spikes == sorting_analyzer.sorting.count_total_num_spikes()
+
+def _set_extension(sorting_analyzer, extension: str, params: dict, data: dict):
+    """
+    Register an extension whose data were derived from other extensions instead of computed from the recording.
+    Relies on spikeinterface's extensions internals (params, data and run_info).
+    """
+    from spikeinterface.core.sortinganalyzer import get_extension_class
+
+    ext = get_extension_class(extension)(sorting_analyzer)
+    ext.set_params(save=False, **params)
+    ext.data.update(data)
+    ext.run_info['run_completed'] = True
+
+    if sorting_analyzer.format != 'memory':
+        ext.save()
+    sorting_analyzer.extensions[extension] = ext
+
+    return ext
+
+def _amplitudes_from_waveforms(sorting_analyzer, params: dict):
+    """
+    Compute the 'spike_amplitudes' extension from the waveforms of all the spikes, as spikeinterface does 
+    from the traces: the value on the unit's extremum channel, at the template's peak.
+    """
+    peak_sign = params['peak_sign']
+    extremum = si.get_template_extremum_channel(sorting_analyzer, peak_sign=peak_sign, outputs='index')
+    shifts = si.get_template_extremum_channel_peak_shift(sorting_analyzer, peak_sign=peak_sign)
+
+    waveforms_ext = sorting_analyzer.get_extension('waveforms')
+    waveforms = waveforms_ext.data['waveforms']
+    nbefore = waveforms_ext.nbefore
+
+    # Column of the extremum channel in each unit's waveforms, and sample of the peak
+    columns, samples = [], []
+    for u_index, u_id in enumerate(sorting_analyzer.unit_ids):
+        if sorting_analyzer.is_sparse():
+            columns.append(int(np.flatnonzero(sorting_analyzer.sparsity.mask[u_index]).tolist().index(extremum[u_id])))
+        else:
+            columns.append(int(extremum[u_id]))
+        samples.append(min(max(nbefore + shifts[u_id], 0), waveforms.shape[1] - 1))
+
+    random_spikes = sorting_analyzer.get_extension('random_spikes').get_data()
+    unit_index = sorting_analyzer.sorting.to_spike_vector()['unit_index'][random_spikes]
+    amplitudes = np.asarray(waveforms[np.arange(len(unit_index)), np.asarray(samples)[unit_index], np.asarray(columns)[unit_index]])
+
+    return _set_extension(sorting_analyzer, 'spike_amplitudes', params, {'amplitudes': amplitudes})
+
+def load_extensions(sorting_analyzer, extensions: list, **kwargs) -> dict:
+    """
+    Load or compute several extensions at once, taking kwargs from extensions_dict.
+
+    The dependency graph is resolved once, and all the missing extensions are given to spikeinterface
+    in a single compute() call, so that the ones reading the recording share its chunked traversal.
+    When the waveforms of every spike are extracted, the spike amplitudes are read from them
+    instead of traversing the recording again. If spykeparams['general']['cache_folder'] is set,
+    the extensions are first looked up in the extension cache, see cache.ExtensionCache.
+
+    Parameters
+    ----------
+    sorting_analyzer : 
+        spikeinterface sorting analyzer object
+    extensions : list
+        Names of the required extensions
+    **kwargs : 
+        Parameters overriding extensions_dict, per extension, e.g. quality_metrics={'skip_pc_metrics': True}.
+
+    Returns
+    -------
+    loaded_ext : dict
+        The required extensions, by name
+    """
+    from .cache import get_extension_cache
+
+    missing = _resolve_extensions(sorting_analyzer, extensions)
+    params = {extension: {**extensions_dict.get(extension, {}), **kwargs.get(extension, {})} for extension in missing}
+
+    # Extensions computed by a previous run with the same recording, sorting and parameters are restored
+    cache = get_extension_cache(sorting_analyzer) if missing else None
+    if cache is not None:
+        keys = cache.keys(sorting_analyzer, missing, params)
+        missing = cache.restore(sorting_analyzer, missing, keys)
+        params = {extension: params[extension] for extension in missing}
+
+    derive_amplitudes = ('spike_amplitudes' in params 
+                         and ('waveforms' in params or sorting_analyzer.has_extension('waveforms'))
+                         and _covers_all_spikes(sorting_analyzer, params))
+
+    # Extensions are computed in batches, only split where the amplitudes are derived from the waveforms
+    batch = {}
+    for extension in missing:
+        if derive_amplitudes and extension == 'spike_amplitudes':
+            if batch:
+                sorting_analyzer.compute(batch)
+                batch = {}
+            _amplitudes_from_waveforms(sorting_analyzer, params[extension])
+        else:
+            batch[extension] = params[extension]
+    if batch:
+        sorting_analyzer.compute(batch)
+
+    if cache is not None:
+        cache.store(sorting_analyzer, missing, keys)
+
+    return {extension: sorting_analyzer.get_extension(extension) for extension in extensions}
+
+def loader(sorting_analyzer, extension: str, **kwargs):
     """
     Load or compute any extension, taking kwargs from extensions_dict.
 
@@ -579,33 +920,15 @@ def loader(sorting_analyzer, extension: str):
         spikeinterface sorting analyzer object
     extension: str
         Name of the required extension
+    **kwargs : 
+        Parameters of the extension overriding extensions_dict, only used if it has to be computed.
 
     Returns
     -------
     loaded_ext : list
         The required extension
     """  
-    saved_ext = sorting_analyzer.get_saved_extension_names()
-
-    if extension == 'waveforms' and not 'random_spikes' in saved_ext:
-        loader(sorting_analyzer, 'random_spikes')
-    elif extension == 'principal_components' and not 'waveforms' in saved_ext:
-        loader(sorting_analyzer, 'waveforms')
-    elif extension == 'quality_metrics' and not {'noise_levels', 'spike_amplitudes'}.issubset(saved_ext):
-        loader(sorting_analyzer, 'noise_levels')
-        loader(sorting_analyzer, 'spike_amplitudes')
-    elif extension == 'templates' and not 'waveforms' in saved_ext:
-        loader(sorting_analyzer, 'waveforms')
-        
-    kwargs = extensions_dict[extension]
-
-    if extension in sorting_analyzer.get_loaded_extension_names():
-        loaded_ext = sorting_analyzer.get_extension(extension)
-    else:
-        loaded_ext = sorting_analyzer.compute(extension, 
-                                              **kwargs)
-        
-    return loaded_ext
+    return load_extensions(sorting_analyzer, [extension], **{extension: kwargs})[extension]
 
 def rename_annot(data):
     """
@@ -632,10 +955,56 @@ def convert_json_compatible(obj):
     else:
         raise TypeError(f"Type {type(obj)} not serializable")
 
+def folder_size(path) -> int:
+    """
+    Size on disk of a folder, in bytes.
+    """
+    return sum(os.path.getsize(os.path.join(root, file)) 
+               for root, _, files in os.walk(path) 
+               for file in files)
+
+def extremum_channels(recording, sorting, max_spikes_per_unit: int = 100) -> dict:
+    """
+    Estimate the extremum channel of each unit from the average waveform of a few of its spikes.
+    The average is accumulated in memory, without storing any waveform.
+
+    Parameters
+    ----------
+    recording : recording
+        A spikeinterface recording object.
+    sorting : sorting
+        A spikeinterface sorting object.
+    max_spikes_per_unit : int
+        Number of spikes per unit used for the estimation. Default is 100.
+
+    Returns
+    -------
+    max_amp_ch : dict
+        Extremum channel id of each unit.
+    """
+    analyzer = si.create_sorting_analyzer(sorting,
+                                          recording,
+                                          format='memory',
+                                          sparse=False)
+    analyzer.compute('random_spikes', 
+                     **{**extensions_dict['random_spikes'], 'max_spikes_per_unit': max_spikes_per_unit})
+    analyzer.compute('templates', 
+                     **{**extensions_dict['templates'], 'operators': ['average']})
+
+    return si.get_template_extremum_channel(analyzer, 
+                                            peak_sign='both', 
+                                            mode='extremum')
+
 def exporter(id, recording, sorting, folder, metadata:dict, mode:int = 0):
     """
     Export the sorting into a sorting analyzer sparse, with required properties.
 
+    The sparsity is the shank of each unit's extremum channel. The extremum channels are
+    estimated from a few spikes per unit (spykeparams['spikesorting']['extremum_spikes']), 
+    so the only waveforms extracted are the shank-sparse ones of the final analyzer.
+    The timings and the disk usage of the export are saved in metadata['Exports'].
+    After the curation, see derive_analyzer() instead.
+
     Parameters
     ----------
     recording : recording
@@ -660,6 +1029,8 @@ def exporter(id, recording, sorting, folder, metadata:dict, mode:int = 0):
     sorting_analyzer :
         A spikeinterface sorting_analyzer object.
     """
+    from . import spykeparams
+
     if mode == 0:
         name = 'Analyzer'
     elif mode == 1:
@@ -667,15 +1038,7 @@ def exporter(id, recording, sorting, folder, metadata:dict, mode:int = 0):
     else:
         raise ValueError('Mode should be either 0 or 1')
     
-    dense_path = os.path.join(folder['tmp'], f'{name}_dense')
-    final_sa_path = os.path.join(folder['Metadata'], f'{name}_sparsed')
-
-    # Need a Analyzer for computing the sparsity
-    dense_analyzer = si.create_sorting_analyzer(sorting,
-                                                recording,
-                                                folder=dense_path,
-                                                format='binary_folder',
-                                                sparse=False)
+    final_sa_path = os.path.join(folder['metadata'], f'{name}_sparsed')
     
     if id is None:
         shank_groups = [
@@ -694,14 +1057,9 @@ def exporter(id, recording, sorting, folder, metadata:dict, mode:int = 0):
     if not 'shank' in recording.get_property_keys():
         recording.set_property('shank', shank_groups)
 
-    if not 'shank' in dense_analyzer.recording.get_property_keys():
-        dense_analyzer.recording.set_property('shank', shank_groups)
-
-    loader(dense_analyzer, 'waveforms')
-    loader(dense_analyzer, 'templates')
-    max_amp_ch = si.get_template_extremum_channel(dense_analyzer, 
-                                                  peak_sign='both', 
-                                                  mode='extremum')
+    start = time.perf_counter()
+    max_amp_ch = extremum_channels(recording, sorting, spykeparams['spikesorting']['extremum_spikes'])
+    extremum_time = time.perf_counter() - start
 
     group_prop = [
         shank_id
@@ -711,28 +1069,368 @@ def exporter(id, recording, sorting, folder, metadata:dict, mode:int = 0):
     ]
 
     sorting.set_property('shank', group_prop)
-    dense_analyzer.sorting.set_property('shank', group_prop)
 
-    sparsity = si.compute_sparsity(dense_analyzer,
-                                   method='by_property',
-                                   peak_sign='both',
-                                   by_property='shank')
-    
-    # delete the dense analyzer
-    # if os.path.isdir(dense_path):
-    #     shutil.rmtree(dense_path)
+    # Each unit is sparse on the channels of its shank
+    mask = np.asarray(group_prop)[:, None] == np.asarray(recording.get_property('shank'))[None, :]
+    sparsity = si.ChannelSparsity(mask, sorting.unit_ids, recording.channel_ids)
 
+    start = time.perf_counter()
     sorting_analyzer = si.create_sorting_analyzer(sorting,
                                                   recording,
                                                   folder=final_sa_path,
                                                   format='binary_folder',
                                                   sparsity=sparsity)
     if mode == 0:
+        # Only a sample of each unit's spikes is extracted, the curation projects its thresholds on the others
+        if spykeparams['curation']['sample_size']:
+            loader(sorting_analyzer, 'random_spikes', max_spikes_per_unit=spykeparams['curation']['sample_size'])
         loader(sorting_analyzer, 'templates')
+    analyzer_time = time.perf_counter() - start
+
+    metadata.setdefault('Exports', {})[final_sa_path] = {
+        'extremum_channels_s': extremum_time,
+        'analyzer_s': analyzer_time,
+        'disk_usage_MB': folder_size(final_sa_path) / 1e6
+    }
     
     return recording, sorting, sorting_analyzer
 
-def phy_export(data, folder, units):
+def _spike_keys(spike_vector, unit_shanks) -> np.ndarray:
+    """
+    Key identifying the waveform of each spike: its segment, its sample and the shank of its unit.
+    """
+    return ((spike_vector['segment_index'].astype(np.int64) << 48) 
+            | (np.asarray(unit_shanks, dtype=np.int64)[spike_vector['unit_index']] << 40) 
+            | spike_vector['sample_index'].astype(np.int64))
+
+def _match_spikes(source_keys, keys) -> np.ndarray:
+    """
+    Index of each spike among the source spikes having the same key.
+    Spikes sharing a key have the same waveform, they are matched in order.
+    """
+    source_order = np.argsort(source_keys, kind='stable')
+    sorted_keys = source_keys[source_order]
+
+    # Rank of each spike among the spikes with the same key
+    order = np.argsort(keys, kind='stable')
+    first = np.searchsorted(keys[order], keys[order], side='left')
+    ranks = np.empty(len(keys), dtype=np.int64)
+    ranks[order] = np.arange(len(keys)) - first
+
+    positions = np.searchsorted(sorted_keys, keys, side='left') + ranks
+    assert np.all(positions < len(sorted_keys)) and np.array_equal(sorted_keys[positions], keys), \
+        "Some spikes of the curated sorting aren't in the source analyzer"
+
+    return source_order[positions]
+
+def _map_spikes(source_analyzer, sorting, masks):
+    """
+    Match the spikes of a curated sorting with the spikes of the source analyzer.
+
+    Returns
+    -------
+    matches : np.ndarray
+        Index of each spike in the source spike vector.
+    random_spikes : np.ndarray
+        Spikes whose source spike has a waveform.
+    rows : np.ndarray
+        Row of the source waveform of these spikes.
+    """
+    channel_shanks = np.asarray(source_analyzer.recording.get_property('shank'))
+    source_shanks = [channel_shanks[np.flatnonzero(mask)[0]] for mask in source_analyzer.sparsity.mask]
+    shanks = [channel_shanks[np.flatnonzero(mask)[0]] for mask in masks]
+
+    source_spikes = source_analyzer.sorting.to_spike_vector()
+    matches = _match_spikes(_spike_keys(source_spikes, source_shanks), _spike_keys(sorting.to_spike_vector(), shanks))
+
+    source_rows = np.full(len(source_spikes), -1, dtype=np.int64)
+    random_spikes = source_analyzer.get_extension('random_spikes').get_data()
+    source_rows[random_spikes] = np.arange(len(random_spikes))
+
+    random_spikes = np.flatnonzero(source_rows[matches] >= 0)
+
+    return matches, random_spikes, source_rows[matches[random_spikes]]
+
+def _remapped_waveforms(source_analyzer, masks, units, source_units, rows, chunk_size: int):
+    """
+    Read source waveforms by chunks, moving them from the channels of their source unit
+    to the ones of their curated unit.
+
+    Yields
+    ------
+    chunk : np.ndarray
+        Positions of the waveforms in rows.
+    waveforms : np.ndarray
+        Waveforms on the channels of the curated unit.
+    """
+    source_waveforms = source_analyzer.get_extension('waveforms').data['waveforms']
+    source_masks = source_analyzer.sparsity.mask
+
+    for u_index, source_u_index in np.unique(np.stack([units, source_units], axis=1), axis=0):
+        source_channels = np.flatnonzero(source_masks[source_u_index]).tolist()
+        columns = [source_channels.index(channel) for channel in np.flatnonzero(masks[u_index])]
+
+        spikes = np.flatnonzero((units == u_index) & (source_units == source_u_index))
+        for chunk_start in range(0, len(spikes), chunk_size):
+            chunk = spikes[chunk_start:chunk_start + chunk_size]
+            yield chunk, source_waveforms[rows[chunk]][:, :, columns]
+
+def derive_templates(source_analyzer, sorting, unit_channels: dict, unit_ids, chunk_size: int = 10000) -> dict:
+    """
+    Templates of units of a curated sorting, computed from the waveforms of the analyzer 
+    of the sorting it was curated from, without reading the recording.
+
+    Parameters
+    ----------
+    source_analyzer : sorting_analyzer
+        Sparse analyzer of the sorting before the curation, with its waveforms.
+    sorting : sorting
+        The curated sorting.
+    unit_channels : dict
+        Channel ids of each curated unit, its shank.
+    unit_ids : list
+        Units whose template is required.
+    chunk_size : int
+        Number of waveforms read at once. Default is 10000.
+
+    Returns
+    -------
+    templates : dict
+        Template of each unit, shape (n_samples, n_channels) on the unit's channels.
+    """
+    sparsity = si.ChannelSparsity.from_unit_id_to_channel_ids(unit_channels, 
+                                                              sorting.unit_ids, 
+                                                              source_analyzer.channel_ids)
+    matches, random_spikes, rows = _map_spikes(source_analyzer, sorting, sparsity.mask)
+
+    units = sorting.to_spike_vector()['unit_index'][random_spikes]
+    source_units = source_analyzer.sorting.to_spike_vector()['unit_index'][matches[random_spikes]]
+    nb_samples = source_analyzer.get_extension('waveforms').data['waveforms'].shape[1]
+    operator = getattr(np, extensions_dict['templates']['operators'][0])
+
+    templates = {}
+    for u_id in unit_ids:
+        u_index = sorting.id_to_index(u_id)
+        in_unit = units == u_index
+
+        waveforms = np.zeros((in_unit.sum(), nb_samples, sparsity.mask[u_index].sum()), dtype=np.float32)
+        for chunk, chunk_waveforms in _remapped_waveforms(source_analyzer, sparsity.mask, units[in_unit], 
+                                                          source_units[in_unit], rows[in_unit], chunk_size):
+            waveforms[chunk] = chunk_waveforms
+
+        templates[u_id] = operator(waveforms, axis=0)
+
+    return templates
+
+def derive_analyzer(source_analyzer, sorting, unit_channels: dict, folder, metadata: dict, chunk_size: int = 10000):
+    """
+    Build the analyzer of a curated sorting from the analyzer of the sorting it was curated from.
+
+    The curation only relabels spikes, so no waveform is extracted: each spike is matched with its
+    source spike (same segment, sample and shank), whose waveform is copied. The templates, amplitudes
+    and quality metrics are then computed from the copied waveforms, and the noise levels are copied,
+    the recording is never read.
+
+    Parameters
+    ----------
+    source_analyzer : sorting_analyzer
+        Sparse analyzer of the sorting before the curation, with its waveforms.
+    sorting : sorting
+        The curated sorting.
+    unit_channels : dict
+        Channel ids of each curated unit, its shank.
+    folder : dict
+        Dict with all the required paths.
+    metadata : dict
+        Dict with channel map information.
+    chunk_size : int
+        Number of waveforms copied at once. Default is 10000.
+
+    Returns
+    -------
+    sorting_analyzer :
+        A spikeinterface sorting_analyzer object, of the curated sorting.
+    """
+    from spikeinterface.core.sortinganalyzer import get_extension_class
+
+    start = time.perf_counter()
+
+    recording = source_analyzer.recording
+    final_sa_path = os.path.join(folder['metadata'], 'Final_analyzer_sparsed')
+
+    sparsity = si.ChannelSparsity.from_unit_id_to_channel_ids(unit_channels, 
+                                                              sorting.unit_ids, 
+                                                              recording.channel_ids)
+    sorting_analyzer = si.create_sorting_analyzer(sorting,
+                                                  recording,
+                                                  folder=final_sa_path,
+                                                  format='binary_folder',
+                                                  sparsity=sparsity)
+
+    # Matching the curated spikes with the source ones
+    matches, random_spikes, rows = _map_spikes(source_analyzer, sorting, sparsity.mask)
+    spike_vector = sorting.to_spike_vector()
+
+    _set_extension(sorting_analyzer, 'random_spikes', 
+                   source_analyzer.get_extension('random_spikes').params, 
+                   {'random_spikes_indices': random_spikes})
+
+    # Copying the waveforms, from the channels of the source unit to the ones of the curated unit.
+    # They are written in place in the extension folder, as spikeinterface's waveforms extension does,
+    # saving the extension keeps this memmap instead of writing it again
+    source_ext = source_analyzer.get_extension('waveforms')
+    source_waveforms = source_ext.data['waveforms']
+
+    ext = get_extension_class('waveforms')(sorting_analyzer)
+    ext.set_params(save=True, **source_ext.params)
+    waveforms = np.lib.format.open_memmap(os.path.join(ext._get_binary_extension_folder(), 'waveforms.npy'), 
+                                          mode='w+', 
+                                          dtype=source_waveforms.dtype,
+                                          shape=(len(random_spikes), source_waveforms.shape[1], int(sparsity.max_num_active_channels)))
+
+    units = spike_vector['unit_index'][random_spikes]
+    source_units = source_analyzer.sorting.to_spike_vector()['unit_index'][matches[random_spikes]]
+    for chunk, chunk_waveforms in _remapped_waveforms(source_analyzer, sparsity.mask, units, source_units, rows, chunk_size):
+        waveforms[chunk, :, :chunk_waveforms.shape[2]] = chunk_waveforms
+    waveforms.flush()
+
+    ext.data['waveforms'] = waveforms
+    ext.run_info['run_completed'] = True
+    ext._save_run_info()
+    ext._save_data()
+    sorting_analyzer.extensions['waveforms'] = ext
+
+    _set_extension(sorting_analyzer, 'noise_levels', 
+                   loader(source_analyzer, 'noise_levels').params,
+                   {'noise_levels': loader(source_analyzer, 'noise_levels').get_data()})
+
+    # Only a sample of the spikes have a waveform, the amplitudes are the ones of the source spikes
+    if len(random_spikes) < len(spike_vector):
+        source_amplitudes = loader(source_analyzer, 'spike_amplitudes')
+        _set_extension(sorting_analyzer, 'spike_amplitudes', 
+                       source_amplitudes.params,
+                       {'amplitudes': source_amplitudes.get_data()[matches]})
+
+    load_extensions(sorting_analyzer, ['templates', 'spike_amplitudes', 'quality_metrics'])
+
+    metadata.setdefault('Exports', {})[final_sa_path] = {
+        'derived_s': time.perf_counter() - start,
+        'disk_usage_MB': folder_size(final_sa_path) / 1e6
+    }
+
+    return sorting_analyzer
+
+def _written_binary(recording, dat_path: str, written: Optional[list] = None) -> Optional[dict]:
+    """
+    Binary file of a recording written by this run, e.g. with save_dat, with all its channels in their
+    order, None if there is none. A file of the same size left by another run may hold other traces,
+    so only the paths in written are considered.
+    """
+    dtype = recording.get_dtype()
+    nb_bytes = recording.get_num_samples() * recording.get_num_channels() * dtype.itemsize
+    if (recording.get_num_segments() > 1 or dat_path not in (written or [])
+            or not os.path.exists(dat_path) or os.path.getsize(dat_path) != nb_bytes):
+        return None
+
+    return {
+        'dat_path': dat_path,
+        'dtype': dtype.name,
+        'n_channels': recording.get_num_channels(),
+        'channel_map': np.arange(recording.get_num_channels(), dtype='int32')
+        }
+
+def shared_binary(recordings: list, folder: str, written: Optional[list] = None) -> list:
+    """
+    Write the preprocessed recordings of all the probes side by side, in a single binary file, 
+    so that the phy folders of every probe point to it instead of holding their own copy.
+    The file is reused as is only if this run wrote it, e.g. with save_dat, as a file of the same
+    size left by another run may hold other traces.
+
+    Parameters
+    ----------
+    recordings : list
+        Preprocessed recordings, one per probe.
+    folder : str
+        Folder of the binary file.
+    written : list, optional
+        Paths of the preprocessed binaries written by this run, see metadata['Preprocessed_binaries'].
+
+    Returns
+    -------
+    binaries : list
+        For each recording, dict with the 'dat_path', 'dtype' and 'n_channels' of the binary file,
+        and the 'channel_map' of the recording's channels in it.
+    """
+    recording = recordings[0] if len(recordings) == 1 else si.aggregate_channels(recordings)
+    dtype = recording.get_dtype()
+
+    dat_path = os.path.join(folder, 'preprocessed_rec.dat')
+    if _written_binary(recording, dat_path, written) is None:
+        os.makedirs(folder, exist_ok=True)
+        si.write_binary_recording(recording, file_paths=dat_path, dtype=dtype)
+
+    offsets = np.cumsum([0] + [rec.get_num_channels() for rec in recordings])
+
+    return [{
+        'dat_path': dat_path,
+        'dtype': dtype.name,
+        'n_channels': recording.get_num_channels(),
+        'channel_map': np.arange(offsets[i], offsets[i + 1], dtype='int32')
+        } for i in range(len(recordings))]
+
+def _phy_binary(phy_folder: str, binary: dict) -> None:
+    """
+    Point the params.py of a phy folder to a shared binary file, the channels of the folder being
+    selected in it by channel_map.npy.
+    """
+    try:
+        dat_path = os.path.relpath(binary['dat_path'], phy_folder)
+    except ValueError: # Different drives
+        dat_path = os.path.abspath(binary['dat_path'])
+
+    values = {
+        'dat_path': f"r'{dat_path}'",
+        'n_channels_dat': binary['n_channels'],
+        'dtype': f"'{binary['dtype']}'"
+    }
+
+    params_file = os.path.join(phy_folder, 'params.py')
+    with open(params_file, 'r') as f:
+        lines = f.read().splitlines()
+    lines = [f"{line.split('=')[0].strip()} = {values[line.split('=')[0].strip()]}" 
+             if line.split('=')[0].strip() in values else line 
+             for line in lines]
+    with open(params_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    np.save(os.path.join(phy_folder, 'channel_map.npy'), binary['channel_map'])
+
+def _phy_pc_features(sorting_analyzer, phy_folder: str) -> None:
+    """
+    Write the pc features of phy. When the waveforms of every spike were extracted, their projections 
+    are the features, otherwise the waveforms of the other spikes are read from the recording.
+    """
+    pca = loader(sorting_analyzer, 'principal_components')
+
+    # Phy only holds the first segment, whose spikes come first in the spike vector
+    nb_spikes = len(sorting_analyzer.sorting.to_spike_vector(concatenated=False)[0])
+    pc_file = os.path.join(phy_folder, 'pc_features.npy')
+    if _covers_all_spikes(sorting_analyzer, {}):
+        np.save(pc_file, pca.data['pca_projection'][:nb_spikes])
+    else:
+        pca.run_for_all_spikes(pc_file)
+
+    # Same units as spikeinterface's export, without the empty ones
+    nb_unit_spikes = sorting_analyzer.sorting.count_num_spikes_per_unit()
+    unit_ids = [u_id for u_id in sorting_analyzer.unit_ids if nb_unit_spikes[u_id] > 0]
+    channels = sorting_analyzer.sparsity.unit_id_to_channel_indices
+
+    pc_feature_ind = -np.ones((len(unit_ids), max(len(channels[u_id]) for u_id in unit_ids)), dtype='int64')
+    for u_index, u_id in enumerate(unit_ids):
+        pc_feature_ind[u_index, :len(channels[u_id])] = channels[u_id]
+    np.save(os.path.join(phy_folder, 'pc_feature_ind.npy'), pc_feature_ind)
+
+def phy_export(data, folder, units, binary = None):
     """
     Export data to Phy format.
 
@@ -746,6 +1444,9 @@ def phy_export(data, folder, units):
         Contains all required paths
     units : dict
         Contains unit information, optional.
+    binary : dict
+        Shared binary file to point to, as returned by shared_binary(). 
+        If None, the recording is copied in the phy folder.
 
     Returns
     -------
@@ -772,14 +1473,20 @@ def phy_export(data, folder, units):
         sorting_analyzer.set_sorting_property('shank', [units[unit].mother for unit in sorting_analyzer.unit_ids], save = True)
         sorting_analyzer.set_sorting_property('n_spikes', [units[unit].nb_spikes for unit in sorting_analyzer.unit_ids], save = True)
 
+    # The pc features are written afterwards, from the extracted waveforms
     sexp.export_to_phy(sorting_analyzer,
                        output_folder = folder['phy'],
                        compute_amplitudes = False,
-                       compute_pc_features = True,
-                       copy_binary = True,
+                       compute_pc_features = False,
+                       copy_binary = binary is None,
                        remove_if_exists = True,
                        template_mode = "median")
     
+    _phy_pc_features(sorting_analyzer, folder['phy'])
+
+    if binary is not None:
+        _phy_binary(folder['phy'], binary)
+    
     # if units is not None:
     #     for property in os.listdir(phy_folder):
     #         if property.endswith('.tsv'):
@@ -841,10 +1548,7 @@ def klusters_export(
             raise ValueError(f"Missing required property: {prop}")
 
     # ---------- make sure we have waveforms and PCA features ----------
-    # Waveforms
-    loader(sorting_analyzer, 'waveforms')
-    # Principal components
-    loader(sorting_analyzer, 'principal_components')
+    load_extensions(sorting_analyzer, ['waveforms', 'principal_components'])
 
     n_shanks = len(np.unique(sorting.get_property('sh')))
 
@@ -963,14 +1667,33 @@ def export_results(data, paths, units, metadata):
     # Exporting to phy
     if spykeparams['general']['export_to_phy']:
         if spykeparams['general']['pipeline'] == 'all':
+            binaries = [None]
+            if spykeparams['general']['phy_binary'] == 'shared':
+                binaries = shared_binary([data['sorting_analyzer'].recording], paths['preprocessing'],
+                                         metadata.get('Preprocessed_binaries', []))
             phy_export(data,
                        paths,
-                       units)
+                       units,
+                       binaries[0])
         else:
-            for probe_id, _ in metadata['Probes'].items():
+            # Probes whose sorting failed are skipped
+            probe_ids = [probe_id for probe_id in metadata['Probes'].keys() if data[probe_id] is not None]
+            binaries = [None] * len(probe_ids)
+            if spykeparams['general']['phy_binary'] == 'shared':
+                # The binaries written by this run for each probe, else all the probes in a single file
+                binaries = [_written_binary(data[probe_id]['sorting_analyzer'].recording,
+                                            os.path.join(paths[f'Probe_{probe_id}']['preprocessing'], 'preprocessed_rec.dat'),
+                                            metadata.get('Preprocessed_binaries', []))
+                            for probe_id in probe_ids]
+                if None in binaries:
+                    binaries = shared_binary([data[probe_id]['sorting_analyzer'].recording for probe_id in probe_ids], 
+                                             os.path.join(paths['output_folder'], 'Preprocessing'),
+                                             metadata.get('Preprocessed_binaries', []))
+            for probe_id, binary in zip(probe_ids, binaries):
                 phy_export(data[probe_id],
                         paths[f'Probe_{probe_id}'],
-                        units[probe_id])
+                        units[probe_id],
+                        binary)
                 
     # Exporting to klusters
     if spykeparams['general']['export_to_klusters']:
@@ -980,6 +1703,8 @@ def export_results(data, paths, units, metadata):
                             units)
         else:
             for probe_id, _ in metadata['Probes'].items():
+                if data[probe_id] is None:
+                    continue
                 klusters_export(data[probe_id],
                                 paths[f'Probe_{probe_id}'],
                                 units[probe_id])